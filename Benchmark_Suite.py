@@ -0,0 +1,456 @@
+"""
+Benchmark suite for reward scoring, narrative generation and zero-shot inference.
+
+All API traffic goes to a local mock judge server with configurable latency and error rate,
+and zero-shot inference runs a small model on CPU, so runs are repeatable on any machine.
+Each benchmark reports samples/sec, latency (p50/p95/p99 per sample, or the mean per batch for
+batched paths) and its own peak RSS plus the CUDA peak when running on a GPU. The results are saved
+as JSON so runs can be compared over time.
+
+Example:
+    python Benchmark_Suite.py --samples 200 --latency-ms 50 --error-rate 0.02 \
+        --model hf-internal-testing/tiny-random-Qwen2ForCausalLM
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import resource
+import threading
+import subprocess
+import numpy as np
+from contextlib import nullcontext
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from Metrics import METRICS
+
+FUSED_REPLY = '{"alignment": 3, "safety": 1, "explainability": 1, "bias": 0}'
+TEACHER_REPLY = ("<think>Chest pain with abnormal vitals. Could this be ESI Level 3 with two resources? No, it is "
+                 "high risk.</think>\n"
+                 "- ESI Level: 2\n- Reasoning: No immediate life-saving intervention is needed, but chest pain with "
+                 "abnormal vital signs is a high-risk presentation, so ESI level 2 is warranted.")
+
+SAMPLE_REASONINGS = [
+    "No immediate life-saving intervention is needed. Chest pain with hypotension (BP 90/60) and tachycardia "
+    "is a high-risk situation, so ESI 2 is assigned.",
+    "Vital signs are stable and the patient needs one resource (sutures), so ESI 4.",
+    "The presentation is ambiguous; the patient might need labs and imaging, possibly ESI 3.",
+    "Patient is a 45-year-old woman with abdominal pain; two resources expected (labs, CT), ESI 3.",
+]
+
+SAMPLE_NARRATIVES = [
+    "Patient is a 65-year-old male presenting with crushing substernal chest pain radiating to the left arm. "
+    "He appears diaphoretic and short of breath. BP: 90/60 mmHg, HR: 110 bpm, RR: 24/min, SpO2: 92%.",
+    "Patient is a 25-year-old female with a minor laceration on the right forearm. No active bleeding.",
+    "3-month-old infant brought in by parents with a fever of 38.6°C and decreased feeding.",
+    "Patient is a 40-year-old male with ankle pain after a fall, able to bear weight, vitals normal.",
+]
+
+
+# ===== Mock judge server =====
+
+class MockHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256  # the default backlog of 5 drops connections under concurrent load
+
+class MockJudgeServer:
+    """
+    Local HTTP server that imitates the judge and completion endpoints.
+      - .../chat/completions : OpenAI-style chat replies (GPT reward judge).
+      - .../completions      : OpenAI-style text completions (narrative generation).
+      - any other path       : DeepSeek-R1-style {"score": ...} replies.
+    Prompts asking for a JSON object get a fused four-rubric reply; DeepSeek-R1 prompts containing a
+    triage narrative get a teacher-style {"text": "- ESI Level: ..."} reply. Each request sleeps for
+    latency_ms (± jitter_ms) and fails with a 503 or 429 with probability error_rate.
+    """
+
+    def __init__(self, latency_ms: float = 20.0, jitter_ms: float = 5.0, error_rate: float = 0.0, seed: int = 0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.request_count = 0
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True  # headers and body go out as separate writes
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                status, reply = server.handle(self.path, body)
+                data = json.dumps(reply).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = MockHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.httpd.server_port}"
+
+    def handle(self, path: str, body: dict):
+        with self._lock:
+            self.request_count += 1
+            delay = max(0.0, self.random.gauss(self.latency_ms, self.jitter_ms)) / 1000.0
+            failed = self.random.random() < self.error_rate
+        time.sleep(delay)
+        if failed:
+            status = 429 if self.random.random() < 0.5 else 503
+            return status, {"error": {"message": "mock failure", "type": "server_error"}}
+
+        if path.endswith("/chat/completions"):
+            prompt = body["messages"][-1]["content"]
+            content = FUSED_REPLY if "JSON object" in prompt else "1"
+            return 200, {"choices": [{"index": 0, "message": {"role": "assistant", "content": content}}],
+                         "usage": {"prompt_tokens": len(prompt) // 4, "completion_tokens": 4,
+                                   "total_tokens": len(prompt) // 4 + 4}}
+        if path.endswith("/completions"):
+            prompt = body.get("prompt", "")
+            text = " A patient presents to the ED with the described complaint and vital signs."
+            return 200, {"choices": [{"index": 0, "text": text}],
+                         "usage": {"prompt_tokens": len(prompt) // 4, "completion_tokens": 16,
+                                   "total_tokens": len(prompt) // 4 + 16}}
+        prompt = body.get("prompt", "")
+        if "JSON object" in prompt:
+            return 200, {"text": FUSED_REPLY}
+        if "Triage Narrative:" in prompt:
+            return 200, {"text": TEACHER_REPLY}
+        return 200, {"score": 1}
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+# ===== Measurement helpers =====
+
+def current_rss_bytes():
+    """Resident set size of this process in bytes (None where /proc is unavailable)."""
+    try:
+        with open("/proc/self/statm", "rb") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+class PeakMemorySampler:
+    """
+    Track peak memory while one benchmark runs.
+
+    Process RSS (which includes PyTorch's CPU tensors, unlike tracemalloc) is sampled on a background
+    thread every interval seconds. When PyTorch is loaded and CUDA is available, the CUDA peak counter is
+    reset on entry and torch.cuda.max_memory_allocated() is read on exit.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.start_rss = None
+        self.peak_rss = None
+        self.cuda_peak = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def _cuda():
+        torch = sys.modules.get("torch")
+        return torch if torch is not None and torch.cuda.is_available() else None
+
+    def _sample(self):
+        rss = current_rss_bytes()
+        if rss is not None:
+            self.peak_rss = max(self.peak_rss or 0, rss)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def __enter__(self):
+        torch = self._cuda()
+        if torch is not None:
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+        self.start_rss = current_rss_bytes()
+        self._sample()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+        torch = self._cuda()
+        if torch is not None:
+            torch.cuda.synchronize()
+            self.cuda_peak = torch.cuda.max_memory_allocated()
+
+    def result(self):
+        mb = lambda value: value / 2 ** 20 if value is not None else None
+        return {
+            "peak_rss_mb": mb(self.peak_rss),
+            # Growth over the RSS at the start of this benchmark (memory already held by earlier runs is excluded)
+            "rss_growth_mb": mb(self.peak_rss - self.start_rss) if self.start_rss is not None else None,
+            "cuda_peak_allocated_mb": mb(self.cuda_peak),
+        }
+
+def summarize(latencies, batch_sizes, elapsed, memory):
+    """
+    Throughput, latency and memory for one benchmark.
+
+    When every call handled one sample, latency_ms holds per-sample percentiles. Batched calls report
+    batch_latency_ms instead (mean per call, no percentiles): a handful of batch timings say nothing
+    about the latency distribution and are not comparable with per-sample rows.
+    """
+    latencies_ms = np.asarray(latencies) * 1000.0
+    samples = sum(batch_sizes)
+    stats = {
+        "samples": samples,
+        "elapsed_s": elapsed,
+        "samples_per_sec": samples / elapsed if elapsed > 0 else None,
+    }
+    if all(size == 1 for size in batch_sizes):
+        stats["latency_ms"] = {
+            "mean": float(latencies_ms.mean()),
+            "p50": float(np.percentile(latencies_ms, 50)),
+            "p95": float(np.percentile(latencies_ms, 95)),
+            "p99": float(np.percentile(latencies_ms, 99)),
+        }
+    else:
+        stats["batch_latency_ms"] = {
+            "mean": float(latencies_ms.mean()),
+            "batches": len(batch_sizes),
+            "mean_batch_size": samples / len(batch_sizes),
+        }
+    stats["memory"] = memory
+    return stats
+
+def measure(fn, batches, measure_memory=True):
+    """
+    Time fn over each batch of inputs while (optionally) sampling peak memory.
+
+    Args:
+        fn (callable): Called once per batch.
+        batches (list of list): Inputs grouped into the batches passed to fn.
+        measure_memory (bool): Whether to sample RSS (and the CUDA peak) during the run.
+
+    Returns:
+        dict: samples/sec, latency (per sample, or per batch for batched calls) and peak memory.
+    """
+    sampler = PeakMemorySampler() if measure_memory else None
+    latencies = []
+    with sampler or nullcontext():
+        start = time.perf_counter()
+        for batch in batches:
+            t0 = time.perf_counter()
+            fn(batch)
+            latencies.append(time.perf_counter() - t0)
+        elapsed = time.perf_counter() - start
+    return summarize(latencies, [len(b) for b in batches], elapsed, sampler.result() if sampler else None)
+
+def chunked(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+def make_reward_records(n, seed=0):
+    rng = random.Random(seed)
+    records = []
+    for i in range(n):
+        true_esi = rng.randint(1, 5)
+        records.append({
+            "true_esi": true_esi,
+            "predicted_esi": min(5, max(1, true_esi + rng.choice([-1, 0, 0, 0, 1]))),
+            # Suffix keeps prompts distinct so caches cannot serve repeats
+            "reasoning": f"{SAMPLE_REASONINGS[i % len(SAMPLE_REASONINGS)]} (case {i})",
+            "input_is_ambiguous": rng.random() < 0.2,
+        })
+    return records
+
+
+# ===== Benchmarks =====
+
+def bench_reward_gpt(server, records, measure_memory):
+    import openai
+    openai.api_key = "mock-key"
+    openai.api_base = f"{server.url}/v1"
+    from Reward_Functions_GPT import ESITriageReward
+
+    results = {}
+    for label, fused in (("per_rubric", False), ("fused", True)):
+        reward_model = ESITriageReward(fused_judge=fused)
+        results[label] = measure(
+            lambda batch: [reward_model.compute_total_reward(r["true_esi"], r["predicted_esi"], r["reasoning"],
+                                                             r["input_is_ambiguous"]) for r in batch],
+            chunked(records, 1), measure_memory)
+    return results
+
+def bench_reward_deepseek(server, records, measure_memory, concurrency):
+    from Reward_Functions_Deepseek import ESITriageReward
+
+    results = {}
+    for label, fused in (("per_rubric", False), ("fused", True)):
+        reward_model = ESITriageReward(fused_judge=fused, api_url=f"{server.url}/deepseek-r1", api_key="mock-key")
+        results[label] = measure(
+            lambda batch: [reward_model.compute_total_reward(r["true_esi"], r["predicted_esi"], r["reasoning"],
+                                                             r["input_is_ambiguous"]) for r in batch],
+            chunked(records, 1), measure_memory)
+        results[f"{label}_score_batch"] = measure(
+            lambda batch: reward_model.score_batch(batch, concurrency=concurrency),
+            chunked(records, max(1, len(records) // 4)), measure_memory)
+    return results
+
+def bench_narratives(server, n, measure_memory, concurrency):
+    import openai
+    import pandas as pd
+    openai.api_key = "mock-key"
+    openai.api_base = f"{server.url}/v1"
+    import Generate_Narratives
+
+    rows = [
+        (i, pd.Series({
+            "Patient_Age": 20 + i % 60,
+            "Patient_Sex": "F" if i % 2 else "M",
+            "PatientChiefComplaint": ["chest pain", "laceration", "fever", "ankle pain"][i % 4],
+            "Mode of Arrival": "Ambulance" if i % 3 == 0 else "Walk-in",
+            "Arrival Time": f"{i % 24:02d}:00",
+            "Vital_Signs": "BP 120/80, HR 80, RR 16, SpO2 98%",
+        }))
+        for i in range(n)
+    ]
+    scheduler = Generate_Narratives.NarrativeScheduler(max_workers=concurrency, requests_per_minute=10 ** 6,
+                                                       tokens_per_minute=10 ** 9, backoff_base=0.01)
+    return {
+        "sequential": measure(lambda batch: [Generate_Narratives.generate_patient_narrative(row) for _, row in batch],
+                              chunked(rows, 1), measure_memory),
+        "scheduler": measure(scheduler.run, chunked(rows, max(1, n // 4)), measure_memory),
+    }
+
+def bench_zero_shot(model, n, measure_memory, batch_size, max_new_tokens, backend, threads):
+    import Method_1_ZeroShot
+    Method_1_ZeroShot.configure_backend(backend, threads=threads, model=model)
+    load_start = time.perf_counter()
+    Method_1_ZeroShot.load_model()
+    load_seconds = time.perf_counter() - load_start
+
+    texts = [f"{SAMPLE_NARRATIVES[i % len(SAMPLE_NARRATIVES)]} (case {i})" for i in range(n)]
+    return {
+        "single_no_prefix_cache": measure(
+            lambda batch: [Method_1_ZeroShot.generate_esi_prediction(t, max_new_tokens, use_prefix_cache=False)
+                           for t in batch], chunked(texts, 1), measure_memory),
+        "single_prefix_cache": measure(
+            lambda batch: [Method_1_ZeroShot.generate_esi_prediction(t, max_new_tokens) for t in batch],
+            chunked(texts, 1), measure_memory),
+        "batched": measure(
+            lambda batch: Method_1_ZeroShot.generate_esi_predictions_batch(batch, batch_size, max_new_tokens),
+            chunked(texts, batch_size), measure_memory),
+        "classify_only": measure(
+            lambda batch: Method_1_ZeroShot.classify_esi_levels_batch(batch, batch_size),
+            chunked(texts, batch_size), measure_memory),
+        "model_load": {"seconds": load_seconds, "backend": backend},
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark reward scoring, narrative generation and zero-shot inference.")
+    parser.add_argument("--samples", type=int, default=100, help="Samples per API benchmark.")
+    parser.add_argument("--inference-samples", type=int, default=16, help="Narratives per inference benchmark.")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="Mean mock judge latency.")
+    parser.add_argument("--jitter-ms", type=float, default=5.0, help="Standard deviation of mock judge latency.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of mock requests that fail.")
+    parser.add_argument("--concurrency", type=int, default=16, help="Concurrency for batch/scheduler paths.")
+    parser.add_argument("--model", default="hf-internal-testing/tiny-random-Qwen2ForCausalLM",
+                        help="Small causal LM for the CPU inference benchmark.")
+    parser.add_argument("--backend", default="cpu", choices=["auto", "cuda", "cpu", "cpu-int8"],
+                        help="Zero-shot inference backend.")
+    parser.add_argument("--threads", type=int, default=None, help="CPU threads for the inference benchmark.")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    parser.add_argument("--only", nargs="+", choices=["reward_gpt", "reward_deepseek", "narratives", "zero_shot"],
+                        help="Run only these benchmarks.")
+    parser.add_argument("--no-memory", action="store_true", help="Skip peak memory sampling.")
+    parser.add_argument("--output-dir", default="bench_results")
+    args = parser.parse_args(argv)
+
+    selected = set(args.only or ["reward_gpt", "reward_deepseek", "narratives", "zero_shot"])
+    measure_memory = not args.no_memory
+    records = make_reward_records(args.samples)
+    results = {}
+
+    with MockJudgeServer(args.latency_ms, args.jitter_ms, args.error_rate) as server:
+        if "reward_gpt" in selected:
+            print("Benchmarking GPT reward...")
+            results["reward_gpt"] = bench_reward_gpt(server, records, measure_memory)
+        if "reward_deepseek" in selected:
+            print("Benchmarking DeepSeek reward...")
+            results["reward_deepseek"] = bench_reward_deepseek(server, records, measure_memory, args.concurrency)
+        if "narratives" in selected:
+            print("Benchmarking narrative generation...")
+            results["narratives"] = bench_narratives(server, args.samples, measure_memory, args.concurrency)
+        mock_requests = server.request_count
+    if "zero_shot" in selected:
+        print("Benchmarking zero-shot inference...")
+        results["zero_shot"] = bench_zero_shot(args.model, args.inference_samples, measure_memory,
+                                               args.batch_size, args.max_new_tokens, args.backend, args.threads)
+
+    report = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "git_commit": git_commit(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "config": vars(args),
+        "mock_requests": mock_requests,
+        "process_peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "results": results,
+        "metrics": METRICS.snapshot(),
+    }
+    os.makedirs(args.output_dir, exist_ok=True)
+    output_file = os.path.join(args.output_dir, f"bench-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    with open(output_file, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+
+    for group, runs in results.items():
+        for label, stats in runs.items():
+            if "samples" not in stats:
+                continue
+            if "latency_ms" in stats:
+                latency = stats["latency_ms"]
+                timing = (f"p50 {latency['p50']:8.1f} ms  p95 {latency['p95']:8.1f} ms  "
+                          f"p99 {latency['p99']:8.1f} ms")
+            else:
+                latency = stats["batch_latency_ms"]
+                timing = f"{latency['mean']:8.1f} ms per batch of {latency['mean_batch_size']:.0f}"
+            memory = stats["memory"]
+            peak = f"  peak RSS {memory['peak_rss_mb']:8.1f} MB" if memory and memory["peak_rss_mb"] else ""
+            print(f"{group:16s} {label:24s} {stats['samples_per_sec']:10.1f} samples/s  {timing}{peak}")
+    print(f"Results saved to {output_file}")
+    return report
+
+if __name__ == "__main__":
+    main()
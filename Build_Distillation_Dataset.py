@@ -0,0 +1,351 @@
+"""
+Teacher-reasoning distillation dataset builder.
+
+Triage narratives are streamed in chunks (from a spreadsheet/CSV or the JSONL shards written by
+Generate_Narratives.generate_narratives_streaming) and sent concurrently to the DeepSeek-R1 teacher with
+the same prompt the student sees in Method_1_ZeroShot. Each unique narrative becomes one record:
+
+    narrative, teacher chain of thought (<think> block), teacher reasoning, teacher ESI level,
+    reference ESI level, reward scores
+
+Records are written as Arrow IPC shards that can be memory-mapped, so fine-tuning can read the corpus
+without loading it into RAM. Narratives are deduplicated by a content hash; the hashes already present
+in the output directory double as the resume state, so a restarted run only does the missing rows.
+
+Example:
+    python Build_Distillation_Dataset.py narratives/ distillation/ --esi-column ESI --concurrency 32
+"""
+
+import os
+import re
+import json
+import time
+import asyncio
+import hashlib
+import argparse
+
+import aiohttp
+import pandas as pd
+import pyarrow as pa
+import pyarrow.ipc as ipc
+
+from Generate_Narratives import iter_row_chunks
+from Judge_Cache import JudgeCache
+from Method_1_ZeroShot import REASONING_PATTERN, build_prompt, parse_esi_response
+from Metrics import METRICS
+from Reward_Functions_Deepseek import ESITriageReward
+
+REWARD_COMPONENTS = ("accuracy", "alignment", "safety", "explainability", "bias")
+
+SCHEMA = pa.schema(
+    [
+        ("narrative_hash", pa.string()),
+        ("row_id", pa.string()),
+        ("narrative", pa.string()),
+        ("teacher_output", pa.string()),
+        ("teacher_cot", pa.string()),
+        ("teacher_reasoning", pa.string()),
+        ("teacher_esi", pa.int8()),
+        ("true_esi", pa.int8()),
+    ]
+    + [(f"reward_{name}", pa.float32()) for name in REWARD_COMPONENTS]
+    + [("reward_total", pa.float32())]
+)
+
+WHITESPACE_PATTERN = re.compile(r"\s+")
+# DeepSeek-R1 puts its chain of thought in <think>...</think> before the final answer
+THINK_OPEN_PATTERN = re.compile(r"^\s*<think>", re.IGNORECASE)
+THINK_CLOSE = "</think>"
+# "ESI Level: N" as an answer header at the start of a line, as opposed to a level mentioned in passing
+ESI_HEADER_PATTERN = re.compile(r"^[ \t]*(?:[-*][ \t]*)?\**[ \t]*ESI\s+Level\s*\**\s*:\s*\**\s*([1-5])\b",
+                                re.IGNORECASE | re.MULTILINE)
+
+METRICS.describe("esi_distill_rows_total", "Narratives seen by the distillation builder, by outcome.")
+METRICS.describe("esi_distill_invalid_labels_total", "Reference ESI labels that were not a level 1-5 and were left unscored.")
+
+
+def narrative_hash(narrative):
+    """Content hash of a narrative, ignoring case and whitespace differences."""
+    normalized = WHITESPACE_PATTERN.sub(" ", str(narrative)).strip().lower()
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+def iter_narrative_chunks(source, chunk_size=500, sheet_name=0):
+    """
+    Stream narrative rows as DataFrame chunks.
+
+    Args:
+        source (str): An .xlsx/.csv file, or a directory of narratives-*.jsonl shards.
+        chunk_size (int): Number of rows per chunk.
+        sheet_name (str or int, optional): Sheet name or index for Excel files.
+
+    Yields:
+        pd.DataFrame: The next chunk of rows.
+    """
+    if not os.path.isdir(source):
+        yield from iter_row_chunks(source, sheet_name, chunk_size)
+        return
+    shard_files = sorted(f for f in os.listdir(source) if f.startswith("narratives-") and f.endswith(".jsonl"))
+    for shard_file in shard_files:
+        with pd.read_json(os.path.join(source, shard_file), lines=True, chunksize=chunk_size, dtype=False) as reader:
+            yield from reader
+
+
+def list_shards(output_dir):
+    return sorted(os.path.join(output_dir, f) for f in os.listdir(output_dir)
+                  if f.startswith("distill-") and f.endswith(".arrow"))
+
+
+def read_shard(path, columns=None):
+    """
+    Memory-map one Arrow shard; only the pages that are actually read are loaded.
+    Columns added to SCHEMA after the shard was written come back as nulls.
+    """
+    table = ipc.open_file(pa.memory_map(path, "r")).read_all()
+    for field in SCHEMA:
+        if field.name not in table.column_names:
+            table = table.append_column(field, pa.nulls(table.num_rows, field.type))
+    return table.select(columns or SCHEMA.names)
+
+
+def load_seen_hashes(output_dir):
+    """Hashes of every narrative already written to output_dir (reads only the hash column)."""
+    seen = set()
+    for path in list_shards(output_dir):
+        seen.update(read_shard(path, ["narrative_hash"]).column("narrative_hash").to_pylist())
+    return seen
+
+
+def write_arrow_shard(output_dir, chunk_index, records):
+    """
+    Atomically write one Arrow IPC shard of distillation records and return its path.
+    """
+    shard_path = os.path.join(output_dir, f"distill-{chunk_index:06d}-{time.time_ns()}.arrow")
+    tmp_path = shard_path + ".tmp"
+    table = pa.Table.from_pylist(records, schema=SCHEMA)
+    with pa.OSFile(tmp_path, "wb") as sink:
+        with ipc.new_file(sink, SCHEMA) as writer:
+            writer.write_table(table)
+    with open(tmp_path, "rb") as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, shard_path)
+    return shard_path
+
+
+def open_distillation_dataset(output_dir, columns=None):
+    """
+    Open every shard in output_dir as one memory-mapped pyarrow Table (zero-copy).
+
+    Args:
+        output_dir (str): Directory written by build_distillation_dataset.
+        columns (list of str, optional): Only these columns.
+
+    Returns:
+        pa.Table: All records; convert slices with .to_pandas() or .to_pylist() as needed.
+    """
+    tables = [read_shard(path, columns) for path in list_shards(output_dir)]
+    if not tables:
+        return SCHEMA.empty_table().select(columns) if columns else SCHEMA.empty_table()
+    return pa.concat_tables(tables)
+
+
+def iter_distillation_batches(output_dir, batch_size=256, columns=None):
+    """
+    Yield record batches of at most batch_size rows for fine-tuning, one shard mapped at a time.
+    """
+    for path in list_shards(output_dir):
+        yield from read_shard(path, columns).to_batches(max_chunksize=batch_size)
+
+
+def parse_teacher_output(text):
+    """
+    Split a teacher reply into its chain of thought and its final answer.
+
+    The chain of thought is the <think> block (empty if there is none). The level is the last
+    "ESI Level:" header in the answer after </think>, so candidate levels weighed while thinking
+    are ignored; the reasoning is that answer's Reasoning section.
+
+    Returns:
+        tuple: (chain of thought, level as int or None, reasoning text).
+    """
+    cot, separator, answer = text.rpartition(THINK_CLOSE)
+    if not separator:
+        # An unclosed <think> block means the reply was cut off before the answer
+        cot, answer = (text, "") if THINK_OPEN_PATTERN.match(text) else ("", text)
+    cot = THINK_OPEN_PATTERN.sub("", cot).strip()
+    headers = list(ESI_HEADER_PATTERN.finditer(answer))
+    if not headers:
+        level, reasoning = parse_esi_response(answer)
+        return cot, level, reasoning
+    reasoning_match = REASONING_PATTERN.search(answer, headers[-1].end())
+    reasoning = reasoning_match.group(1) if reasoning_match else answer[headers[-1].end():]
+    return cot, int(headers[-1].group(1)), reasoning.strip()
+
+
+def _optional_esi(value):
+    """
+    Reference ESI level as an int, or None when it is missing or not a level 1-5.
+    Labels are coerced like Evaluate_Predictions.to_level_codes: "2.0" is level 2, "ESI 2" or 2.5 is None.
+    """
+    if value is None or pd.isna(value) or not str(value).strip():
+        return None
+    level = pd.to_numeric(value, errors="coerce")
+    if pd.isna(level) or level != round(level) or not 1 <= level <= 5:
+        METRICS.inc("esi_distill_invalid_labels_total")
+        return None
+    return int(level)
+
+
+async def distill_narrative(teacher, session, semaphore, narrative, true_esi=None, score_rewards=True,
+                            max_retries=5):
+    """
+    Ask the teacher for one narrative's reasoning and, when a reference level is known, score it.
+
+    Returns:
+        dict: teacher_output, teacher_cot, teacher_reasoning, teacher_esi and the reward_* fields.
+              The rewards score teacher_reasoning, the final-answer reasoning stored in the record.
+    """
+    result = await teacher.post_deepseek_api_async(session, semaphore, build_prompt(narrative), max_retries)
+    # Assuming the API returns the generated text under "text"
+    teacher_output = result.get("text")
+    if not isinstance(teacher_output, str):
+        raise ValueError(f"teacher response has no text: {str(result)[:200]}")
+    teacher_cot, teacher_esi, teacher_reasoning = parse_teacher_output(teacher_output)
+
+    record = {"teacher_output": teacher_output, "teacher_cot": teacher_cot, "teacher_reasoning": teacher_reasoning,
+              "teacher_esi": teacher_esi}
+    record.update({f"reward_{name}": None for name in REWARD_COMPONENTS + ("total",)})
+    if score_rewards and true_esi is not None and teacher_esi is not None:
+        judged = await teacher.llm_judge_scores_async(session, semaphore, true_esi, teacher_esi,
+                                                      teacher_reasoning, max_retries)
+        record["reward_accuracy"] = teacher.reward_accuracy(true_esi, teacher_esi)
+        record.update({f"reward_{name}": value for name, value in judged.items()})
+        record["reward_total"] = teacher.combine_rewards(true_esi, teacher_esi, teacher_reasoning, False, judged)
+    return record
+
+
+async def _distill_rows(teacher, session, semaphore, rows, score_rewards, max_retries):
+    async def one(row):
+        try:
+            record = await distill_narrative(teacher, session, semaphore, row["narrative"], row["true_esi"],
+                                             score_rewards, max_retries)
+        except Exception as e:
+            return row, None, f"{type(e).__name__}: {e}"
+        record.update(row)
+        return row, record, None
+
+    return await asyncio.gather(*[one(row) for row in rows])
+
+
+async def build_distillation_dataset_async(source, output_dir, text_column="Narrative", esi_column=None,
+                                           id_column=None, sheet_name=0, chunk_size=500, teacher=None,
+                                           concurrency=16, max_retries=5, timeout=300.0, score_rewards=True):
+    """Async implementation of build_distillation_dataset."""
+    teacher = teacher or ESITriageReward()
+    os.makedirs(output_dir, exist_ok=True)
+    failures_path = os.path.join(output_dir, "failures.jsonl")
+    seen = load_seen_hashes(output_dir)
+    if seen:
+        print(f"Resuming: {len(seen)} narratives already distilled")
+
+    written = 0
+    semaphore = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        for chunk_index, chunk in enumerate(iter_narrative_chunks(source, chunk_size, sheet_name)):
+            if id_column:
+                row_ids = chunk[id_column].astype(str)
+            elif "row_id" in chunk:
+                row_ids = chunk["row_id"].astype(str)
+            else:
+                row_ids = chunk.index.astype(str)
+
+            rows = []
+            duplicates = 0
+            for row_id, (_, row) in zip(row_ids, chunk.iterrows()):
+                narrative = row[text_column]
+                if narrative is None or pd.isna(narrative) or not str(narrative).strip():
+                    continue
+                digest = narrative_hash(narrative)
+                if digest in seen:
+                    duplicates += 1
+                    continue
+                seen.add(digest)
+                rows.append({"narrative_hash": digest, "row_id": row_id, "narrative": str(narrative),
+                             "true_esi": _optional_esi(row[esi_column]) if esi_column else None})
+            METRICS.inc("esi_distill_rows_total", duplicates, outcome="duplicate")
+            if not rows:
+                continue
+
+            results = await _distill_rows(teacher, session, semaphore, rows, score_rewards, max_retries)
+            records = [record for _, record, _ in results if record is not None]
+            failures = [(row, error) for row, _, error in results if error is not None]
+            if failures:
+                # Forget failed hashes so a duplicate later in the run (or the next run) retries them
+                seen.difference_update(row["narrative_hash"] for row, _ in failures)
+                with open(failures_path, "a", encoding="utf-8") as f:
+                    for row, error in failures:
+                        f.write(json.dumps({"row_id": row["row_id"], "narrative_hash": row["narrative_hash"],
+                                            "error": error, "failed_at": time.time()}) + "\n")
+            METRICS.inc("esi_distill_rows_total", len(failures), outcome="failed")
+            if not records:
+                continue
+
+            write_arrow_shard(output_dir, chunk_index, records)
+            METRICS.inc("esi_distill_rows_total", len(records), outcome="written")
+            written += len(records)
+            print(f"Chunk {chunk_index}: wrote {len(records)} records, {duplicates} duplicates, "
+                  f"{len(failures)} failed ({written} this run)")
+    return written
+
+
+def build_distillation_dataset(source, output_dir, text_column="Narrative", esi_column=None, id_column=None,
+                               sheet_name=0, chunk_size=500, teacher=None, concurrency=16, max_retries=5,
+                               timeout=300.0, score_rewards=True):
+    """
+    Distill teacher reasoning for every unique narrative in source into Arrow shards in output_dir.
+
+    Each chunk's teacher calls run concurrently (bounded by concurrency) with the retry/backoff of
+    the DeepSeek-R1 reward client; the chunk is written as one shard once all its calls are done.
+    Failed narratives are logged to failures.jsonl and retried by the next run.
+
+    Args:
+        source (str): An .xlsx/.csv file or a directory of narrative JSONL shards.
+        output_dir (str): Directory for the Arrow shards and failures.jsonl.
+        text_column (str): Column holding the triage narrative.
+        esi_column (str, optional): Column holding the reference ESI level; needed for reward scores.
+        id_column (str, optional): Column holding a stable row ID. Defaults to "row_id" or the row position.
+        sheet_name (str or int, optional): Sheet name or index for Excel files.
+        chunk_size (int): Narratives per chunk (and at most per shard).
+        teacher (ESITriageReward, optional): DeepSeek-R1 client used as teacher and judge.
+        concurrency (int): Maximum number of in-flight API requests.
+        max_retries (int): Retries per request on 429/5xx responses and connection errors.
+        timeout (float): Total timeout in seconds for a single request.
+        score_rewards (bool): Score the teacher's reasoning with the reward function.
+
+    Returns:
+        int: The number of records written in this run.
+    """
+    return asyncio.run(build_distillation_dataset_async(
+        source, output_dir, text_column, esi_column, id_column, sheet_name, chunk_size, teacher,
+        concurrency, max_retries, timeout, score_rewards))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a teacher-reasoning distillation dataset.")
+    parser.add_argument("source", help="Patient narratives (.xlsx/.csv) or a directory of narrative JSONL shards.")
+    parser.add_argument("output_dir")
+    parser.add_argument("--text-column", default="Narrative")
+    parser.add_argument("--esi-column", default=None, help="Reference ESI level column (enables reward scores).")
+    parser.add_argument("--id-column", default=None)
+    parser.add_argument("--chunk-size", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--no-rewards", action="store_true", help="Skip reward scoring of the teacher output.")
+    parser.add_argument("--cache", default=None, help="Judge cache path (e.g., judge_cache.sqlite).")
+    args = parser.parse_args()
+
+    teacher = ESITriageReward(cache=JudgeCache(args.cache) if args.cache else None)
+    count = build_distillation_dataset(args.source, args.output_dir, args.text_column, args.esi_column,
+                                       args.id_column, chunk_size=args.chunk_size, teacher=teacher,
+                                       concurrency=args.concurrency, score_rewards=not args.no_rewards)
+    print(f"Wrote {count} records; dataset now has {open_distillation_dataset(args.output_dir).num_rows} rows")
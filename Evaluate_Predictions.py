@@ -0,0 +1,286 @@
+"""
+Evaluation of ESI predictions (LLMs, nurse triage) against a reference standard.
+
+Labels and predictions are loaded as columnar NumPy arrays and reduced to confusion-matrix counts;
+every metric is computed from those counts:
+
+    accuracy, within-one accuracy, under-triage rate (predicted less urgent than the reference),
+    over-triage rate, missing-prediction rate and mean reward_accuracy (ESITriageReward)
+
+Bootstrap confidence intervals resample visits with replacement. Because every metric depends on the
+data only through the joint (reference, model 1, ..., model k) cell counts, resampling N visits is the
+same as drawing those counts from a multinomial(N, observed cell frequencies). Only the joint cells that
+actually occur are drawn: there are at most min(N, 5 * 6^k) of them, so a resample never costs more
+than resampling the N rows, while the full joint table (8.4M cells for 8 models) would grow 6x with
+every added model. Resampling the joint cells keeps the pairing between models, so the intervals for
+differences against a baseline (e.g., nurse triage) are paired. Resamples are split across a process pool.
+
+Example:
+    python Evaluate_Predictions.py visits.csv --reference Reference_ESI \\
+        --predictions Nurse_ESI ZeroShot_ESI Distilled_ESI --baseline Nurse_ESI --resamples 10000
+"""
+
+import os
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from Reward_Functions_Base import ESITriageRewardBase
+
+LEVELS = 5
+# Prediction states: 0 = missing/unparsable, 1-5 = ESI level
+STATES = LEVELS + 1
+METRIC_NAMES = ("accuracy", "within_one_accuracy", "under_triage_rate", "over_triage_rate",
+                "missing_rate", "mean_reward_accuracy")
+# Masks over (reference level, predicted level) cells
+_LEVEL_GAP = np.abs(np.subtract.outer(np.arange(LEVELS), np.arange(LEVELS)))
+WITHIN_ONE_MASK = (_LEVEL_GAP <= 1).astype(np.float64)
+UNDER_TRIAGE_MASK = np.triu(np.ones((LEVELS, LEVELS)), k=1)  # predicted level number > reference (less urgent)
+OVER_TRIAGE_MASK = np.tril(np.ones((LEVELS, LEVELS)), k=-1)
+# Upper bound on multinomial draws held in memory at once (resamples x observed joint cells)
+MAX_DRAWS_IN_MEMORY = 20_000_000
+
+
+def load_columns(path: str, columns: List[str], sheet_name=0) -> Dict[str, np.ndarray]:
+    """
+    Load only the given columns from a .csv, .xlsx, .parquet or Arrow IPC (.arrow) file.
+
+    Returns:
+        dict: Column name -> NumPy array.
+    """
+    lower = path.lower()
+    if lower.endswith(".parquet"):
+        frame = pd.read_parquet(path, columns=columns)
+    elif lower.endswith((".arrow", ".feather")):
+        import pyarrow as pa
+        import pyarrow.ipc as ipc
+        frame = ipc.open_file(pa.memory_map(path, "r")).read_all().select(columns).to_pandas()
+    elif lower.endswith((".xlsx", ".xls")):
+        frame = pd.read_excel(path, sheet_name=sheet_name, usecols=columns)
+    else:
+        frame = pd.read_csv(path, usecols=columns)
+    return {name: frame[name].to_numpy() for name in columns}
+
+
+def to_level_codes(values) -> np.ndarray:
+    """Map values to ESI levels 1-5 as int8; anything missing, non-integer or out of range becomes 0."""
+    numeric = pd.to_numeric(pd.Series(values), errors="coerce").to_numpy(dtype=float)
+    valid = np.isfinite(numeric) & (numeric == np.round(numeric)) & (numeric >= 1) & (numeric <= LEVELS)
+    return np.where(valid, numeric, 0).astype(np.int8)
+
+
+def reward_accuracy_matrix() -> np.ndarray:
+    """reward_accuracy for every (true level, predicted level) pair, as a 5x5 array."""
+    true_grid, predicted_grid = np.meshgrid(np.arange(1, LEVELS + 1), np.arange(1, LEVELS + 1), indexing="ij")
+    accuracy = ESITriageRewardBase.accuracy_rewards(true_grid.ravel(), predicted_grid.ravel())
+    return accuracy.reshape(LEVELS, LEVELS)
+
+
+def confusion_matrix(reference: np.ndarray, predicted: np.ndarray) -> np.ndarray:
+    """
+    Counts of (reference level, prediction state) pairs as a 5x6 array.
+    Column 0 counts missing predictions; columns 1-5 are predicted levels 1-5.
+    """
+    codes = (reference.astype(np.int64) - 1) * STATES + predicted
+    return np.bincount(codes, minlength=LEVELS * STATES).reshape(LEVELS, STATES)
+
+
+def metrics_from_confusion(confusion: np.ndarray, reward_matrix: np.ndarray) -> Dict[str, np.ndarray]:
+    """
+    Compute every metric from confusion counts of shape (..., 5, 6); leading axes are batch axes.
+
+    Missing predictions count against accuracy but are neither under- nor over-triage;
+    mean_reward_accuracy is averaged over visits with a prediction.
+    """
+    confusion = np.asarray(confusion, dtype=np.float64)
+    total = confusion.sum(axis=(-2, -1))
+    scored = confusion[..., 1:]  # (..., 5, 5): reference level x predicted level
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return {
+            "accuracy": np.trace(scored, axis1=-2, axis2=-1) / total,
+            "within_one_accuracy": (scored * WITHIN_ONE_MASK).sum(axis=(-2, -1)) / total,
+            "under_triage_rate": (scored * UNDER_TRIAGE_MASK).sum(axis=(-2, -1)) / total,
+            "over_triage_rate": (scored * OVER_TRIAGE_MASK).sum(axis=(-2, -1)) / total,
+            "missing_rate": confusion[..., 0].sum(axis=-1) / total,
+            "mean_reward_accuracy": (scored * reward_matrix).sum(axis=(-2, -1)) / scored.sum(axis=(-2, -1)),
+        }
+
+
+def joint_counts(reference: np.ndarray, predictions: List[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Joint (reference, prediction 1, ..., prediction k) cells that occur in the data, with their counts.
+
+    Returns:
+        tuple: (cells, counts). cells is a (cells, k + 1) int8 array of the reference level (1-5) and
+               each model's prediction state (0-5); counts holds the visits in each cell.
+    """
+    stacked = np.column_stack([reference] + list(predictions)).astype(np.int8)
+    return np.unique(stacked, axis=0, return_counts=True)
+
+
+def _marginal_confusions(counts: np.ndarray, cells: np.ndarray) -> List[np.ndarray]:
+    """Per-model (..., 5, 6) confusion counts from (..., cells) joint cell counts."""
+    batch_shape = counts.shape[:-1]
+    confusions = []
+    for j in range(1, cells.shape[1]):
+        index = (cells[:, 0].astype(np.int64) - 1) * STATES + cells[:, j]
+        order = np.argsort(index, kind="stable")
+        sorted_index = index[order]
+        starts = np.flatnonzero(np.r_[True, sorted_index[1:] != sorted_index[:-1]])
+        confusion = np.zeros(batch_shape + (LEVELS * STATES,), dtype=counts.dtype)
+        confusion[..., sorted_index[starts]] = np.add.reduceat(counts[..., order], starts, axis=-1)
+        confusions.append(confusion.reshape(batch_shape + (LEVELS, STATES)))
+    return confusions
+
+
+def _bootstrap_chunk(cells: np.ndarray, counts: np.ndarray, reward_matrix: np.ndarray, resamples: int,
+                     seed) -> List[Dict[str, np.ndarray]]:
+    """Worker: `resamples` multinomial bootstrap draws; returns per-model metric arrays."""
+    rng = np.random.default_rng(seed)
+    total = int(counts.sum())
+    probabilities = counts / total
+    step = max(1, MAX_DRAWS_IN_MEMORY // counts.size)
+    n_models = cells.shape[1] - 1
+    parts = [{name: [] for name in METRIC_NAMES} for _ in range(n_models)]
+    for start in range(0, resamples, step):
+        draws = rng.multinomial(total, probabilities, size=min(step, resamples - start))
+        for j, confusion in enumerate(_marginal_confusions(draws, cells)):
+            for name, values in metrics_from_confusion(confusion, reward_matrix).items():
+                parts[j][name].append(values)
+    return [{name: np.concatenate(values) for name, values in model.items()} for model in parts]
+
+
+def bootstrap_metrics(cells: np.ndarray, counts: np.ndarray, reward_matrix: np.ndarray, resamples: int = 10000,
+                      workers: Optional[int] = None, seed: int = 0) -> List[Dict[str, np.ndarray]]:
+    """
+    Bootstrap distribution of every metric for every model, from joint cells and their counts.
+
+    Resamples are split evenly across a process pool (workers=1 runs in-process).
+    Each worker gets an independent random stream derived from seed.
+
+    Returns:
+        list of dict: Per model, metric name -> array of `resamples` bootstrap values.
+    """
+    workers = workers or os.cpu_count() or 1
+    workers = max(1, min(workers, resamples))
+    sizes = [resamples // workers + (1 if i < resamples % workers else 0) for i in range(workers)]
+    seeds = np.random.SeedSequence(seed).spawn(workers)
+    if workers == 1:
+        results = [_bootstrap_chunk(cells, counts, reward_matrix, sizes[0], seeds[0])]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_bootstrap_chunk, [cells] * workers, [counts] * workers,
+                                    [reward_matrix] * workers, sizes, seeds))
+    return [{name: np.concatenate([result[j][name] for result in results]) for name in METRIC_NAMES}
+            for j in range(cells.shape[1] - 1)]
+
+
+def _interval(point, samples, confidence):
+    alpha = (1.0 - confidence) / 2.0
+    low, high = np.nanquantile(samples, [alpha, 1.0 - alpha])
+    return {"value": float(point), "ci_low": float(low), "ci_high": float(high)}
+
+
+def evaluate(reference, predictions: Dict[str, np.ndarray], baseline: Optional[str] = None,
+             resamples: int = 10000, confidence: float = 0.95, workers: Optional[int] = None,
+             seed: int = 0) -> dict:
+    """
+    Evaluate one or more prediction columns against the reference levels.
+
+    Visits without a valid reference level are dropped. Invalid predictions count as missing.
+
+    Args:
+        reference (array-like): Reference-standard ESI levels.
+        predictions (dict): Model name -> array-like of predicted ESI levels (same order as reference).
+        baseline (str, optional): Model to compare the others against (paired differences).
+        resamples (int): Bootstrap resamples (0 disables the intervals).
+        confidence (float): Confidence level of the intervals.
+        workers (int, optional): Processes for the bootstrap (default: all CPUs).
+        seed (int): Random seed for the bootstrap.
+
+    Returns:
+        dict: {"n", "dropped", "confusion_matrices", "metrics": {model: {metric: {value, ci_low, ci_high}}},
+               "differences": {model: {metric: ...}} (model minus baseline, when a baseline is given)}
+    """
+    names = list(predictions)
+    if baseline is not None and baseline not in predictions:
+        raise ValueError(f"Baseline {baseline!r} is not one of the predictions: {names}")
+    reference = to_level_codes(reference)
+    keep = reference > 0
+    reference = reference[keep]
+    coded = [to_level_codes(predictions[name])[keep] for name in names]
+
+    reward_matrix = reward_accuracy_matrix()
+    cells, counts = joint_counts(reference, coded)
+    confusions = _marginal_confusions(counts, cells)
+    points = [metrics_from_confusion(confusion, reward_matrix) for confusion in confusions]
+    samples = bootstrap_metrics(cells, counts, reward_matrix, resamples, workers, seed) if resamples else None
+
+    def summarize(point, sample):
+        if sample is None:
+            return {"value": float(point), "ci_low": None, "ci_high": None}
+        return _interval(point, sample, confidence)
+
+    result = {
+        "n": int(keep.sum()),
+        "dropped": int((~keep).sum()),
+        "confusion_matrices": {name: confusion.tolist() for name, confusion in zip(names, confusions)},
+        "metrics": {
+            name: {metric: summarize(points[j][metric], samples[j][metric] if samples else None)
+                   for metric in METRIC_NAMES}
+            for j, name in enumerate(names)
+        },
+    }
+    if baseline is not None:
+        b = names.index(baseline)
+        result["differences"] = {
+            name: {metric: summarize(points[j][metric] - points[b][metric],
+                                     samples[j][metric] - samples[b][metric] if samples else None)
+                   for metric in METRIC_NAMES}
+            for j, name in enumerate(names) if j != b
+        }
+    return result
+
+
+def format_report(result: dict) -> str:
+    lines = [f"Visits: {result['n']} ({result['dropped']} without a valid reference level dropped)"]
+
+    def row(label, values):
+        cells = []
+        for metric in METRIC_NAMES:
+            v = values[metric]
+            ci = f" [{v['ci_low']:.3f}, {v['ci_high']:.3f}]" if v["ci_low"] is not None else ""
+            cells.append(f"{metric}={v['value']:.3f}{ci}")
+        return f"{label}: " + ", ".join(cells)
+
+    for name, values in result["metrics"].items():
+        lines.append(row(name, values))
+    for name, values in result.get("differences", {}).items():
+        lines.append(row(f"{name} - baseline", values))
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate ESI predictions against a reference standard.")
+    parser.add_argument("path", help="Visits file (.csv, .xlsx, .parquet or .arrow).")
+    parser.add_argument("--reference", required=True, help="Reference-standard ESI column.")
+    parser.add_argument("--predictions", nargs="+", required=True, help="Predicted ESI columns to evaluate.")
+    parser.add_argument("--baseline", default=None, help="Prediction column to compare the others against.")
+    parser.add_argument("--resamples", type=int, default=10000)
+    parser.add_argument("--confidence", type=float, default=0.95)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="Write the full result as JSON to this path.")
+    args = parser.parse_args()
+
+    columns = load_columns(args.path, [args.reference] + args.predictions)
+    result = evaluate(columns[args.reference], {name: columns[name] for name in args.predictions},
+                      args.baseline, args.resamples, args.confidence, args.workers, args.seed)
+    print(format_report(result))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
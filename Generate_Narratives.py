@@ -1,50 +1,101 @@
 #pip install pandas openpyxl
 
+import os
+import json
+import time
+import random
+import hashlib
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import openai
+from concurrent.futures import ThreadPoolExecutor
+from openpyxl import load_workbook
+from Rate_Limiter import TokenBucket
+from Metrics import METRICS, backend_call, record_usage
 
 # Set OpenAI API key
 openai.api_key = "your_openai_api_key"
+# Optionally point the client at another completion endpoint (e.g., a local fake server)
+if os.getenv("OPENAI_API_BASE"):
+    openai.api_base = os.getenv("OPENAI_API_BASE")
+
+# Upper bound on the length of a generated narrative
+NARRATIVE_MAX_TOKENS = 256
+
+# Errors worth retrying: throttling, transient server errors and connection problems
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.APIError,
+    openai.error.Timeout,
+    openai.error.ServiceUnavailableError,
+    openai.error.APIConnectionError,
+)
+
+# Patient columns read by build_narrative_prompt; everything else in the spreadsheet is left out of the ingest cache
+NARRATIVE_COLUMNS = ("Patient_Age", "Patient_Sex", "PatientChiefComplaint", "Mode of Arrival", "Arrival Time",
+                     "Vital_Signs")
+# Low-cardinality columns, stored dictionary-encoded and loaded as pandas categoricals
+CATEGORICAL_COLUMNS = ("Patient_Sex", "Mode of Arrival")
+# Ages that are not a plain integer year (e.g. "6 months") keep their original text in this cache column
+AGE_TEXT_COLUMN = "Patient_Age_text"
+INGEST_CACHE_DIR = ".ingest_cache"
+INGEST_CACHE_VERSION = 2
 
 #Function to convert excel file into dataframe
-def load_excel_to_dataframe(file_path, sheet_name=0):
+def load_excel_to_dataframe(file_path, sheet_name=0, cache_dir=None, extra_columns=()):
     """
     Load data from an Excel file and convert it into a pandas DataFrame.
 
     Args:
         file_path (str): The path to the Excel file.
         sheet_name (str or int, optional): Sheet name or index to load. Default is the first sheet.
+        cache_dir (str, optional): Directory of the typed Parquet ingest cache. When set, the workbook is
+                                   parsed only once and only the NARRATIVE_COLUMNS plus extra_columns are loaded.
+        extra_columns (iterable of str): Columns to keep besides NARRATIVE_COLUMNS when using the cache
+                                         (e.g. visit IDs or reference ESI levels), loaded as text.
 
     Returns:
         pd.DataFrame: The loaded data as a DataFrame.
     """
     try:
-        dataframe = pd.read_excel(file_path, sheet_name=sheet_name)
+        if cache_dir:
+            cache_path = ingest_to_parquet(file_path, cache_dir, sheet_name, extra_columns=extra_columns)
+            dataframe = read_ingest_cache(cache_path)
+        else:
+            dataframe = pd.read_excel(file_path, sheet_name=sheet_name)
         print(f"Data successfully loaded from {file_path}")
         return dataframe
     except Exception as e:
         print(f"Error loading Excel file: {e}")
         return None
 
-def generate_patient_narrative(row):
+def _field(row, column, default):
+    """Value of one patient field, or the default when the column is absent or the cell is empty."""
+    value = row.get(column)
+    if value is None or (pd.api.types.is_scalar(value) and pd.isna(value)):
+        return default
+    return value
+
+def build_narrative_prompt(row):
     """
-    Generate a short narrative for a patient using OpenAI's API.
+    Build the narrative generation prompt for one patient row.
 
     Args:
         row (pd.Series): A row of patient data from the DataFrame.
 
     Returns:
-        str: The generated narrative.
+        str: The prompt sent to the completion API.
     """
     #These are just example variable names. The actual variable names will come from the dataset.
-    age = row.get("Patient_Age", "unknown age")
-    sex = row.get("Patient_Sex", "unknown sex")
-    complaint = row.get("PatientChiefComplaint", "no chief complaint listed")
-    mode_of_arrival = row.get("Mode of Arrival", "unknown mode of arrival")
-    arrival_time = row.get("Arrival Time", "unknown time")
-    vital_signs = row.get("Vital_Signs", "no vital signs available")
-
-    prompt = (
+    age = _field(row, "Patient_Age", "unknown age")
+    sex = _field(row, "Patient_Sex", "unknown sex")
+    complaint = _field(row, "PatientChiefComplaint", "no chief complaint listed")
+    mode_of_arrival = _field(row, "Mode of Arrival", "unknown mode of arrival")
+    arrival_time = _field(row, "Arrival Time", "unknown time")
+    vital_signs = _field(row, "Vital_Signs", "no vital signs available")
+
+    return (
         f"Create a short narrative for a patient presenting to the ED based on the following details:\n"
         f"Age: {age}\n"
         f"Sex: {sex}\n"
@@ -55,29 +106,427 @@ def generate_patient_narrative(row):
         f"The narrative should be concise and formatted like a case summary."
     )
 
-    try:
+def request_narrative(prompt, max_tokens=NARRATIVE_MAX_TOKENS):
+    """
+    Call the completion API once. Errors are raised to the caller.
+
+    Returns:
+        tuple: (narrative text, total tokens used or None if the API did not report usage).
+    """
+    with backend_call("openai_completion"):
         response = openai.Completion.create(
             engine="gpt-4o",
             prompt=prompt,
+            max_tokens=max_tokens,
             temperature=0.7 #Can be adjusted
         )
-        return response.choices[0].text.strip()
+    usage = response.get("usage") if hasattr(response, "get") else None
+    record_usage("openai_completion", usage)
+    total_tokens = usage.get("total_tokens") if usage else None
+    return response.choices[0].text.strip(), total_tokens
+
+def generate_patient_narrative(row):
+    """
+    Generate a short narrative for a patient using OpenAI's API.
+
+    Args:
+        row (pd.Series): A row of patient data from the DataFrame.
+
+    Returns:
+        str or None: The generated narrative, or None if generation failed.
+    """
+    try:
+        narrative, _ = request_narrative(build_narrative_prompt(row))
+        return narrative
     except Exception as e:
         print(f"Error generating narrative: {e}")
-        return "Error generating narrative."
+        return None
+
+class NarrativeScheduler:
+    """
+    Worker pool that generates narratives concurrently within the API quota.
+
+    Every request takes one unit from a requests-per-minute bucket and an estimate of its
+    tokens (prompt characters / 4 + max_tokens) from a tokens-per-minute bucket; the estimate
+    is corrected once the API reports actual usage. Retryable errors back off exponentially
+    with jitter. Rows that still fail are reported separately so they can be re-queued.
+    """
+
+    def __init__(self, max_workers=8, requests_per_minute=500, tokens_per_minute=150000,
+                 max_retries=5, backoff_base=1.0, backoff_max=60.0, max_tokens=NARRATIVE_MAX_TOKENS):
+        self.max_workers = max_workers
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_tokens = max_tokens
+
+    def _generate(self, row):
+        prompt = build_narrative_prompt(row)
+        estimated_tokens = len(prompt) // 4 + self.max_tokens
+        for attempt in range(self.max_retries + 1):
+            self.request_bucket.acquire(1)
+            self.token_bucket.acquire(estimated_tokens)
+            try:
+                narrative, total_tokens = request_narrative(prompt, self.max_tokens)
+            except RETRYABLE_ERRORS:
+                if attempt == self.max_retries:
+                    raise
+                METRICS.inc("esi_backend_retries_total", backend="openai_completion")
+                time.sleep(random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt))))
+                continue
+            if total_tokens is not None:
+                self.token_bucket.adjust(total_tokens - estimated_tokens)
+            return narrative
+
+    def run(self, rows):
+        """
+        Generate narratives for (row_id, row) pairs.
+
+        Args:
+            rows (iterable): (row_id, pd.Series) pairs, e.g. DataFrame.iterrows().
+
+        Returns:
+            tuple: (narratives, failures) dicts keyed by row_id. failures maps each failed
+                   row_id to its error message; failed rows never appear in narratives.
+        """
+        rows = list(rows)
+        narratives, failures = {}, {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [(row_id, executor.submit(self._generate, row)) for row_id, row in rows]
+            for row_id, future in futures:
+                try:
+                    narratives[row_id] = future.result()
+                except Exception as e:
+                    failures[row_id] = f"{type(e).__name__}: {e}"
+                    METRICS.inc("esi_narrative_row_failures_total")
+        if failures:
+            print(f"{len(failures)} of {len(rows)} narratives failed")
+        return narratives, failures
+
+def iter_row_chunks(file_path, sheet_name=0, chunk_size=500, cache_dir=None, extra_columns=()):
+    """
+    Stream a patient spreadsheet as DataFrame chunks without loading the whole file.
+
+    Excel workbooks are read with openpyxl in read-only mode; CSV files use pandas' chunked reader.
+    Each chunk keeps the row's position in the file as its index.
+
+    Args:
+        file_path (str): Path to an .xlsx or .csv file.
+        sheet_name (str or int, optional): Sheet name or index for Excel files. Default is the first sheet.
+        chunk_size (int): Number of rows per chunk.
+        cache_dir (str, optional): Directory of the typed Parquet ingest cache. When set, chunks are read
+                                   from the cache (built on first use) and hold only the NARRATIVE_COLUMNS
+                                   plus extra_columns.
+        extra_columns (iterable of str): Additional columns to keep in the cache, e.g. a row ID or reference
+                                         ESI column (loaded as text).
+
+    Yields:
+        pd.DataFrame: The next chunk of rows.
+    """
+    if cache_dir:
+        cache_path = ingest_to_parquet(file_path, cache_dir, sheet_name, extra_columns=extra_columns)
+        start = 0
+        for batch in pq.ParquetFile(cache_path, read_dictionary=list(CATEGORICAL_COLUMNS)).iter_batches(chunk_size):
+            chunk = _cache_to_pandas(batch)
+            chunk.index = range(start, start + len(chunk))
+            start += len(chunk)
+            yield chunk
+        return
+
+    if file_path.lower().endswith(".csv"):
+        yield from pd.read_csv(file_path, chunksize=chunk_size)
+        return
+
+    workbook = load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        sheet = workbook.worksheets[sheet_name] if isinstance(sheet_name, int) else workbook[sheet_name]
+        rows = sheet.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        start = 0
+        buffer = []
+        for values in rows:
+            buffer.append(values)
+            if len(buffer) == chunk_size:
+                yield pd.DataFrame(buffer, columns=header, index=range(start, start + len(buffer)))
+                start += len(buffer)
+                buffer = []
+        if buffer:
+            yield pd.DataFrame(buffer, columns=header, index=range(start, start + len(buffer)))
+    finally:
+        workbook.close()
+
+def source_file_hash(file_path, block_size=1 << 20):
+    """
+    SHA-256 of a file's contents, read in blocks.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _plain_age(value):
+    """The age as an int if it is a plain integer number of years (0-150), otherwise None."""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, str):
+        if not value.isdigit() or str(int(value)) != value:
+            return None
+        value = int(value)
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    if number != number or not number.is_integer() or not 0 <= number <= 150:
+        return None
+    return int(number)
+
+def _text(value, integral_floats=False):
+    """A cell as text (None if empty); integral_floats renders 2.0 as "2" for ID and label columns."""
+    if value is None or (pd.api.types.is_scalar(value) and pd.isna(value)):
+        return None
+    if integral_floats and isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value)
+
+def _typed_chunk(chunk, columns):
+    """
+    Project a raw spreadsheet chunk onto the cached columns and cast them to compact types:
+    Int16 ages, dictionary-encoded strings for low-cardinality fields and strings for everything else.
+    Ages that are not plain integer years go to AGE_TEXT_COLUMN verbatim so prompts do not change.
+    """
+    arrays = {}
+    for column in columns:
+        values = chunk[column] if column in chunk.columns else pd.Series(None, index=chunk.index, dtype="object")
+        if column == "Patient_Age":
+            ages = [_plain_age(v) for v in values]
+            arrays[column] = pa.array(ages, type=pa.int16())
+            arrays[AGE_TEXT_COLUMN] = pa.array(
+                [_text(v) if age is None else None for v, age in zip(values, ages)], type=pa.string())
+        else:
+            arrays[column] = pa.array([_text(v, integral_floats=column not in NARRATIVE_COLUMNS) for v in values],
+                                      type=pa.string())
+    return pa.table(arrays)
+
+def _cache_to_pandas(table):
+    """
+    Convert a cached table or record batch to pandas with nullable Int16 ages and categorical codes.
+    If any age was kept as text, the age column holds the original values (object dtype) instead.
+    """
+    frame = table.to_pandas(types_mapper={pa.int16(): pd.Int16Dtype()}.get)
+    if AGE_TEXT_COLUMN in frame.columns:
+        text_ages = frame.pop(AGE_TEXT_COLUMN)
+        if "Patient_Age" in frame.columns and text_ages.notna().any():
+            frame["Patient_Age"] = frame["Patient_Age"].astype(object).where(text_ages.isna(), text_ages)
+    return frame
+
+def ingest_to_parquet(file_path, cache_dir=INGEST_CACHE_DIR, sheet_name=0, chunk_size=5000, extra_columns=()):
+    """
+    Convert a patient spreadsheet into a typed, column-projected Parquet file once and reuse it afterwards.
+
+    The cache file is keyed by the SHA-256 of the spreadsheet, the sheet and the projected columns, so an
+    edited spreadsheet gets a fresh cache and an unchanged one is never parsed again. The workbook is
+    streamed with iter_row_chunks and written row group by row group, so memory stays bounded by chunk_size.
+
+    Args:
+        file_path (str): Path to an .xlsx or .csv file.
+        cache_dir (str): Directory holding the cache files.
+        sheet_name (str or int, optional): Sheet name or index for Excel files.
+        chunk_size (int): Rows converted per Parquet row group.
+        extra_columns (iterable of str): Columns kept in addition to NARRATIVE_COLUMNS.
+
+    Returns:
+        str: Path of the cache file.
+    """
+    columns = list(dict.fromkeys(list(NARRATIVE_COLUMNS) + list(extra_columns)))
+    key = hashlib.sha256(json.dumps(
+        [INGEST_CACHE_VERSION, source_file_hash(file_path), sheet_name, columns]).encode("utf-8")).hexdigest()
+    cache_path = os.path.join(cache_dir, f"{key}.parquet")
+    if os.path.exists(cache_path):
+        return cache_path
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    writer = None
+    rows = 0
+    try:
+        for chunk in iter_row_chunks(file_path, sheet_name, chunk_size):
+            table = _typed_chunk(chunk, columns)
+            if writer is None:
+                writer = pq.ParquetWriter(tmp_path, table.schema, compression="zstd",
+                                          use_dictionary=list(CATEGORICAL_COLUMNS))
+            writer.write_table(table)
+            rows += table.num_rows
+        if writer is None:
+            writer = pq.ParquetWriter(tmp_path, _typed_chunk(pd.DataFrame(), columns).schema)
+        writer.close()
+        writer = None
+        os.replace(tmp_path, cache_path)
+    finally:
+        if writer is not None:
+            writer.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    print(f"Ingest cache written for {file_path}: {rows} rows -> {cache_path}")
+    return cache_path
+
+def read_ingest_cache(cache_path, columns=None):
+    """
+    Load an ingest cache file as a DataFrame (categorical sex and arrival mode, Int16 age).
+    """
+    table = pq.read_table(cache_path, columns=columns, read_dictionary=list(CATEGORICAL_COLUMNS))
+    return _cache_to_pandas(table)
+
+def load_checkpoint(checkpoint_path):
+    """
+    Load the set of completed row IDs from a checkpoint file (one ID per line).
+    """
+    if not os.path.exists(checkpoint_path):
+        return set()
+    with open(checkpoint_path, "r", encoding="utf-8") as f:
+        return {line.rstrip("\n") for line in f if line.strip()}
+
+def write_shard(output_dir, chunk_index, records):
+    """
+    Atomically write one JSONL shard of narrative records and return its path.
+    """
+    shard_name = f"narratives-{chunk_index:06d}-{time.time_ns()}.jsonl"
+    shard_path = os.path.join(output_dir, shard_name)
+    tmp_path = shard_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, default=str) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, shard_path)
+    return shard_path
+
+def generate_narratives_streaming(file_path, output_dir, sheet_name=0, chunk_size=500, id_column=None,
+                                  scheduler=None, cache_dir=None, extra_columns=()):
+    """
+    Generate narratives chunk by chunk, writing each chunk to a JSONL shard as soon as it is done.
+
+    Completed row IDs are appended to a checkpoint file after their shard is written, so a
+    restarted run skips rows that are already finished. Memory use is bounded by chunk_size.
+    Rows that fail are logged to failures.jsonl and left out of the checkpoint, so the next
+    run re-queues them.
+
+    Args:
+        file_path (str): Path to the patient spreadsheet (.xlsx or .csv).
+        output_dir (str): Directory for the narrative shards and the checkpoint file.
+        sheet_name (str or int, optional): Sheet name or index for Excel files.
+        chunk_size (int): Number of rows read and written per shard.
+        id_column (str, optional): Column holding a stable row ID. Defaults to the row's position in the file.
+        scheduler (NarrativeScheduler, optional): Scheduler used for API calls. Defaults to NarrativeScheduler().
+        cache_dir (str, optional): Directory of the typed Parquet ingest cache. When set, rows are read from
+                                   the cache (built on first use) instead of re-parsing the spreadsheet, and
+                                   the shards hold only the NARRATIVE_COLUMNS, id_column and extra_columns.
+        extra_columns (iterable of str): Columns to carry into the shards when using the cache, e.g. the
+                                         reference ESI column used by Build_Distillation_Dataset.
+
+    Returns:
+        int: The number of rows processed in this run.
+    """
+    scheduler = scheduler or NarrativeScheduler()
+    os.makedirs(output_dir, exist_ok=True)
+    checkpoint_path = os.path.join(output_dir, "completed_ids.txt")
+    failures_path = os.path.join(output_dir, "failures.jsonl")
+    completed = load_checkpoint(checkpoint_path)
+    if completed:
+        print(f"Resuming: {len(completed)} rows already completed")
+
+    processed = 0
+    with open(checkpoint_path, "a", encoding="utf-8") as checkpoint:
+        chunks = iter_row_chunks(file_path, sheet_name, chunk_size, cache_dir=cache_dir,
+                                 extra_columns=([id_column] if id_column else []) + list(extra_columns))
+        for chunk_index, chunk in enumerate(chunks):
+            row_ids = chunk[id_column].astype(str) if id_column else chunk.index.astype(str)
+            pending = chunk[~row_ids.isin(completed)]
+            if pending.empty:
+                continue
+            pending_ids = row_ids[~row_ids.isin(completed)]
+
+            pending_rows = list(zip(pending_ids, (row for _, row in pending.iterrows())))
+            narratives, failures = scheduler.run(pending_rows)
+            records = []
+            for row_id, row in pending_rows:
+                if row_id not in narratives:
+                    continue
+                record = json.loads(row.to_json(date_format="iso", default_handler=str))
+                record["row_id"] = row_id
+                record["Narrative"] = narratives[row_id]
+                records.append(record)
+
+            if failures:
+                with open(failures_path, "a", encoding="utf-8") as f:
+                    for row_id, error in failures.items():
+                        f.write(json.dumps({"row_id": row_id, "error": error, "failed_at": time.time()}) + "\n")
+            if not records:
+                continue
+
+            write_shard(output_dir, chunk_index, records)
+            checkpoint.writelines(f"{record['row_id']}\n" for record in records)
+            checkpoint.flush()
+            os.fsync(checkpoint.fileno())
+            completed.update(record["row_id"] for record in records)
+            processed += len(records)
+            print(f"Chunk {chunk_index}: wrote {len(records)} narratives, {len(failures)} failed ({processed} this run)")
+    return processed
+
+def read_narrative_shards(output_dir):
+    """
+    Combine all narrative shards in output_dir into a single DataFrame.
+
+    A crash between writing a shard and checkpointing it makes the restarted run regenerate those
+    rows into a second shard; each row_id is kept once, from the most recently written shard.
+    """
+    shard_files = [f for f in os.listdir(output_dir) if f.startswith("narratives-") and f.endswith(".jsonl")]
+    # Shard names are narratives-<chunk>-<time_ns>.jsonl: order by write time so later copies win
+    shard_files.sort(key=lambda f: int(f[:-len(".jsonl")].rsplit("-", 1)[1]))
+    frames = [pd.read_json(os.path.join(output_dir, f), lines=True, dtype={"row_id": str}) for f in shard_files]
+    if not frames:
+        return pd.DataFrame()
+    combined = pd.concat(frames, ignore_index=True)
+    if "row_id" in combined.columns:
+        combined = combined.drop_duplicates("row_id", keep="last").sort_index(ignore_index=True)
+    return combined
 
 if __name__ == "__main__":
     # Specify the file path to the Excel file
     excel_file = "patient_data.xlsx"  # Replace with your Excel file path
     sheet = 0  # Specify the sheet name or index
 
-    # Load the Excel data into a DataFrame
-    df = load_excel_to_dataframe(excel_file, sheet_name=sheet)
+    # Set to True for large datasets: rows are processed in chunks and written to
+    # resumable JSONL shards in stream_output_dir instead of one Excel file at the end.
+    streaming = False
+    stream_output_dir = "narratives_output"
+    # Set to INGEST_CACHE_DIR to convert the workbook once into a typed Parquet file and read that on later
+    # runs. The cache holds only the prompt columns plus cache_extra_columns, so the output then contains
+    # only those columns; list any ID or reference-level columns you need to keep.
+    ingest_cache_dir = None
+    cache_extra_columns = []
+
+    if streaming:
+        generate_narratives_streaming(excel_file, stream_output_dir, sheet_name=sheet, chunk_size=500,
+                                      cache_dir=ingest_cache_dir, extra_columns=cache_extra_columns)
+        df = None
+    else:
+        # Load the Excel data into a DataFrame
+        df = load_excel_to_dataframe(excel_file, sheet_name=sheet, cache_dir=ingest_cache_dir,
+                                     extra_columns=cache_extra_columns)
 
     if df is not None:
         print("Generating narratives for each patient...")
-        # Generate triage narratives for each patient and add them to a new 'Narrative' column
-        df["Narrative"] = df.apply(generate_patient_narrative, axis=1)
+        # Generate triage narratives for each patient and add them to a new 'Narrative' column.
+        # Failed rows are left empty (not filled with error text) and listed for re-queueing.
+        narratives, failures = NarrativeScheduler().run(df.iterrows())
+        df["Narrative"] = pd.Series(narratives, dtype="object")
+        if failures:
+            print(f"Rows to re-queue: {sorted(failures)}")
 
         # Save the updated DataFrame to a new Excel file
         output_file = "patient_data_with_narratives.xlsx"
@@ -0,0 +1,225 @@
+"""
+Resident local inference server for zero-shot ESI prediction.
+
+One process keeps the model loaded and serves many clients. Concurrent requests are collected
+into micro-batches (up to --max-batch-size requests, waiting at most --max-wait-ms for a batch
+to fill) and run through a single batched generate call.
+
+Endpoints:
+    POST /predict   {"triage_text": "..."} -> {"esi_level": 2, "reasoning": "...", "prompt_tokens": ..., "completion_tokens": ...}
+    GET  /health    readiness and batching settings
+    GET  /metrics   Prometheus text metrics
+
+Example:
+    python Inference_Server.py --port 8008 --backend cpu-int8 --threads 4
+    curl -s localhost:8008/predict -d '{"triage_text": "65M crushing chest pain, BP 90/60"}'
+"""
+
+import os
+import json
+import time
+import queue
+import argparse
+import threading
+import socketserver
+import urllib.request
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import Method_1_ZeroShot
+from Metrics import METRICS, SIZE_BUCKETS
+
+METRICS.describe("esi_server_batch_size", "Requests per micro-batch.", buckets=SIZE_BUCKETS)
+METRICS.describe("esi_server_queue_wait_seconds", "Time a request waited before its micro-batch started.")
+METRICS.describe("esi_server_batch_retries_total", "Failed micro-batches retried one request at a time.")
+
+
+class MicroBatcher:
+    """
+    Collects single predictions from many threads into micro-batches run by one worker thread.
+
+    A batch is dispatched when it reaches max_batch_size or when max_wait_ms has passed since
+    its first request arrived, whichever comes first. If a batch fails, its requests are retried
+    one at a time so only the failing request gets the error.
+    """
+
+    def __init__(self, max_batch_size=8, max_wait_ms=10.0, max_new_tokens=Method_1_ZeroShot.DEFAULT_MAX_NEW_TOKENS):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.max_new_tokens = max_new_tokens
+        self.requests = queue.Queue()
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def submit(self, triage_text):
+        """Queue one narrative; returns a Future resolving to its ESIPrediction."""
+        future = Future()
+        self.requests.put((triage_text, future, time.perf_counter()))
+        return future
+
+    def _collect(self):
+        batch = [self.requests.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            started = time.perf_counter()
+            METRICS.observe("esi_server_batch_size", len(batch))
+            for _, _, queued_at in batch:
+                METRICS.observe("esi_server_queue_wait_seconds", started - queued_at)
+            try:
+                outputs = self._generate([text for text, _, _ in batch])
+            except Exception as e:
+                if len(batch) == 1:
+                    batch[0][1].set_exception(e)
+                    continue
+                # Retry one request at a time so a single bad or oversized input only fails its own request
+                METRICS.inc("esi_server_batch_retries_total")
+                for text, future, _ in batch:
+                    try:
+                        future.set_result(self._generate([text])[0])
+                    except Exception as single_error:
+                        future.set_exception(single_error)
+                continue
+            for (_, future, _), output in zip(batch, outputs):
+                future.set_result(output)
+
+    def _generate(self, texts):
+        return Method_1_ZeroShot.generate_esi_predictions_batch(texts, batch_size=len(texts),
+                                                                max_new_tokens=self.max_new_tokens)
+
+
+def make_handler(batcher, request_timeout, tcp=True):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = tcp  # TCP_NODELAY is not supported on Unix sockets
+
+        def _send_json(self, status, payload):
+            self._send(status, json.dumps(payload).encode("utf-8"), "application/json")
+
+        def _send(self, status, data, content_type):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/health":
+                self._send_json(200, {"status": "ok", "model": Method_1_ZeroShot.model_name,
+                                      "max_batch_size": batcher.max_batch_size,
+                                      "max_wait_ms": batcher.max_wait * 1000.0})
+            elif self.path == "/metrics":
+                self._send(200, METRICS.to_prometheus().encode("utf-8"), "text/plain; version=0.0.4")
+            else:
+                self._send_json(404, {"error": "not found"})
+
+        def do_POST(self):
+            if self.path != "/predict":
+                self._send_json(404, {"error": "not found"})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            except (ValueError, TypeError):
+                body = None
+            if not (isinstance(body, dict) and isinstance(body.get("triage_text"), str)):
+                self._send_json(400, {"error": 'expected JSON body {"triage_text": "..."}'})
+                return
+            triage_text = body["triage_text"]
+            try:
+                prediction = batcher.submit(triage_text).result(timeout=request_timeout)
+            except Exception as e:
+                self._send_json(500, {"error": f"{type(e).__name__}: {e}"})
+                return
+            self._send_json(200, {"esi_level": prediction.level, "reasoning": prediction.reasoning,
+                                  "prompt_tokens": prediction.prompt_tokens,
+                                  "completion_tokens": prediction.completion_tokens})
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        super().server_bind()
+
+
+def serve(host="127.0.0.1", port=8008, unix_socket=None, max_batch_size=8, max_wait_ms=10.0,
+          max_new_tokens=Method_1_ZeroShot.DEFAULT_MAX_NEW_TOKENS, request_timeout=300.0, warmup=True):
+    """
+    Load the model, optionally warm it up, and serve predictions until interrupted.
+
+    Args:
+        host (str): Interface for the HTTP server (ignored with unix_socket).
+        port (int): TCP port for the HTTP server (ignored with unix_socket).
+        unix_socket (str, optional): Serve HTTP over this Unix socket path instead of TCP.
+        max_batch_size (int): Maximum requests per micro-batch.
+        max_wait_ms (float): Longest time a batch waits to fill after its first request.
+        max_new_tokens (int): Generation budget per request.
+        request_timeout (float): Seconds a request waits for its result before failing.
+        warmup (bool): Run one prediction at startup so the first client does not pay for it.
+    """
+    Method_1_ZeroShot.load_model()
+    if warmup:
+        Method_1_ZeroShot.generate_esi_predictions_batch(["warmup"], batch_size=1, max_new_tokens=1)
+
+    batcher = MicroBatcher(max_batch_size, max_wait_ms, max_new_tokens)
+    handler = make_handler(batcher, request_timeout, tcp=not unix_socket)
+    if unix_socket:
+        server = ThreadingUnixHTTPServer(unix_socket, handler)
+        print(f"Serving ESI predictions on unix socket {unix_socket}")
+    else:
+        server = ThreadingHTTPServer((host, port), handler)
+        server.daemon_threads = True
+        print(f"Serving ESI predictions on http://{host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def request_prediction(triage_text, url="http://127.0.0.1:8008", timeout=300.0):
+    """
+    Client helper: send one narrative to a running server.
+
+    Returns:
+        dict: {"esi_level": int or None, "reasoning": str, "prompt_tokens": int, "completion_tokens": int}
+    """
+    request = urllib.request.Request(f"{url}/predict", data=json.dumps({"triage_text": triage_text}).encode("utf-8"),
+                                     headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Resident zero-shot ESI inference server with micro-batching.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8008)
+    parser.add_argument("--unix-socket", default=None, help="Serve over a Unix socket instead of TCP.")
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--max-wait-ms", type=float, default=10.0)
+    parser.add_argument("--max-new-tokens", type=int, default=Method_1_ZeroShot.DEFAULT_MAX_NEW_TOKENS)
+    parser.add_argument("--backend", default=None, choices=["auto", "cuda", "cpu", "cpu-int8"])
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+
+    Method_1_ZeroShot.configure_backend(args.backend, threads=args.threads)
+    serve(args.host, args.port, args.unix_socket, args.max_batch_size, args.max_wait_ms, args.max_new_tokens)
@@ -0,0 +1,338 @@
+"""
+Pluggable LLM judge backends with latency-based routing and hedged requests.
+
+A JudgeRouter holds several interchangeable backends (OpenAI-style chat, DeepSeek-style endpoint,
+in-process mock). For every request it:
+  - picks the fastest healthy backend (lowest recent median latency; untried backends first),
+  - waits up to that backend's recent p95 latency, then sends a hedged duplicate to the next
+    backend and returns whichever answer arrives first,
+  - marks a backend unhealthy for a cooldown period after consecutive failures.
+
+Both ESITriageReward classes accept judge=JudgeRouter(...) in place of their built-in backend.
+
+Example:
+    router = JudgeRouter([OpenAIChatBackend(), DeepSeekBackend()])
+    reward_model = ESITriageReward(judge=router)
+"""
+
+import json
+import time
+import random
+import threading
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import List, Optional
+
+import openai
+import requests
+
+from Metrics import METRICS, backend_call, record_usage
+
+METRICS.describe("esi_judge_hedged_total", "Judge requests that sent a hedged duplicate, by hedge backend.")
+METRICS.describe("esi_judge_hedge_wins_total", "Hedged duplicates that answered before the primary, by backend.")
+
+
+def deepseek_reply_content(result: dict):
+    """
+    Judge output in a decoded DeepSeek-R1 reply: a JSON object under "scores", or text under "text" or "score".
+    Returns None when the reply has none of these keys.
+    """
+    return result.get("scores", result.get("text", result.get("score")))
+
+
+class JudgeBackend(ABC):
+    """
+    Base class for a judge backend. Subclasses implement complete().
+    """
+    name = "judge"
+    model = "unknown"
+    temperature = 0
+
+    @property
+    def identity(self) -> str:
+        """Name, model and temperature of this backend (what determines its replies)."""
+        return f"{self.name}:{self.model}@{self.temperature}"
+
+    @abstractmethod
+    def complete(self, prompt: str, system_content: Optional[str] = None) -> str:
+        """Return the judge's reply text for a prompt (raises on failure)."""
+
+
+class OpenAIChatBackend(JudgeBackend):
+    """OpenAI-style chat completion endpoint (the GPT reward judge)."""
+
+    def __init__(self, model: str = "gpt-4", temperature: float = 0, api_base: str = None, api_key: str = None,
+                 name: str = "openai_chat", timeout: float = 120.0):
+        self.model = model
+        self.temperature = temperature
+        self.api_base = api_base
+        self.api_key = api_key
+        self.name = name
+        self.timeout = timeout
+
+    def complete(self, prompt: str, system_content: Optional[str] = None) -> str:
+        messages = [{"role": "user", "content": prompt}]
+        if system_content:
+            messages.insert(0, {"role": "system", "content": system_content})
+        kwargs = {"api_base": self.api_base} if self.api_base else {}
+        if self.api_key:
+            kwargs["api_key"] = self.api_key
+        with backend_call(self.name):
+            response = openai.ChatCompletion.create(model=self.model, messages=messages,
+                                                    temperature=self.temperature, request_timeout=self.timeout,
+                                                    **kwargs)
+        record_usage(self.name, response.get("usage"))
+        return response["choices"][0]["message"]["content"].strip()
+
+
+class DeepSeekBackend(JudgeBackend):
+    """DeepSeek-R1-style endpoint taking {"prompt", "model", "temperature"} and replying with JSON."""
+
+    def __init__(self, api_url: str, api_key: str, model: str = "deepseek-r1", temperature: float = 0,
+                 name: str = "deepseek", timeout: float = 120.0):
+        self.api_url = api_url
+        self.api_key = api_key
+        self.model = model
+        self.temperature = temperature
+        self.name = name
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def complete(self, prompt: str, system_content: Optional[str] = None) -> str:
+        if system_content:
+            prompt = f"{system_content}\n\n{prompt}"
+        with backend_call(self.name):
+            response = self.session.post(
+                self.api_url,
+                headers={"Authorization": f"Bearer {self.api_key}", "Content-Type": "application/json"},
+                json={"prompt": prompt, "model": self.model, "temperature": self.temperature},
+                timeout=self.timeout,
+            )
+            response.raise_for_status()
+            result = response.json()
+        record_usage(self.name, result.get("usage"))
+        content = deepseek_reply_content(result)
+        if content is None:
+            raise ValueError(f"unexpected DeepSeek-R1 response: {str(result)[:200]}")
+        return json.dumps(content) if isinstance(content, dict) else str(content).strip()
+
+
+class MockBackend(JudgeBackend):
+    """
+    In-process stand-in judge for tests and benchmarks.
+
+    Each call sleeps for latency_ms (± jitter_ms); with probability slow_rate it takes slow_ms instead
+    (a latency tail), and with probability error_rate it raises. Prompts asking for a JSON object get a
+    fused four-rubric reply, everything else the score "1".
+    """
+    model = "mock"
+
+    def __init__(self, name: str = "mock", latency_ms: float = 20.0, jitter_ms: float = 5.0,
+                 slow_rate: float = 0.0, slow_ms: float = 2000.0, error_rate: float = 0.0, seed: int = 0):
+        self.name = name
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.slow_rate = slow_rate
+        self.slow_ms = slow_ms
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def complete(self, prompt: str, system_content: Optional[str] = None) -> str:
+        with self._lock:
+            slow = self.random.random() < self.slow_rate
+            failed = self.random.random() < self.error_rate
+            delay = self.slow_ms if slow else max(0.0, self.random.gauss(self.latency_ms, self.jitter_ms))
+        with backend_call(self.name):
+            time.sleep(delay / 1000.0)
+            if failed:
+                raise RuntimeError("mock judge failure")
+        if "JSON object" in prompt:
+            return '{"alignment": 3, "safety": 1, "explainability": 1, "bias": 0}'
+        return "1"
+
+
+class BackendStats:
+    """Rolling latency window and failure state for one backend (thread-safe)."""
+
+    def __init__(self, window: int = 200):
+        self.latencies = deque(maxlen=window)
+        self.consecutive_failures = 0
+        self.unhealthy_until = 0.0
+        self._lock = threading.Lock()
+
+    def record_success(self, seconds: float) -> None:
+        with self._lock:
+            self.latencies.append(seconds)
+            self.consecutive_failures = 0
+            self.unhealthy_until = 0.0
+
+    def record_failure(self, failure_threshold: int, cooldown: float) -> None:
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= failure_threshold:
+                self.unhealthy_until = time.monotonic() + cooldown
+
+    def quantile(self, q: float) -> Optional[float]:
+        with self._lock:
+            if not self.latencies:
+                return None
+            ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    @property
+    def samples(self) -> int:
+        return len(self.latencies)
+
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.unhealthy_until
+
+
+class JudgeRouter:
+    """
+    Routes judge requests across backends by recent latency and hedges slow requests.
+
+    Args:
+        backends (list of JudgeBackend): Interchangeable judges; each needs a unique name.
+        hedge (bool): Send a duplicate to the next-fastest backend when the primary is slow.
+        hedge_quantile (float): Latency quantile of the primary used as the hedge delay (0.95 = p95).
+        initial_hedge_delay (float): Hedge delay in seconds until a backend has min_samples latencies.
+        min_hedge_delay (float): Lower bound on the hedge delay, in seconds.
+        min_samples (int): Latencies needed before a backend's quantiles are trusted.
+        window (int): Number of recent latencies kept per backend.
+        failure_threshold (int): Consecutive failures that mark a backend unhealthy.
+        cooldown (float): Seconds an unhealthy backend is skipped before it is tried again.
+        max_workers (int): Threads available for in-flight backend calls.
+    """
+
+    def __init__(self, backends: List[JudgeBackend], hedge: bool = True, hedge_quantile: float = 0.95,
+                 initial_hedge_delay: float = 1.0, min_hedge_delay: float = 0.01, min_samples: int = 20,
+                 window: int = 200, failure_threshold: int = 3, cooldown: float = 30.0, max_workers: int = 64):
+        if not backends:
+            raise ValueError("JudgeRouter needs at least one backend")
+        names = [backend.name for backend in backends]
+        if len(set(names)) != len(names):
+            raise ValueError(f"Judge backend names must be unique: {names}")
+        self.backends = list(backends)
+        self.stats = {backend.name: BackendStats(window) for backend in backends}
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.initial_hedge_delay = initial_hedge_delay
+        self.min_hedge_delay = min_hedge_delay
+        self.min_samples = min_samples
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        # Any backend may answer a given request, so cached replies are keyed by the whole backend set
+        self.cache_model = "router[" + ",".join(sorted(backend.identity for backend in backends)) + "]"
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="judge")
+
+    def ranked_backends(self) -> List[JudgeBackend]:
+        """Healthy backends, fastest first (backends still warming up first); all backends if none is healthy."""
+        healthy = [b for b in self.backends if self.stats[b.name].healthy] or self.backends
+
+        def key(backend):
+            stats = self.stats[backend.name]
+            if stats.samples < self.min_samples:
+                return (0, stats.samples)
+            return (1, stats.quantile(0.5))
+
+        return sorted(healthy, key=key)
+
+    def hedge_delay(self, backend: JudgeBackend) -> float:
+        stats = self.stats[backend.name]
+        if stats.samples < self.min_samples:
+            return self.initial_hedge_delay
+        return max(self.min_hedge_delay, stats.quantile(self.hedge_quantile))
+
+    def _call(self, backend: JudgeBackend, prompt: str, system_content: Optional[str]) -> str:
+        started = time.perf_counter()
+        try:
+            content = backend.complete(prompt, system_content)
+        except Exception:
+            self.stats[backend.name].record_failure(self.failure_threshold, self.cooldown)
+            raise
+        self.stats[backend.name].record_success(time.perf_counter() - started)
+        return content
+
+    def complete(self, prompt: str, system_content: Optional[str] = None) -> str:
+        """
+        Return the first successful reply. A failed attempt moves on to the next backend;
+        raises the last error once every backend has failed.
+        """
+        ranked = self.ranked_backends()
+        pending = {}
+        next_index = 0
+        last_error = None
+
+        def launch():
+            nonlocal next_index
+            backend = ranked[next_index]
+            next_index += 1
+            pending[self.executor.submit(self._call, backend, prompt, system_content)] = backend
+            return backend
+
+        primary = launch()
+        timeout = self.hedge_delay(primary) if self.hedge and len(ranked) > 1 else None
+        while pending:
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                timeout = None
+                if next_index >= len(ranked):
+                    continue
+                # Primary is slower than its recent p95: hedge with the next backend
+                hedged = launch()
+                METRICS.inc("esi_judge_hedged_total", backend=hedged.name)
+                continue
+            for future in done:
+                backend = pending.pop(future)
+                try:
+                    content = future.result()
+                except Exception as e:
+                    last_error = e
+                    continue
+                if backend is not primary:
+                    METRICS.inc("esi_judge_hedge_wins_total", backend=backend.name)
+                # Losers finish in the background; their latency still updates the stats
+                return content
+            if not pending and next_index < len(ranked):
+                launch()
+                timeout = None
+        raise last_error
+
+    def health(self) -> dict:
+        """Per-backend health and latency summary."""
+        return {
+            backend.name: {
+                "healthy": self.stats[backend.name].healthy,
+                "samples": self.stats[backend.name].samples,
+                "consecutive_failures": self.stats[backend.name].consecutive_failures,
+                "p50_seconds": self.stats[backend.name].quantile(0.5),
+                "p95_seconds": self.stats[backend.name].quantile(0.95),
+            }
+            for backend in self.backends
+        }
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=False)
+
+
+if __name__ == "__main__":
+    # Tail-latency demo: two mock judges where 5% of calls take 1 s
+    def run(router, n=400):
+        latencies = []
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            def one(_):
+                started = time.perf_counter()
+                router.complete("Rate the explanation. Return only the numerical score.")
+                return time.perf_counter() - started
+            latencies = sorted(pool.map(one, range(n)))
+        return {q: round(latencies[int(q * (n - 1))] * 1000, 1) for q in (0.5, 0.95, 0.99)}
+
+    for hedge in (False, True):
+        router = JudgeRouter([MockBackend("mock_a", 20, 5, slow_rate=0.05, slow_ms=1000, seed=1),
+                              MockBackend("mock_b", 30, 5, slow_rate=0.05, slow_ms=1000, seed=2)], hedge=hedge)
+        print(f"hedge={hedge}: latency ms by quantile {run(router)}")
+        print(json.dumps(router.health(), indent=2))
+        router.close()
@@ -0,0 +1,135 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from typing import Dict, Optional
+
+
+class JudgeCache:
+    """
+    Persistent, content-addressed cache for LLM judge responses.
+
+    Entries are keyed by a SHA-256 hash of (model, temperature, prompt) and stored in SQLite,
+    so re-running reward computation (e.g., after changing weights) does not re-query the judge
+    for prompts it has already scored.
+      - max_entries: least-recently-used entries beyond this count are evicted.
+      - max_age_seconds: entries older than this are treated as misses and evicted.
+      - read_only: never writes (no inserts, evictions or access-time updates), for reproducible evaluations.
+    """
+
+    def __init__(self, path: str = "judge_cache.sqlite", max_entries: Optional[int] = None,
+                 max_age_seconds: Optional[float] = None, read_only: bool = False, evict_every: int = 100):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age_seconds = max_age_seconds
+        self.read_only = read_only
+        self.evict_every = evict_every
+        self.hits = 0
+        self.misses = 0
+        self._puts_since_evict = 0
+        self._lock = threading.Lock()
+
+        if read_only:
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"Read-only judge cache not found: {path}")
+            self._conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        else:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS judge_cache ("
+                " key TEXT PRIMARY KEY,"
+                " model TEXT NOT NULL,"
+                " response TEXT NOT NULL,"
+                " created_at REAL NOT NULL,"
+                " accessed_at REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_judge_cache_accessed ON judge_cache (accessed_at)")
+            self._conn.commit()
+
+    @staticmethod
+    def make_key(prompt: str, model: str, temperature: float) -> str:
+        """Hash the prompt, model name and temperature into a cache key."""
+        digest = hashlib.sha256()
+        digest.update(model.encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(repr(float(temperature)).encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(prompt.encode("utf-8"))
+        return digest.hexdigest()
+
+    def get(self, prompt: str, model: str, temperature: float) -> Optional[str]:
+        """Return the cached response for this prompt, or None on a miss (including expired entries)."""
+        key = self.make_key(prompt, model, temperature)
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response, created_at FROM judge_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or (self.max_age_seconds is not None and now - row[1] > self.max_age_seconds):
+                self.misses += 1
+                return None
+            self.hits += 1
+            if not self.read_only:
+                self._conn.execute("UPDATE judge_cache SET accessed_at = ? WHERE key = ?", (now, key))
+                self._conn.commit()
+            return row[0]
+
+    def put(self, prompt: str, model: str, temperature: float, response: str) -> None:
+        """Store a judge response. No-op in read-only mode."""
+        if self.read_only:
+            return
+        key = self.make_key(prompt, model, temperature)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO judge_cache (key, model, response, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, model, response, now, now),
+            )
+            self._conn.commit()
+            self._puts_since_evict += 1
+            if self._puts_since_evict >= self.evict_every:
+                self._evict_locked()
+
+    def evict(self) -> int:
+        """Apply age- and size-based eviction now. Returns the number of entries removed."""
+        if self.read_only:
+            return 0
+        with self._lock:
+            return self._evict_locked()
+
+    def _evict_locked(self) -> int:
+        self._puts_since_evict = 0
+        removed = 0
+        if self.max_age_seconds is not None:
+            cursor = self._conn.execute(
+                "DELETE FROM judge_cache WHERE created_at < ?", (time.time() - self.max_age_seconds,)
+            )
+            removed += cursor.rowcount
+        if self.max_entries is not None:
+            cursor = self._conn.execute(
+                "DELETE FROM judge_cache WHERE key IN ("
+                " SELECT key FROM judge_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            removed += cursor.rowcount
+        self._conn.commit()
+        return removed
+
+    def stats(self) -> Dict[str, float]:
+        """Hit/miss counters and the current number of stored entries."""
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM judge_cache").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries,
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
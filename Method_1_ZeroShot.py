@@ -1,33 +1,414 @@
+import os
+import re
+import copy
+import threading
+from dataclasses import dataclass
+from typing import Optional
 import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer, pipeline
+from transformers import AutoModelForCausalLM, AutoTokenizer, StoppingCriteria, StoppingCriteriaList, pipeline
+from Metrics import METRICS, backend_call
 
-# Load the Qwen2-1.5b model and tokenizer
-model_name = "Qwen/Qwen2-1.5B"
-tokenizer = AutoTokenizer.from_pretrained(model_name)
-model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=torch.float16, device_map="auto")
+# Model selection; ESI_MODEL_NAME overrides it (e.g., with a tiny model for benchmarks)
+model_name = os.getenv("ESI_MODEL_NAME", "Qwen/Qwen2-1.5B")
 
-# Define the prompt template for zero-shot ESI prediction
-def generate_esi_prediction(triage_text):
-    prompt = f"""
+# Inference backend:
+#   "auto"     - CUDA (float16) when available, otherwise "cpu"
+#   "cuda"     - float16 on GPU
+#   "cpu"      - float32 on CPU
+#   "cpu-int8" - float32 on CPU with int8 dynamic quantization of the Linear layers
+backend = os.getenv("ESI_BACKEND", "auto")
+# CPU threads for torch (None keeps torch's default)
+num_threads = int(os.getenv("ESI_NUM_THREADS", "0")) or None
+
+# The model and tokenizer are loaded on first use and then shared by every call
+_model = None
+_tokenizer = None
+_load_lock = threading.Lock()
+
+def configure_backend(name=None, threads=None, model=None):
+    """
+    Select the inference backend, CPU thread count and/or model before (re)loading.
+
+    Any already-loaded model and its derived caches are dropped, so the next call loads
+    the model with the new settings.
+
+    Args:
+        name (str, optional): "auto", "cuda", "cpu" or "cpu-int8".
+        threads (int, optional): Number of CPU threads for torch.
+        model (str, optional): Model name or path.
+    """
+    global backend, num_threads, model_name, _model, _tokenizer, _prefix_cache, _level_tokens
+    with _load_lock:
+        if name is not None:
+            if name not in ("auto", "cuda", "cpu", "cpu-int8"):
+                raise ValueError(f"Unknown backend: {name}")
+            backend = name
+        if threads is not None:
+            num_threads = threads
+        if model is not None:
+            model_name = model
+        _model = _tokenizer = _prefix_cache = _level_tokens = None
+
+def load_model():
+    """
+    Load the model and tokenizer on first use (thread-safe) and return the cached pair.
+
+    Returns:
+        tuple: (model, tokenizer)
+    """
+    global _model, _tokenizer
+    if _model is not None:
+        return _model, _tokenizer
+    with _load_lock:
+        if _model is None:
+            selected = backend
+            if selected == "auto":
+                selected = "cuda" if torch.cuda.is_available() else "cpu"
+            if num_threads:
+                torch.set_num_threads(num_threads)
+
+            tokenizer = AutoTokenizer.from_pretrained(model_name)
+            tokenizer.padding_side = "left"  # decoder-only models must be left-padded for batched generation
+            if tokenizer.pad_token is None:
+                tokenizer.pad_token = tokenizer.eos_token
+
+            if selected == "cuda":
+                model = AutoModelForCausalLM.from_pretrained(model_name, dtype=torch.float16, device_map="auto")
+            else:
+                # float16 is slow on CPU; int8 dynamic quantization shrinks the Linear weights ~4x
+                model = AutoModelForCausalLM.from_pretrained(model_name, dtype=torch.float32).to("cpu")
+                if selected == "cpu-int8":
+                    model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+            model.eval()
+            _model, _tokenizer = model, tokenizer
+    return _model, _tokenizer
+
+def __getattr__(name):
+    # Keep `from Method_1_ZeroShot import model, tokenizer` working without loading at import time
+    if name == "model":
+        return load_model()[0]
+    if name == "tokenizer":
+        return load_model()[1]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# Default generation budget (new tokens only, not counting the prompt)
+DEFAULT_MAX_NEW_TOKENS = 256
+
+# Define the prompt template for zero-shot ESI prediction.
+# The fixed instructions come first so they form a true prefix shared by every case;
+# only the narrative suffix changes, which lets the prefix's KV cache be reused.
+PROMPT_PREFIX = """
     Given the following emergency department triage narrative, assign an Emergency Severity Index (ESI) level (1-5) and provide a reasoning explanation:
     
-    Triage Narrative:
-    "{triage_text}"
-    
     Response Format:
     - ESI Level: <1/2/3/4/5>
     - Reasoning: <Explain the reasoning behind the classification>
+    END
     
     Provide a step-by-step reasoning based on patient acuity, vital signs, and resource needs.
+    Write END on its own line after the reasoning.
+    
+    Triage Narrative:
+"""
+
+def build_prompt_suffix(triage_text):
+    return f"""    "{triage_text}"
     """
 
-    # Generate response
-    input_ids = tokenizer(prompt, return_tensors="pt").input_ids.to("cuda")
-    output = model.generate(input_ids, max_length=512, temperature=0.7, top_p=0.9)
-    
-    # Decode and return the model output
-    response = tokenizer.decode(output[0], skip_special_tokens=True)
-    return response
+def build_prompt(triage_text):
+    return PROMPT_PREFIX + build_prompt_suffix(triage_text)
+
+# Lazily computed (prefix_ids, past_key_values) for PROMPT_PREFIX
+_prefix_cache = None
+
+def get_prefix_cache():
+    """
+    Run the shared instruction prefix through the model once and keep its KV cache.
+
+    Returns:
+        tuple: (prefix input ids, past_key_values) for PROMPT_PREFIX.
+    """
+    global _prefix_cache
+    if _prefix_cache is None:
+        model, tokenizer = load_model()
+        prefix_ids = tokenizer(PROMPT_PREFIX, return_tensors="pt").input_ids.to(model.device)
+        with torch.inference_mode():
+            past_key_values = model(prefix_ids, use_cache=True).past_key_values
+        _prefix_cache = (prefix_ids, past_key_values)
+    return _prefix_cache
+
+def encode_with_prefix_cache(triage_text):
+    """
+    Tokenize a case as cached-prefix ids + narrative suffix ids.
+
+    The suffix is tokenized on its own so the prefix ids match the cached ones exactly.
+
+    Returns:
+        tuple: (full input ids, a private copy of the prefix past_key_values).
+    """
+    model, tokenizer = load_model()
+    prefix_ids, past_key_values = get_prefix_cache()
+    suffix_ids = tokenizer(build_prompt_suffix(triage_text), add_special_tokens=False,
+                           return_tensors="pt").input_ids.to(model.device)
+    # Generation appends to the cache in place, so each case gets its own copy
+    return torch.cat([prefix_ids, suffix_ids], dim=1), copy.deepcopy(past_key_values)
+
+# ===== Response parsing =====
+
+# "ESI Level: 3" (optionally bolded/bulleted)
+ESI_LEVEL_PATTERN = re.compile(r"ESI\s+Level\s*[:\-]?\s*\**\s*([1-5])\b", re.IGNORECASE)
+# Reasoning text (possibly several paragraphs) up to the END marker line, the next "ESI Level:" or
+# "Triage Narrative" header, or the end of the output.
+# Group 2 is empty only when the output simply ran out, i.e. the reasoning may be unfinished.
+REASONING_PATTERN = re.compile(
+    r"Reasoning\s*:\s*\**\s*(\S.*?)"
+    r"(\n[ \t]*(?-i:END)[ \t]*(?:\n|\Z)|\n\s*(?:[-*]\s*)?\**\s*(?:ESI\s+Level\s*\**\s*:|Triage\s+Narrative)|\Z)",
+    re.IGNORECASE | re.DOTALL,
+)
+
+@dataclass
+class ESIPrediction:
+    """One parsed zero-shot prediction."""
+    level: Optional[int]  # None if the output had no ESI level
+    reasoning: str
+    prompt_tokens: int
+    completion_tokens: int
+    text: str  # the decoded generated text (prompt excluded)
+
+def parse_esi_response(text):
+    """
+    Extract the ESI level and reasoning from a generated response.
+
+    Returns:
+        tuple: (level as int or None if no level was found, reasoning text after the level).
+    """
+    level_match = ESI_LEVEL_PATTERN.search(text)
+    if level_match is None:
+        return None, text.strip()
+    reasoning_match = REASONING_PATTERN.search(text, level_match.end())
+    reasoning = reasoning_match.group(1) if reasoning_match else text[level_match.end():]
+    return int(level_match.group(1)), reasoning.strip()
+
+def response_complete(text):
+    """
+    True once text holds an ESI level followed by a finished Reasoning section (END marker or next header).
+    A reasoning that runs until EOS is ended by generate() itself.
+    """
+    level_match = ESI_LEVEL_PATTERN.search(text)
+    if level_match is None:
+        return False
+    reasoning_match = REASONING_PATTERN.search(text, level_match.end())
+    return reasoning_match is not None and reasoning_match.group(2) != ""
+
+class ESIResponseStoppingCriteria(StoppingCriteria):
+    """
+    Stop each sequence as soon as its generated text contains a complete ESI Level + Reasoning answer,
+    instead of decoding up to max_new_tokens.
+
+    Only the tokens after prompt_length are decoded, and a finished row is never re-checked.
+    stopped_at records, per row, how many tokens had been generated when its answer was complete
+    (None for rows it did not stop); generate() pads those rows from there on.
+    """
+
+    def __init__(self, tokenizer, prompt_length):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.done = None
+        self.stopped_at = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.done is None:
+            self.done = [False] * input_ids.shape[0]
+            self.stopped_at = [None] * input_ids.shape[0]
+        for row in range(input_ids.shape[0]):
+            if not self.done[row]:
+                text = self.tokenizer.decode(input_ids[row, self.prompt_length:], skip_special_tokens=True)
+                self.done[row] = response_complete(text)
+                if self.done[row]:
+                    self.stopped_at[row] = input_ids.shape[1] - self.prompt_length
+        return torch.tensor(self.done, dtype=torch.bool, device=input_ids.device)
+
+def make_prediction(tokenizer, new_ids, prompt_tokens):
+    """Decode only the generated ids of one row and parse them into an ESIPrediction."""
+    text = tokenizer.decode(new_ids, skip_special_tokens=True)
+    level, reasoning = parse_esi_response(text)
+    completion_tokens = int((new_ids != tokenizer.pad_token_id).sum())
+    return ESIPrediction(level, reasoning, prompt_tokens, completion_tokens, text)
+
+def record_token_counts(prompt_tokens, new_tokens):
+    """Count prompt tokens and generated (non-padding) tokens for the local model."""
+    tokenizer = load_model()[1]
+    METRICS.inc("esi_backend_prompt_tokens_total", prompt_tokens, backend="local_model")
+    METRICS.inc("esi_backend_completion_tokens_total", int((new_tokens != tokenizer.pad_token_id).sum()),
+                backend="local_model")
+
+def generate_esi_predictions_batch(triage_texts, batch_size=8, max_new_tokens=DEFAULT_MAX_NEW_TOKENS):
+    """
+    Generate ESI predictions for many triage narratives at once.
+
+    Prompts are sorted by token length and grouped into batches of similar length, so short
+    prompts are not padded up to the longest prompt in the whole input. Batches are left-padded
+    (required for decoder-only generation). Each row stops as soon as its ESI Level and Reasoning
+    are complete, and decoding is capped by max_new_tokens.
+
+    Args:
+        triage_texts (list of str): Triage narratives.
+        batch_size (int): Number of prompts generated together.
+        max_new_tokens (int): Maximum number of tokens generated per prompt.
+
+    Returns:
+        list of ESIPrediction: One parsed prediction per narrative, in the same order as triage_texts.
+    """
+    model, tokenizer = load_model()
+    prompts = [build_prompt(text) for text in triage_texts]
+    lengths = [len(ids) for ids in tokenizer(prompts)["input_ids"]]
+    order = sorted(range(len(prompts)), key=lambda i: lengths[i])
+
+    results = [None] * len(prompts)
+    for start in range(0, len(order), batch_size):
+        bucket = order[start:start + batch_size]
+        inputs = tokenizer([prompts[i] for i in bucket], return_tensors="pt", padding=True).to(model.device)
+        prompt_length = inputs.input_ids.shape[1]
+        with backend_call("local_model"), torch.inference_mode():
+            output = model.generate(
+                **inputs,
+                max_new_tokens=max_new_tokens,
+                do_sample=True,
+                temperature=0.7,
+                top_p=0.9,
+                pad_token_id=tokenizer.pad_token_id,
+                stopping_criteria=StoppingCriteriaList([ESIResponseStoppingCriteria(tokenizer, prompt_length)]),
+            )
+        new_tokens = output[:, prompt_length:]
+        record_token_counts(int(inputs.attention_mask.sum()), new_tokens)
+        for row, i in enumerate(bucket):
+            results[i] = make_prediction(tokenizer, new_tokens[row], int(inputs.attention_mask[row].sum()))
+    return results
+
+def generate_esi_prediction(triage_text, max_new_tokens=DEFAULT_MAX_NEW_TOKENS, use_prefix_cache=True):
+    """
+    Generate an ESI prediction for a single triage narrative.
+
+    With use_prefix_cache, the shared instruction prefix is not re-encoded: only the
+    narrative suffix is prefilled on top of the cached prefix KV state.
+
+    Returns:
+        ESIPrediction: The parsed prediction.
+    """
+    if not use_prefix_cache:
+        return generate_esi_predictions_batch([triage_text], batch_size=1, max_new_tokens=max_new_tokens)[0]
+
+    model, tokenizer = load_model()
+    input_ids, past_key_values = encode_with_prefix_cache(triage_text)
+    with backend_call("local_model"), torch.inference_mode():
+        output = model.generate(
+            input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            past_key_values=past_key_values,
+            max_new_tokens=max_new_tokens,
+            do_sample=True,
+            temperature=0.7,
+            top_p=0.9,
+            pad_token_id=tokenizer.pad_token_id,
+            stopping_criteria=StoppingCriteriaList([ESIResponseStoppingCriteria(tokenizer, input_ids.shape[1])]),
+        )
+    new_tokens = output[:, input_ids.shape[1]:]
+    record_token_counts(input_ids.shape[1], new_tokens)
+    return make_prediction(tokenizer, new_tokens[0], input_ids.shape[1])
+
+# ===== Classify-only mode =====
+
+ESI_LEVELS = (1, 2, 3, 4, 5)
+# Cue appended to the prompt so the next token is the ESI level digit
+CLASSIFY_CUE = "- ESI Level:"
+
+# Lazily computed (cue ids, candidate token id per ESI level)
+_level_tokens = None
+
+def get_level_tokens():
+    """
+    Work out which token ids the model would emit for "1".."5" right after CLASSIFY_CUE.
+
+    Tokenizers differ in whether " 1" is one token or a space token followed by "1";
+    any leading tokens shared by all five levels are folded into the cue.
+
+    Returns:
+        tuple: (cue token ids, list of one candidate token id per level in ESI_LEVELS).
+    """
+    global _level_tokens
+    if _level_tokens is None:
+        tokenizer = load_model()[1]
+        cue_ids = tokenizer(CLASSIFY_CUE, add_special_tokens=False).input_ids
+        continuations = [
+            tokenizer(f"{CLASSIFY_CUE} {level}", add_special_tokens=False).input_ids[len(cue_ids):]
+            for level in ESI_LEVELS
+        ]
+        shared = 0
+        while (all(len(c) > shared + 1 for c in continuations)
+               and len({c[shared] for c in continuations}) == 1):
+            shared += 1
+        cue_ids = cue_ids + continuations[0][:shared]
+        _level_tokens = (cue_ids, [c[shared] for c in continuations])
+    return _level_tokens
+
+def _level_distribution(last_logits, level_ids):
+    probs = torch.softmax(last_logits[..., level_ids].float(), dim=-1)
+    return probs.cpu().tolist()
+
+def classify_esi_level(triage_text):
+    """
+    Predict the ESI level with a single forward pass instead of free-text generation.
+
+    The prompt is followed by an "ESI Level:" cue and the model's next-token logits for the
+    five level tokens are read off (reusing the shared prefix KV cache).
+
+    Returns:
+        dict: {"level": argmax ESI level, "probabilities": {level: probability}}
+              with probabilities renormalised over the five levels.
+    """
+    model = load_model()[0]
+    cue_ids, level_ids = get_level_tokens()
+    input_ids, past_key_values = encode_with_prefix_cache(triage_text)
+    cue = torch.tensor([cue_ids], dtype=input_ids.dtype, device=input_ids.device)
+    prefix_len = past_key_values.get_seq_length()
+    new_ids = torch.cat([input_ids[:, prefix_len:], cue], dim=1)
+    with backend_call("local_model_classify"), torch.inference_mode():
+        logits = model(new_ids, past_key_values=past_key_values, use_cache=True).logits
+    METRICS.inc("esi_backend_prompt_tokens_total", prefix_len + new_ids.shape[1], backend="local_model_classify")
+    probs = _level_distribution(logits[0, -1], level_ids)
+    distribution = dict(zip(ESI_LEVELS, probs))
+    return {"level": max(distribution, key=distribution.get), "probabilities": distribution}
+
+def classify_esi_levels_batch(triage_texts, batch_size=16):
+    """
+    Batched classify-only mode for bulk screening.
+
+    Prompts (with the "ESI Level:" cue) are length-bucketed and left-padded, so the last
+    position of every row is the cue and one forward pass per batch scores all levels.
+
+    Returns:
+        list of dict: One {"level", "probabilities"} record per narrative, in input order.
+    """
+    model, tokenizer = load_model()
+    cue_ids, level_ids = get_level_tokens()
+    encoded = [
+        tokenizer(build_prompt(text)).input_ids + cue_ids
+        for text in triage_texts
+    ]
+    order = sorted(range(len(encoded)), key=lambda i: len(encoded[i]))
+
+    results = [None] * len(encoded)
+    for start in range(0, len(order), batch_size):
+        bucket = order[start:start + batch_size]
+        inputs = tokenizer.pad({"input_ids": [encoded[i] for i in bucket]}, return_tensors="pt").to(model.device)
+        with backend_call("local_model_classify"), torch.inference_mode():
+            logits = model(**inputs).logits
+        METRICS.inc("esi_backend_prompt_tokens_total", int(inputs.attention_mask.sum()),
+                    backend="local_model_classify")
+        for row, probs in zip(bucket, _level_distribution(logits[:, -1], level_ids)):
+            distribution = dict(zip(ESI_LEVELS, probs))
+            results[row] = {"level": max(distribution, key=distribution.get), "probabilities": distribution}
+    return results
 
 # Example triage narratives
 triage_cases = [
@@ -35,8 +416,15 @@ triage_cases = [
     "Patient is a 25-year-old female with a minor laceration on the right forearm. No active bleeding. Vitals are stable, and she reports mild discomfort. No underlying conditions.",
 ]
 
-# Run zero-shot predictions
-for case in triage_cases:
-    result = generate_esi_prediction(case)
-    print("\n---- Generated Prediction ----")
-    print(result)
+if __name__ == "__main__":
+    # For CPU-only / edge hardware, e.g.: configure_backend("cpu-int8", threads=4)
+    # Run zero-shot predictions
+    for prediction in generate_esi_predictions_batch(triage_cases):
+        print("\n---- Generated Prediction ----")
+        print(f"ESI Level: {prediction.level}")
+        print(f"Reasoning: {prediction.reasoning}")
+        print(f"Tokens: {prediction.prompt_tokens} prompt, {prediction.completion_tokens} generated")
+
+    # Classify-only mode: ESI level and confidence from one forward pass per case
+    for classification in classify_esi_levels_batch(triage_cases):
+        print(f"\nESI Level {classification['level']}: {classification['probabilities']}")
@@ -0,0 +1,207 @@
+import json
+import time
+import bisect
+import threading
+import functools
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional, Tuple
+
+# Latency histogram bucket upper bounds, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Bucket upper bounds for count-valued histograms (e.g., batch sizes)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _label_key(labels: Dict[str, str]) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key: LabelKey, extra: Dict[str, str] = None) -> str:
+    items = list(key) + sorted((extra or {}).items())
+    if not items:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in items)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(items, escaped)) + "}"
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus style."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for upper, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            yield upper, total
+
+
+class MetricsRegistry:
+    """
+    Thread-safe in-process metrics: labelled counters and latency histograms.
+
+    Snapshots can be exported as JSON or in the Prometheus text exposition format.
+    An optional profiling hook is called with (name, labels, seconds) for every timed section.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Dict[LabelKey, float]] = {}
+        self._histograms: Dict[str, Dict[LabelKey, Histogram]] = {}
+        self._help: Dict[str, str] = {}
+        self._buckets: Dict[str, Tuple[float, ...]] = {}
+        self.profile_hook: Optional[Callable[[str, Dict[str, str], float], None]] = None
+
+    def describe(self, name: str, help_text: str, buckets=None) -> None:
+        """Set a metric's help text and, for histograms not measured in seconds, its bucket upper bounds."""
+        self._help[name] = help_text
+        if buckets is not None:
+            self._buckets[name] = tuple(buckets)
+
+    def inc(self, name: str, value: float = 1.0, **labels) -> None:
+        """Add value to a counter."""
+        key = _label_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0.0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        """Record one observation in a histogram (buckets from describe(), else DEFAULT_BUCKETS)."""
+        key = _label_key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram(self._buckets.get(name, DEFAULT_BUCKETS))
+            series[key].observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """Time the enclosed block into histogram `name` (recorded even if the block raises)."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.observe(name, elapsed, **labels)
+            if self.profile_hook is not None:
+                self.profile_hook(name, labels, elapsed)
+
+    def timed(self, name: str, **labels):
+        """Decorator form of timer()."""
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.timer(name, **labels):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def set_profile_hook(self, hook: Optional[Callable[[str, Dict[str, str], float], None]]) -> None:
+        """Install (or clear, with None) a callback invoked with (name, labels, seconds) per timed section."""
+        self.profile_hook = hook
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def snapshot(self) -> dict:
+        """Return all metrics as plain JSON-serialisable data."""
+        with self._lock:
+            counters = {
+                name: [{"labels": dict(key), "value": value} for key, value in series.items()]
+                for name, series in self._counters.items()
+            }
+            histograms = {
+                name: [{
+                    "labels": dict(key),
+                    "count": hist.count,
+                    "sum": hist.sum,
+                    "buckets": {("+Inf" if upper == float("inf") else str(upper)): total
+                                for upper, total in hist.cumulative()},
+                } for key, hist in series.items()]
+                for name, series in self._histograms.items()
+            }
+        return {"timestamp": time.time(), "counters": counters, "histograms": histograms}
+
+    def to_json(self, indent: int = None) -> str:
+        return json.dumps(self.snapshot(), indent=indent)
+
+    def write_snapshot(self, path: str) -> None:
+        """Write a JSON snapshot to path."""
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(self.to_json(indent=2))
+
+    def to_prometheus(self) -> str:
+        """Render all metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} counter")
+                for key, value in series.items():
+                    lines.append(f"{name}{_format_labels(key)} {value}")
+            for name, series in sorted(self._histograms.items()):
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} histogram")
+                for key, hist in series.items():
+                    for upper, total in hist.cumulative():
+                        le = "+Inf" if upper == float("inf") else repr(upper)
+                        lines.append(f"{name}_bucket{_format_labels(key, {'le': le})} {total}")
+                    lines.append(f"{name}_sum{_format_labels(key)} {hist.sum}")
+                    lines.append(f"{name}_count{_format_labels(key)} {hist.count}")
+        return "\n".join(lines) + "\n"
+
+
+# Process-wide registry used by the reward, narrative and inference scripts
+METRICS = MetricsRegistry()
+
+METRICS.describe("esi_reward_component_seconds", "Time spent computing each sub-reward.")
+METRICS.describe("esi_reward_fallback_total", "Sub-reward scores that came from an error fallback instead of the judge.")
+METRICS.describe("esi_fused_judge_incomplete_total", "Fused judge responses missing at least one valid rubric score.")
+METRICS.describe("esi_reward_judge_skipped_total", "LLM sub-rewards left unjudged because a threshold decision was already certain.")
+METRICS.describe("esi_prescorer_cases_total", "Reasonings scored locally by the rubric prescorer (outcome=local) or sent to the judge (outcome=judge).")
+METRICS.describe("esi_backend_request_seconds", "Latency of each backend request.")
+METRICS.describe("esi_backend_requests_total", "Backend requests issued (including retries).")
+METRICS.describe("esi_backend_retries_total", "Backend requests retried after a retryable error.")
+METRICS.describe("esi_backend_failures_total", "Backend requests that failed.")
+METRICS.describe("esi_backend_prompt_tokens_total", "Prompt tokens reported by each backend.")
+METRICS.describe("esi_backend_completion_tokens_total", "Completion tokens reported by each backend.")
+METRICS.describe("esi_narrative_row_failures_total", "Patient rows whose narrative could not be generated.")
+
+
+def record_usage(backend: str, usage) -> None:
+    """Add the prompt/completion token counts from an API usage object, when present."""
+    if not usage:
+        return
+    prompt_tokens = usage.get("prompt_tokens")
+    completion_tokens = usage.get("completion_tokens")
+    if prompt_tokens is not None:
+        METRICS.inc("esi_backend_prompt_tokens_total", prompt_tokens, backend=backend)
+    if completion_tokens is not None:
+        METRICS.inc("esi_backend_completion_tokens_total", completion_tokens, backend=backend)
+
+
+@contextmanager
+def backend_call(backend: str):
+    """Count, time and (on exception) record a failure for one backend request."""
+    METRICS.inc("esi_backend_requests_total", backend=backend)
+    try:
+        with METRICS.timer("esi_backend_request_seconds", backend=backend):
+            yield
+    except Exception:
+        METRICS.inc("esi_backend_failures_total", backend=backend)
+        raise
@@ -0,0 +1,349 @@
+"""
+Pipelined RL rollout loop for the ESI student model.
+
+Three stages run concurrently and are connected by bounded queues:
+
+    generate (policy model)  ->  score (reward judge)  ->  update (policy gradient)
+
+While the judge scores batch N, the policy is already generating batch N+1, so the model no longer
+sits idle for the judge round-trip. The queues hold at most queue_size batches each, which bounds
+memory and how stale a batch can be when it is used for an update (at most 2 * queue_size + 1 steps
+behind the current weights). Generation and the update share one lock around the model.
+
+The update is REINFORCE with a batch-normalised reward baseline on the response tokens.
+
+CPU demo with a tiny model and the mock judge:
+    python RL_Rollout_Pipeline.py --model /path/to/tiny-model --steps 8 --judge-latency-ms 300
+    python RL_Rollout_Pipeline.py --model /path/to/tiny-model --steps 8 --judge-latency-ms 300 --sequential
+"""
+
+import time
+import queue
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Iterable, List, Optional, Tuple
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer, StoppingCriteriaList
+
+from Method_1_ZeroShot import ESIResponseStoppingCriteria, build_prompt, parse_esi_response
+from Metrics import METRICS
+
+METRICS.describe("esi_rl_stage_seconds", "Time spent in each RL pipeline stage per batch.")
+METRICS.describe("esi_rl_backpressure_seconds", "Time a stage waited for room in its full output queue.")
+
+_DONE = object()
+
+
+def response_mask(response: torch.Tensor, eos_token_ids: Iterable[int],
+                  stopped_at: Optional[List[Optional[int]]] = None) -> torch.Tensor:
+    """
+    Mask of the response tokens each row actually generated.
+
+    A row's response runs up to and including its first EOS token, or up to where the stopping criteria
+    ended it (stopped_at, in generated tokens), whichever is shorter; everything after is padding. The
+    pad token may be the EOS token (pad_token = eos_token), so comparing against pad_token_id would drop
+    the EOS and the policy would never learn when to stop.
+
+    Returns:
+        torch.Tensor: (batch, response length) long tensor, 1 for generated tokens.
+    """
+    length = response.shape[1]
+    positions = torch.arange(length, device=response.device)
+    is_eos = torch.isin(response, torch.tensor(list(eos_token_ids), dtype=response.dtype, device=response.device))
+    first_eos = torch.where(is_eos, positions, length).min(dim=1).values
+    lengths = (first_eos + 1).clamp(max=length)
+    if stopped_at is not None:
+        stops = torch.tensor([length if stop is None else stop for stop in stopped_at], device=response.device)
+        lengths = torch.minimum(lengths, stops)
+    return (positions.unsqueeze(0) < lengths.unsqueeze(1)).long()
+
+
+@dataclass
+class RolloutBatch:
+    """One generated batch on its way through the pipeline."""
+    step: int
+    records: List[dict]  # narrative, true_esi, predicted_esi, reasoning, parsed
+    sequences: torch.Tensor  # left-padded prompt + response ids
+    attention_mask: torch.Tensor
+    prompt_length: int
+    rewards: Optional[List[float]] = None
+
+
+class RolloutPipeline:
+    """
+    Rollout/training driver with overlapping generation, reward scoring and policy update stages.
+
+    Args:
+        model: A causal LM in training precision (not int8).
+        tokenizer: Its tokenizer; left padding is enforced.
+        reward_model: An ESITriageReward (GPT or DeepSeek). DeepSeek's score_batch is used when
+            available; otherwise compute_total_reward runs in a thread pool.
+        learning_rate (float): AdamW learning rate (ignored if an optimizer is given).
+        batch_size (int): Narratives per rollout batch.
+        max_new_tokens (int): Generation budget per response.
+        temperature (float), top_p (float): Sampling settings for rollouts.
+        queue_size (int): Capacity of each inter-stage queue (backpressure bound).
+        judge_concurrency (int): Concurrent judge requests per batch.
+        unparsed_level (int): Level assumed for responses without a parseable ESI level; 5 (least
+            urgent) is penalised hardest for under-triage.
+        max_grad_norm (float): Gradient clipping threshold.
+    """
+
+    def __init__(self, model, tokenizer, reward_model, optimizer=None, learning_rate=1e-5, batch_size=4,
+                 max_new_tokens=64, temperature=1.0, top_p=1.0, queue_size=2, judge_concurrency=16,
+                 unparsed_level=5, max_grad_norm=1.0):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        # generate() stops a row at any of the model's EOS ids (the generation config may list several)
+        eos = getattr(getattr(model, "generation_config", None), "eos_token_id", None)
+        eos = list(eos) if isinstance(eos, (list, tuple)) else [eos]
+        self.eos_token_ids = sorted({i for i in eos + [self.tokenizer.eos_token_id] if i is not None})
+        self.reward_model = reward_model
+        self.optimizer = optimizer or torch.optim.AdamW(model.parameters(), lr=learning_rate)
+        self.batch_size = batch_size
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.queue_size = queue_size
+        self.judge_concurrency = judge_concurrency
+        self.unparsed_level = unparsed_level
+        self.max_grad_norm = max_grad_norm
+        self.model_lock = threading.Lock()
+
+    # ===== Stages =====
+
+    def generate_batch(self, step: int, items: List[Tuple[str, int]]) -> RolloutBatch:
+        """Sample one response per (narrative, true_esi) item with the current policy."""
+        prompts = [build_prompt(narrative) for narrative, _ in items]
+        inputs = self.tokenizer(prompts, return_tensors="pt", padding=True).to(self.model.device)
+        prompt_length = inputs.input_ids.shape[1]
+        stopping = ESIResponseStoppingCriteria(self.tokenizer, prompt_length)
+        with self.model_lock, torch.inference_mode():
+            self.model.eval()
+            sequences = self.model.generate(
+                **inputs,
+                do_sample=True,
+                temperature=self.temperature,
+                top_p=self.top_p,
+                max_new_tokens=self.max_new_tokens,
+                pad_token_id=self.tokenizer.pad_token_id,
+                stopping_criteria=StoppingCriteriaList([stopping]),
+            )
+        response = sequences[:, prompt_length:]
+        attention_mask = torch.cat([inputs.attention_mask,
+                                    response_mask(response, self.eos_token_ids, stopping.stopped_at)], dim=1)
+
+        records = []
+        for (narrative, true_esi), ids in zip(items, response):
+            level, reasoning = parse_esi_response(self.tokenizer.decode(ids, skip_special_tokens=True))
+            records.append({"narrative": narrative, "true_esi": true_esi, "reasoning": reasoning,
+                            "predicted_esi": level if level is not None else self.unparsed_level,
+                            "parsed": level is not None})
+        return RolloutBatch(step, records, sequences.clone(), attention_mask, prompt_length)
+
+    def score_batch(self, batch: RolloutBatch) -> List[float]:
+        """Total reward per rollout from the reward model (judge calls run concurrently)."""
+        records = [{key: record[key] for key in ("true_esi", "predicted_esi", "reasoning")}
+                   for record in batch.records]
+        if hasattr(self.reward_model, "score_batch"):
+            return self.reward_model.score_batch(records, concurrency=self.judge_concurrency)
+        with ThreadPoolExecutor(max_workers=min(self.judge_concurrency, len(records))) as pool:
+            return list(pool.map(
+                lambda r: self.reward_model.compute_total_reward(r["true_esi"], r["predicted_esi"], r["reasoning"]),
+                records))
+
+    def update(self, batch: RolloutBatch) -> dict:
+        """One REINFORCE step on the batch's response tokens; returns step statistics."""
+        rewards = torch.tensor(batch.rewards, dtype=torch.float32, device=batch.sequences.device)
+        advantages = rewards - rewards.mean()
+        if len(rewards) > 1:
+            advantages = advantages / (rewards.std() + 1e-6)
+        stats = {"step": batch.step, "mean_reward": float(rewards.mean()),
+                 "parsed": sum(r["parsed"] for r in batch.records), "size": len(batch.records), "loss": 0.0}
+        if not advantages.abs().sum():
+            return stats  # identical rewards carry no learning signal
+
+        # Left padding shifts every row; positions must follow the attention mask as in generate()
+        position_ids = (batch.attention_mask.cumsum(-1) - 1).clamp(min=0)
+        response_mask = batch.attention_mask[:, batch.prompt_length:].float()
+        with self.model_lock:
+            self.model.train()
+            logits = self.model(batch.sequences, attention_mask=batch.attention_mask,
+                                position_ids=position_ids).logits[:, batch.prompt_length - 1:-1]
+            token_logprobs = torch.log_softmax(logits.float(), dim=-1).gather(
+                -1, batch.sequences[:, batch.prompt_length:].unsqueeze(-1)).squeeze(-1)
+            sequence_logprobs = (token_logprobs * response_mask).sum(1) / response_mask.sum(1).clamp(min=1.0)
+            loss = -(advantages * sequence_logprobs).mean()
+            self.optimizer.zero_grad()
+            loss.backward()
+            torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.max_grad_norm)
+            self.optimizer.step()
+            self.model.eval()
+        stats["loss"] = float(loss.detach())
+        return stats
+
+    # ===== Drivers =====
+
+    def _batches(self, dataset: Iterable[Tuple[str, int]], steps: Optional[int]):
+        items = []
+        step = 0
+        for item in dataset:
+            items.append(item)
+            if len(items) == self.batch_size:
+                yield step, items
+                items = []
+                step += 1
+                if steps is not None and step >= steps:
+                    return
+        if items:
+            yield step, items
+
+    def run_sequential(self, dataset, steps=None) -> List[dict]:
+        """Baseline without overlap: generate, score and update one batch at a time."""
+        history = []
+        for step, items in self._batches(dataset, steps):
+            started = time.perf_counter()
+            with METRICS.timer("esi_rl_stage_seconds", stage="generate"):
+                batch = self.generate_batch(step, items)
+            with METRICS.timer("esi_rl_stage_seconds", stage="score"):
+                batch.rewards = self.score_batch(batch)
+            with METRICS.timer("esi_rl_stage_seconds", stage="update"):
+                stats = self.update(batch)
+            stats["seconds"] = time.perf_counter() - started
+            history.append(stats)
+            print(f"step {step}: mean reward {stats['mean_reward']:.2f}, loss {stats['loss']:.4f}")
+        return history
+
+    def run(self, dataset: Iterable[Tuple[str, int]], steps: Optional[int] = None) -> List[dict]:
+        """
+        Run the pipelined loop over (narrative, true_esi) items until the dataset or `steps` runs out.
+
+        Generation and scoring run in worker threads; the update runs in the calling thread.
+        An exception in any stage stops the pipeline and is re-raised here.
+
+        Returns:
+            list of dict: Per-step statistics (step, mean_reward, parsed, size, loss, seconds).
+        """
+        to_score = queue.Queue(maxsize=self.queue_size)
+        to_update = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+        errors = []
+
+        def put(q, item, stage):
+            waited = time.perf_counter()
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            METRICS.observe("esi_rl_backpressure_seconds", time.perf_counter() - waited, stage=stage)
+
+        def get(q):
+            # Poll so a stage notices when another stage has failed and stopped the pipeline
+            while not stop.is_set():
+                try:
+                    return q.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+            return _DONE
+
+        def generator():
+            try:
+                for step, items in self._batches(dataset, steps):
+                    if stop.is_set():
+                        break
+                    with METRICS.timer("esi_rl_stage_seconds", stage="generate"):
+                        batch = self.generate_batch(step, items)
+                    put(to_score, batch, "generate")
+            except Exception as e:
+                errors.append(e)
+                stop.set()
+            finally:
+                put(to_score, _DONE, "generate")
+
+        def scorer():
+            try:
+                while True:
+                    batch = get(to_score)
+                    if batch is _DONE:
+                        break
+                    with METRICS.timer("esi_rl_stage_seconds", stage="score"):
+                        batch.rewards = self.score_batch(batch)
+                    put(to_update, batch, "score")
+            except Exception as e:
+                errors.append(e)
+                stop.set()
+            finally:
+                put(to_update, _DONE, "score")
+
+        workers = [threading.Thread(target=generator, daemon=True), threading.Thread(target=scorer, daemon=True)]
+        for worker in workers:
+            worker.start()
+
+        history = []
+        last = time.perf_counter()
+        try:
+            while True:
+                batch = get(to_update)
+                if batch is _DONE:
+                    break
+                with METRICS.timer("esi_rl_stage_seconds", stage="update"):
+                    stats = self.update(batch)
+                now = time.perf_counter()
+                stats["seconds"] = now - last
+                last = now
+                history.append(stats)
+                print(f"step {batch.step}: mean reward {stats['mean_reward']:.2f}, loss {stats['loss']:.4f}")
+        finally:
+            stop.set()
+            for worker in workers:
+                worker.join(timeout=5.0)
+        if errors:
+            raise errors[0]
+        return history
+
+
+if __name__ == "__main__":
+    import os
+    import itertools
+    from Benchmark_Suite import MockJudgeServer
+    from Method_1_ZeroShot import triage_cases
+    from Reward_Functions_Deepseek import ESITriageReward
+
+    parser = argparse.ArgumentParser(description="Pipelined RL rollout demo with a mock judge.")
+    parser.add_argument("--model", default=os.getenv("ESI_MODEL_NAME", "Qwen/Qwen2-1.5B"))
+    parser.add_argument("--steps", type=int, default=8)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    parser.add_argument("--queue-size", type=int, default=2)
+    parser.add_argument("--judge-latency-ms", type=float, default=300.0)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--sequential", action="store_true", help="Run without overlap, for comparison.")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    tokenizer = AutoTokenizer.from_pretrained(args.model)
+    model = AutoModelForCausalLM.from_pretrained(args.model, dtype=torch.float32)
+    dataset = itertools.cycle(zip(triage_cases, [2, 4]))  # (narrative, reference ESI level)
+
+    with MockJudgeServer(latency_ms=args.judge_latency_ms, jitter_ms=args.judge_latency_ms / 10) as server:
+        reward_model = ESITriageReward(api_url=server.url, api_key="mock-key")
+        pipeline = RolloutPipeline(model, tokenizer, reward_model, batch_size=args.batch_size,
+                                   max_new_tokens=args.max_new_tokens, queue_size=args.queue_size)
+        started = time.perf_counter()
+        if args.sequential:
+            history = pipeline.run_sequential(dataset, args.steps)
+        else:
+            history = pipeline.run(dataset, args.steps)
+        elapsed = time.perf_counter() - started
+
+    print(f"\n{len(history)} steps in {elapsed:.2f}s ({'sequential' if args.sequential else 'pipelined'})")
+    print(METRICS.to_prometheus())
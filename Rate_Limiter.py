@@ -0,0 +1,44 @@
+import time
+import threading
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket for per-minute API quotas (requests or tokens per minute).
+
+    The bucket refills continuously at rate_per_minute / 60 units per second up to capacity
+    (one minute's worth by default). acquire() blocks until enough units are available.
+    """
+
+    def __init__(self, rate_per_minute: float, capacity: float = None):
+        self.rate_per_second = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.available = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated_at) * self.rate_per_second)
+        self.updated_at = now
+
+    def acquire(self, amount: float = 1.0) -> None:
+        """Block until `amount` units can be taken from the bucket (capped at the bucket capacity)."""
+        amount = min(amount, self.capacity)
+        while True:
+            with self._lock:
+                self._refill()
+                if self.available >= amount:
+                    self.available -= amount
+                    return
+                wait = (amount - self.available) / self.rate_per_second
+            time.sleep(wait)
+
+    def adjust(self, delta: float) -> None:
+        """
+        Correct an earlier estimate once the real usage is known.
+        A positive delta takes more units (usage was higher than estimated); a negative one refunds.
+        """
+        with self._lock:
+            self._refill()
+            self.available = min(self.capacity, self.available - delta)
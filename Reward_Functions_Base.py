@@ -0,0 +1,457 @@
+import re
+import json
+from abc import ABC, abstractmethod
+import numpy as np
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Tuple, Union
+from Judge_Cache import JudgeCache
+from Rubric_Prescorer import RubricPrescorer
+from Metrics import METRICS
+
+if TYPE_CHECKING:
+    # Annotation only: importing Judge_Backends pulls in the openai and requests clients
+    from Judge_Backends import JudgeRouter
+
+# LLM-judged sub-rewards the RubricPrescorer can score locally
+LOCAL_COMPONENTS = ("alignment", "explainability")
+
+# Terms that signal the explanation acknowledges uncertainty, matched in one case-insensitive pass
+UNCERTAINTY_KEYWORDS = ["uncertain", "possibly", "might", "unsure", "ambiguous", "low confidence"]
+UNCERTAINTY_PATTERN = re.compile("|".join(re.escape(kw) for kw in UNCERTAINTY_KEYWORDS), re.IGNORECASE)
+
+
+def parse_fused_scores(content: Union[str, dict], score_ranges: Dict[str, Tuple[float, float]]) -> Dict[str, float]:
+    """
+    Parse a fused judge response into per-rubric scores.
+
+    Args:
+        content (str or dict): The judge output, either a JSON string (optionally wrapped in
+            extra text or a code fence) or an already-decoded JSON object.
+        score_ranges (dict): Documented (min, max) range for each rubric.
+
+    Returns:
+        dict: Scores for the rubrics that parsed and fall within their documented range.
+              Rubrics that are missing or invalid are left out so the caller can fall back.
+    """
+    if isinstance(content, str):
+        match = re.search(r"\{.*\}", content, re.DOTALL)
+        if match is None:
+            return {}
+        try:
+            content = json.loads(match.group(0))
+        except ValueError:
+            return {}
+    if not isinstance(content, dict):
+        return {}
+
+    scores = {}
+    for name, (low, high) in score_ranges.items():
+        try:
+            value = float(content[name])
+        except (KeyError, TypeError, ValueError):
+            continue
+        if low <= value <= high:
+            scores[name] = value
+    return scores
+
+
+class ESITriageRewardBase(ABC):
+    """
+    Backend-independent part of the ESI triage reward: weights, deterministic sub-rewards, judge prompts,
+    the prescorer cascade, threshold short-circuiting and batch scoring.
+
+    Subclasses supply the judge transport: the four per-rubric reward_* methods and call_llm_assessment_fused.
+    """
+
+    # Documented (min, max) score range of each LLM-judged sub-reward.
+    SCORE_RANGES = {
+        "alignment": (-5.0, 5.0),
+        "safety": (-2.0, 2.0),
+        "explainability": (-2.0, 2.0),
+        "bias": (-3.0, 0.0),
+    }
+
+    def __init__(self, model: str, weights: Dict[str, float] = None, fused_judge: bool = False,
+                 cache: Optional[JudgeCache] = None, prescorer: Optional[RubricPrescorer] = None,
+                 judge: Optional["JudgeRouter"] = None):
+        """
+        model is the backend's own judge model name (used in cache keys when no JudgeRouter is set);
+        the other arguments are described on the backend subclasses.
+        """
+        self.model = model
+        self.weights = {
+            "accuracy": 1.0,
+            "alignment": 1.0,
+            "safety": 1.0,
+            "explainability": 1.0,
+            "bias": 1.0,
+            "uncertainty": 1.0
+        }
+        if weights:
+            self.weights.update(weights)
+        self.fused_judge = fused_judge
+        self.cache = cache
+        self.prescorer = prescorer
+        self.judge = judge
+        self.temperature = 0  # Deterministic output
+
+    @METRICS.timed("esi_reward_component_seconds", component="accuracy")
+    def reward_accuracy(self, true_esi: int, predicted_esi: int) -> float:
+        """
+        Accuracy Reward:
+          - +10 for an exact match.
+          - If incorrect, apply a penalty proportional to the difference.
+          - Extra penalty (×2) if under–triaging (i.e., predicting a less urgent score).
+        """
+        if predicted_esi == true_esi:
+            return 10.0
+
+        diff = abs(predicted_esi - true_esi)
+        # Under–triage: predicted ESI > true ESI
+        if predicted_esi > true_esi:
+            penalty = 2 * diff
+        else:
+            penalty = diff
+        return -penalty
+
+    @staticmethod
+    def accuracy_rewards(true_esi, predicted_esi) -> np.ndarray:
+        """Vectorized reward_accuracy over arrays of levels (needs no judge, so no instance either)."""
+        diff = np.asarray(predicted_esi) - np.asarray(true_esi)
+        penalty = np.where(diff > 0, 2.0, 1.0) * np.abs(diff)  # under–triage: predicted ESI > true ESI
+        return np.where(diff == 0, 10.0, -penalty)
+
+    @METRICS.timed("esi_reward_component_seconds", component="uncertainty")
+    def reward_uncertainty_handling(self, reasoning: str, input_is_ambiguous: bool = False) -> float:
+        """
+        Handling Uncertainty Reward:
+          - When the input is ambiguous, reward if uncertainty-related terms are present.
+          - Penalize if the explanation is overconfident despite ambiguous inputs.
+        """
+        if input_is_ambiguous:
+            return 2.0 if UNCERTAINTY_PATTERN.search(reasoning) else -2.0
+        return 0.0
+
+    def cache_model(self) -> str:
+        """
+        Model name used in judge cache keys. Replies routed through a JudgeRouter may come from any of
+        its backends, so they are keyed by the router's backend set instead of this class's own model.
+        """
+        return self.judge.cache_model if self.judge is not None else self.model
+
+    # ===== Judge transport (implemented by the backend subclasses) =====
+
+    @abstractmethod
+    def reward_reasoning_alignment(self, reasoning: str) -> float:
+        """Judge score for guideline alignment (-5 to +5)."""
+
+    @abstractmethod
+    def reward_safety(self, true_esi: int, predicted_esi: int, reasoning: str) -> float:
+        """Judge score for safety and conservatism (-2 to +2)."""
+
+    @abstractmethod
+    def reward_explainability(self, reasoning: str) -> float:
+        """Judge score for clarity and structure of the explanation (-2 to +2)."""
+
+    @abstractmethod
+    def reward_bias_mitigation(self, reasoning: str) -> float:
+        """Judge score for biased demographic references (-3 to 0)."""
+
+    @abstractmethod
+    def call_llm_assessment_fused(self, true_esi: int, predicted_esi: int, reasoning: str) -> Dict[str, float]:
+        """All four judge scores from one call; only the valid ones are returned."""
+
+    # ===== Judge prompts =====
+
+    def build_alignment_prompt(self, reasoning: str) -> str:
+        """Build the judge prompt for the reasoning alignment rubric."""
+        prompt = (
+            "You are an expert medical evaluator. Please assess the following reasoning for alignment with "
+            "established Emergency Severity Index (ESI) guidelines. Consider whether the explanation includes "
+            "relevant factors such as vital signs, chief complaint, and resource utilization. Rate the alignment "
+            "on a scale from -5 (poor alignment) to +5 (excellent alignment). Return only the numerical score.\n\n"
+            f"Reasoning: {reasoning}"
+        )
+        return prompt
+
+    def build_safety_prompt(self, true_esi: int, predicted_esi: int, reasoning: str) -> str:
+        """Build the judge prompt for the safety rubric."""
+        prompt = (
+            "You are an expert medical evaluator. Evaluate the safety of the following triage decision. "
+            "The true Emergency Severity Index (ESI) is provided along with the predicted ESI and the reasoning behind the prediction. "
+            "A safe decision should err on the side of caution (i.e., not under–triaging). "
+            "Rate the safety of the decision on a scale from -2 (unsafe, under–triage) to +2 (safe, conservative decision). "
+            "Return only the numerical score.\n\n"
+            f"True ESI: {true_esi}\nPredicted ESI: {predicted_esi}\nReasoning: {reasoning}"
+        )
+        return prompt
+
+    def build_explainability_prompt(self, reasoning: str) -> str:
+        """Build the judge prompt for the explainability rubric."""
+        prompt = (
+            "You are an expert medical evaluator. Please assess the following explanation for clarity, conciseness, "
+            "and logical structure on a scale from -2 (poor) to +2 (excellent). Return only the numerical score.\n\n"
+            f"Explanation: {reasoning}"
+        )
+        return prompt
+
+    def build_bias_prompt(self, reasoning: str) -> str:
+        """Build the judge prompt for the bias rubric."""
+        prompt = (
+            "You are an expert in medical ethics. Please assess the following explanation for any unnecessary or biased "
+            "references to sensitive demographic information (e.g., race, ethnicity, gender, age, etc.). "
+            "Rate the explanation on a scale from -3 (highly biased) to 0 (bias-free). Return only the numerical score.\n\n"
+            f"Explanation: {reasoning}"
+        )
+        return prompt
+
+    def build_fused_prompt(self, true_esi: int, predicted_esi: int, reasoning: str) -> str:
+        """Build the judge prompt that requests all four rubric scores as one JSON object."""
+        prompt = (
+            "You are an expert medical evaluator. Assess the following triage decision and its reasoning on four rubrics:\n"
+            "- alignment: alignment with established Emergency Severity Index (ESI) guidelines, considering whether the "
+            "explanation includes relevant factors such as vital signs, chief complaint, and resource utilization, "
+            "from -5 (poor alignment) to +5 (excellent alignment).\n"
+            "- safety: whether the decision errs on the side of caution (i.e., not under–triaging), "
+            "from -2 (unsafe, under–triage) to +2 (safe, conservative decision).\n"
+            "- explainability: clarity, conciseness, and logical structure of the explanation, "
+            "from -2 (poor) to +2 (excellent).\n"
+            "- bias: unnecessary or biased references to sensitive demographic information (e.g., race, ethnicity, "
+            "gender, age, etc.), from -3 (highly biased) to 0 (bias-free).\n"
+            "Return only a JSON object of the form "
+            '{"alignment": <score>, "safety": <score>, "explainability": <score>, "bias": <score>}.\n\n'
+            f"True ESI: {true_esi}\nPredicted ESI: {predicted_esi}\nReasoning: {reasoning}"
+        )
+        return prompt
+
+    def checked_fused_scores(self, content: Union[str, dict, None]) -> Dict[str, float]:
+        """Parse a fused judge reply against SCORE_RANGES and count replies missing any rubric."""
+        scores = parse_fused_scores(content, self.SCORE_RANGES) if content is not None else {}
+        if len(scores) < len(self.SCORE_RANGES):
+            METRICS.inc("esi_fused_judge_incomplete_total")
+        return scores
+
+    # ===== Judge cascade =====
+
+    def prescore_locally(self, predicted_esi: int, reasoning: str) -> Dict[str, float]:
+        """
+        First stage of the judge cascade: score the reasoning against the rubric locally.
+        Returns alignment and explainability for clear-cut cases, or an empty dict when there is
+        no prescorer or the case is ambiguous (so those rubrics go to the judge).
+        """
+        if self.prescorer is None:
+            return {}
+        rubric = self.prescorer.score(reasoning, predicted_esi)
+        if not rubric.clear_cut:
+            METRICS.inc("esi_prescorer_cases_total", outcome="judge")
+            return {}
+        METRICS.inc("esi_prescorer_cases_total", outcome="local")
+        scores = {"alignment": rubric.alignment(), "explainability": rubric.explainability()}
+        return {name: scores[name] for name in LOCAL_COMPONENTS}
+
+    def local_scores(self, predicted_esi: int, reasoning: str, components: List[str]) -> Dict[str, float]:
+        """
+        Prescorer scores for the requested components (empty if none of them can be scored locally).
+
+        Only alignment and explainability have a local scorer. In fused mode one judge call returns every
+        rubric anyway, so local scores would save no call and only replace the judge's scores; the
+        prescorer is then used only when it covers all requested components (e.g., safety and bias
+        weighted 0).
+        """
+        if not any(name in LOCAL_COMPONENTS for name in components):
+            return {}
+        if self.fused_judge and not set(components) <= set(LOCAL_COMPONENTS):
+            return {}
+        return {name: value for name, value in self.prescore_locally(predicted_esi, reasoning).items()
+                if name in components}
+
+    def active_judge_components(self) -> List[str]:
+        """LLM-judged sub-rewards with a non-zero weight (the only ones worth a judge call)."""
+        return [name for name in self.SCORE_RANGES if self.weights[name] != 0]
+
+    def needs_fused_call(self, scores: Dict[str, float], components: List[str]) -> bool:
+        """Whether a fused judge call is due: fused mode and some requested rubric is still unscored."""
+        return self.fused_judge and any(name not in scores for name in components)
+
+    @staticmethod
+    def merge_scores(scores: Dict[str, float], judged: Dict[str, float], components: List[str]) -> None:
+        """Add the judged scores for requested components to scores, keeping scores already present."""
+        for name, value in judged.items():
+            if name in components:
+                scores.setdefault(name, value)
+
+    def build_component_prompt(self, name: str, true_esi: int, predicted_esi: int, reasoning: str) -> str:
+        """Build the per-rubric judge prompt for one LLM-judged sub-reward."""
+        if name == "alignment":
+            return self.build_alignment_prompt(reasoning)
+        if name == "safety":
+            return self.build_safety_prompt(true_esi, predicted_esi, reasoning)
+        if name == "explainability":
+            return self.build_explainability_prompt(reasoning)
+        if name == "bias":
+            return self.build_bias_prompt(reasoning)
+        raise ValueError(f"Unknown judged sub-reward: {name}")
+
+    def judge_component(self, name: str, true_esi: int, predicted_esi: int, reasoning: str) -> float:
+        """Score one LLM-judged sub-reward with its per-rubric call."""
+        if name == "alignment":
+            return self.reward_reasoning_alignment(reasoning)
+        if name == "safety":
+            return self.reward_safety(true_esi, predicted_esi, reasoning)
+        if name == "explainability":
+            return self.reward_explainability(reasoning)
+        if name == "bias":
+            return self.reward_bias_mitigation(reasoning)
+        raise ValueError(f"Unknown judged sub-reward: {name}")
+
+    def llm_judge_scores(self, true_esi: int, predicted_esi: int, reasoning: str,
+                         components: Optional[Iterable[str]] = None) -> Dict[str, float]:
+        """
+        Collect the LLM-judged sub-rewards (alignment, safety, explainability, bias).
+          - components limits which rubrics are scored (default: all four).
+          - With a prescorer, clear-cut cases get alignment and explainability locally
+            (in fused mode only when no other rubric is requested; see local_scores).
+          - In fused mode, a single judge call returns all requested scores.
+          - Any score that is missing, unparsable or out of range falls back to its per-rubric call.
+        """
+        components = list(self.SCORE_RANGES) if components is None else list(components)
+        scores = self.local_scores(predicted_esi, reasoning, components)
+        if self.needs_fused_call(scores, components):
+            self.merge_scores(scores, self.call_llm_assessment_fused(true_esi, predicted_esi, reasoning), components)
+        for name in components:
+            if name not in scores:
+                scores[name] = self.judge_component(name, true_esi, predicted_esi, reasoning)
+        return scores
+
+    # ===== Totals =====
+
+    def deterministic_reward(self, true_esi: int, predicted_esi: int, reasoning: str,
+                             input_is_ambiguous: bool = False) -> float:
+        """Weighted accuracy + uncertainty sub-rewards (no judge calls); zero-weight terms are skipped."""
+        total = 0.0
+        if self.weights["accuracy"]:
+            total += self.weights["accuracy"] * self.reward_accuracy(true_esi, predicted_esi)
+        if self.weights["uncertainty"]:
+            total += self.weights["uncertainty"] * self.reward_uncertainty_handling(reasoning, input_is_ambiguous)
+        return total
+
+    def _judged_bounds(self, names: Iterable[str]) -> Tuple[float, float]:
+        """Lowest and highest weighted contribution the given LLM sub-rewards can still add."""
+        low = high = 0.0
+        for name in names:
+            a, b = (self.weights[name] * bound for bound in self.SCORE_RANGES[name])
+            low += min(a, b)
+            high += max(a, b)
+        return low, high
+
+    def passes_threshold(self, true_esi: int, predicted_esi: int, reasoning: str, threshold: float,
+                         input_is_ambiguous: bool = False) -> bool:
+        """
+        Decide whether the total reward is >= threshold with as few judge calls as possible
+        (e.g., for rejection sampling, where only the threshold decision matters).
+          - Deterministic sub-rewards and local prescorer scores are counted first.
+          - Each unjudged LLM sub-reward is bounded by its SCORE_RANGES; judging stops as soon as
+            the total is provably above or below the threshold.
+          - Remaining rubrics are judged widest weighted range first (one fused call in fused mode).
+        """
+        base = self.deterministic_reward(true_esi, predicted_esi, reasoning, input_is_ambiguous)
+        active = self.active_judge_components()
+        judged = self.local_scores(predicted_esi, reasoning, active)
+
+        def width(name):
+            low, high = self._judged_bounds([name])
+            return high - low
+
+        pending = sorted((name for name in active if name not in judged), key=width, reverse=True)
+
+        fused_tried = not self.fused_judge
+        while True:
+            total = self._partial_total(base, judged)
+            low, high = self._judged_bounds(pending)
+            if total + low >= threshold or total + high < threshold:
+                if pending:
+                    METRICS.inc("esi_reward_judge_skipped_total", len(pending))
+                return total + low >= threshold
+            if not fused_tried:
+                fused_tried = True
+                self.merge_scores(judged, self.call_llm_assessment_fused(true_esi, predicted_esi, reasoning), pending)
+                pending = [name for name in pending if name not in judged]
+                continue
+            name = pending.pop(0)
+            judged[name] = self.judge_component(name, true_esi, predicted_esi, reasoning)
+
+    def _partial_total(self, base: float, judged: Dict[str, float]) -> float:
+        """
+        base plus the weighted judged sub-rewards, added in the same order as combine_rewards so a fully
+        judged total is bit-for-bit the compute_total_reward total (the threshold decision then agrees
+        even when the total equals the threshold).
+        """
+        total = base
+        for name in self.active_judge_components():
+            if name in judged:
+                total += self.weights[name] * judged[name]
+        return total
+
+    def combine_rewards(self, true_esi: int, predicted_esi: int, reasoning: str,
+                        input_is_ambiguous: bool, judged: Dict[str, float]) -> float:
+        """
+        Weighted sum of the deterministic sub-rewards and the already-judged LLM sub-rewards.
+        Zero-weight sub-rewards are skipped and need not be present in judged.
+        """
+        total_reward = self.deterministic_reward(true_esi, predicted_esi, reasoning, input_is_ambiguous)
+        for name in self.active_judge_components():
+            total_reward += self.weights[name] * judged[name]
+        return total_reward
+
+    def compute_total_reward(self, true_esi: int, predicted_esi: int,
+                             reasoning: str, input_is_ambiguous: bool = False) -> float:
+        """
+        Compute the total reward as the weighted sum of all sub-rewards.
+        Zero-weight sub-rewards are skipped (no judge call is made for them).
+        """
+        judged = self.llm_judge_scores(true_esi, predicted_esi, reasoning, self.active_judge_components())
+        return self.combine_rewards(true_esi, predicted_esi, reasoning, input_is_ambiguous, judged)
+
+    def judge_records(self, records: List[dict], concurrency: int = 16) -> List[Dict[str, float]]:
+        """
+        Non-zero-weight LLM-judged sub-rewards for each record ("true_esi", "predicted_esi", "reasoning"),
+        in input order. Scores one record after another; backends with a concurrent client override this.
+        """
+        return [self.llm_judge_scores(record["true_esi"], record["predicted_esi"], record["reasoning"],
+                                      self.active_judge_components())
+                for record in records]
+
+    def compute_rewards_batch(self, true_esi, predicted_esi, reasonings=None, input_is_ambiguous=None,
+                              include_judge: bool = False, concurrency: int = 16) -> Dict[str, np.ndarray]:
+        """
+        Vectorized deterministic sub-rewards for a whole batch of rollouts.
+          - Accuracy: +10 for an exact match, otherwise -|diff|, doubled for under–triage.
+          - Uncertainty: +2/-2 for ambiguous inputs depending on uncertainty terms, 0 otherwise.
+          - With include_judge, the non-zero-weight LLM-judged sub-rewards are added per sample
+            via judge_records (concurrency is used by backends that judge concurrently).
+        Returns a dict of NumPy arrays (raw sub-rewards plus the weighted "total").
+        """
+        true_esi = np.asarray(true_esi)
+        predicted_esi = np.asarray(predicted_esi)
+        accuracy = self.accuracy_rewards(true_esi, predicted_esi)
+
+        uncertainty = np.zeros(len(accuracy))
+        if input_is_ambiguous is not None:
+            ambiguous = np.asarray(input_is_ambiguous, dtype=bool)
+            if ambiguous.any() and reasonings is None:
+                raise ValueError("reasonings are required when any input is ambiguous")
+            for i in np.flatnonzero(ambiguous):
+                uncertainty[i] = 2.0 if UNCERTAINTY_PATTERN.search(reasonings[i]) else -2.0
+
+        rewards = {"accuracy": accuracy, "uncertainty": uncertainty}
+        total = self.weights["accuracy"] * accuracy + self.weights["uncertainty"] * uncertainty
+        if include_judge:
+            if reasonings is None:
+                raise ValueError("reasonings are required when include_judge is True")
+            records = [{"true_esi": int(t), "predicted_esi": int(p), "reasoning": r}
+                       for t, p, r in zip(true_esi, predicted_esi, reasonings)]
+            judged = self.judge_records(records, concurrency)
+            for name in self.active_judge_components():
+                rewards[name] = np.array([scores[name] for scores in judged], dtype=float)
+                total = total + self.weights[name] * rewards[name]
+        rewards["total"] = total
+        return rewards
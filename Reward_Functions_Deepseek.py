@@ -1,61 +1,60 @@
-import re
 import os
+import json
+import random
+import asyncio
+import aiohttp
 import requests
-from typing import Dict
+from typing import Dict, Iterable, List, Optional
+from Judge_Backends import JudgeRouter, deepseek_reply_content
+from Judge_Cache import JudgeCache
+from Reward_Functions_Base import ESITriageRewardBase
+from Rubric_Prescorer import RubricPrescorer
+from Metrics import METRICS, backend_call, record_usage
 
-class ESITriageReward:
-    def __init__(self, weights: Dict[str, float] = None):
+# HTTP statuses that are worth retrying (rate limiting and transient server errors).
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class ESITriageReward(ESITriageRewardBase):
+    def __init__(self, weights: Dict[str, float] = None, fused_judge: bool = False,
+                 api_url: str = None, api_key: str = None, cache: Optional[JudgeCache] = None,
+                 prescorer: Optional[RubricPrescorer] = None, judge: Optional[JudgeRouter] = None,
+                 timeout: float = 120.0):
         """
         Initialize the reward model with optional weights for each sub-reward.
         Default weights are set to 1.0 for all reward types.
+        If fused_judge is True, the four LLM-judged sub-rewards are requested from DeepSeek-R1
+        in a single structured (JSON) call instead of one call per rubric.
+        api_url and api_key override the environment variables (e.g., to point at a local mock server).
+        If a JudgeCache is given, DeepSeek-R1 responses are looked up there before calling the API.
+        If a RubricPrescorer is given, clear-cut reasonings get their alignment and explainability
+        scores locally and only ambiguous ones are sent to DeepSeek-R1 for those rubrics.
+        With fused_judge the prescorer is only used when alignment and explainability are the only
+        non-zero-weight judged rubrics, since the fused call scores every rubric anyway.
+        If a JudgeRouter is given, judge prompts go through it (routing and hedging across its
+        backends) instead of straight to api_url.
+        timeout is the per-request timeout in seconds for blocking DeepSeek-R1 calls.
         """
-        self.weights = {
-            "accuracy": 1.0,
-            "alignment": 1.0,
-            "safety": 1.0,
-            "explainability": 1.0,
-            "bias": 1.0,
-            "uncertainty": 1.0
-        }
-        if weights:
-            self.weights.update(weights)
-        
-        # Set the DeepSeek-R1 API endpoint and API key from environment variables
-        self.api_url = os.getenv("DEEPSEEK_R1_API_URL", "https://api.microsoftai-foundry.com/deepseek-r1")
-        self.api_key = os.getenv("DEEPSEEK_R1_API_KEY", "YOUR_API_KEY")
+        super().__init__("deepseek-r1", weights, fused_judge, cache, prescorer, judge)
 
-    def reward_accuracy(self, true_esi: int, predicted_esi: int) -> float:
-        """
-        Accuracy Reward:
-          - +10 for an exact match.
-          - If incorrect, apply a penalty proportional to the difference.
-          - Extra penalty (×2) if under–triaging (i.e., predicting a less urgent score).
-        """
-        if predicted_esi == true_esi:
-            return 10.0
+        # Set the DeepSeek-R1 API endpoint and API key from environment variables
+        self.api_url = api_url or os.getenv("DEEPSEEK_R1_API_URL", "https://api.microsoftai-foundry.com/deepseek-r1")
+        self.api_key = api_key or os.getenv("DEEPSEEK_R1_API_KEY", "YOUR_API_KEY")
 
-        diff = abs(predicted_esi - true_esi)
-        if predicted_esi > true_esi:  # under–triage: predicted less urgent than true
-            penalty = 2 * diff
-        else:
-            penalty = diff
-        return -penalty
+        # Reuse keep-alive connections across blocking calls
+        self.session = requests.Session()
+        self.timeout = timeout
 
+    @METRICS.timed("esi_reward_component_seconds", component="alignment")
     def reward_reasoning_alignment(self, reasoning: str) -> float:
         """
         Reasoning Alignment Reward:
           - Uses DeepSeek-R1 to assess whether the reasoning aligns with established ESI guidelines.
           - Expected score scale is, for example, from -5 (poor alignment) to +5 (excellent alignment).
         """
-        prompt = (
-            "You are an expert medical evaluator. Please assess the following reasoning for alignment with "
-            "established Emergency Severity Index (ESI) guidelines. Consider whether the explanation includes "
-            "relevant factors such as vital signs, chief complaint, and resource utilization. Rate the alignment "
-            "on a scale from -5 (poor alignment) to +5 (excellent alignment). Return only the numerical score.\n\n"
-            f"Reasoning: {reasoning}"
-        )
-        return self.call_deepseek_api(prompt)
+        return self.call_deepseek_api(self.build_alignment_prompt(reasoning), component="alignment")
 
+    @METRICS.timed("esi_reward_component_seconds", component="safety")
     def reward_safety(self, true_esi: int, predicted_esi: int, reasoning: str) -> float:
         """
         Safety and Conservatism Reward:
@@ -63,16 +62,9 @@ class ESITriageReward:
           - The LLM considers both the difference between the true and predicted ESI and whether the reasoning errs on the side of caution.
           - Expected score scale is, for example, from -2 (unsafe, under–triage) to +2 (safe, conservative decision).
         """
-        prompt = (
-            "You are an expert medical evaluator. Evaluate the safety of the following triage decision. "
-            "The true Emergency Severity Index (ESI) is provided along with the predicted ESI and the reasoning behind the prediction. "
-            "A safe decision should err on the side of caution (i.e., not under–triaging). "
-            "Rate the safety of the decision on a scale from -2 (unsafe, under–triage) to +2 (safe, conservative decision). "
-            "Return only the numerical score.\n\n"
-            f"True ESI: {true_esi}\nPredicted ESI: {predicted_esi}\nReasoning: {reasoning}"
-        )
-        return self.call_deepseek_api(prompt)
+        return self.call_deepseek_api(self.build_safety_prompt(true_esi, predicted_esi, reasoning), component="safety")
 
+    @METRICS.timed("esi_reward_component_seconds", component="explainability")
     def reward_explainability(self, reasoning: str) -> float:
         """
         Transparency and Explainability Reward:
@@ -80,82 +72,266 @@ class ESITriageReward:
           - The prompt instructs DeepSeek-R1 to evaluate clarity, conciseness, and logical structure,
             returning a numerical score on a scale from -2 (poor) to +2 (excellent).
         """
-        prompt = (
-            "You are an expert medical evaluator. Please assess the following explanation for clarity, conciseness, "
-            "and logical structure on a scale from -2 (poor) to +2 (excellent). Return only the numerical score.\n\n"
-            f"Explanation: {reasoning}"
-        )
-        return self.call_deepseek_api(prompt)
+        return self.call_deepseek_api(self.build_explainability_prompt(reasoning), component="explainability")
 
+    @METRICS.timed("esi_reward_component_seconds", component="bias")
     def reward_bias_mitigation(self, reasoning: str) -> float:
         """
         Bias Mitigation Reward:
           - Uses DeepSeek-R1 to assess the explanation for any unnecessary or biased references to sensitive demographic information.
           - Expected scale is from -3 (highly biased) to 0 (bias-free).
         """
-        prompt = (
-            "You are an expert in medical ethics. Please assess the following explanation for any unnecessary or biased "
-            "references to sensitive demographic information (e.g., race, ethnicity, gender, age, etc.). "
-            "Rate the explanation on a scale from -3 (highly biased) to 0 (bias-free). Return only the numerical score.\n\n"
-            f"Explanation: {reasoning}"
-        )
-        return self.call_deepseek_api(prompt)
+        return self.call_deepseek_api(self.build_bias_prompt(reasoning), component="bias")
+
+    def _request_headers(self) -> Dict[str, str]:
+        return {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json"
+        }
+
+    def _request_payload(self, prompt: str) -> dict:
+        return {
+            "prompt": prompt,
+            "model": self.model,
+            "temperature": self.temperature
+        }
+
+    def _cache_get(self, prompt: str) -> Optional[dict]:
+        if self.cache is None:
+            return None
+        cached = self.cache.get(prompt, self.cache_model(), self.temperature)
+        return json.loads(cached) if cached is not None else None
+
+    def _cache_put(self, prompt: str, result: dict) -> None:
+        if self.cache is not None:
+            self.cache.put(prompt, self.cache_model(), self.temperature, json.dumps(result))
+
+    @staticmethod
+    def _judge_result(content: str) -> dict:
+        # A routed reply is plain text; expose it under the keys the response parsers read
+        return {"text": content, "score": content}
 
-    def reward_uncertainty_handling(self, reasoning: str, input_is_ambiguous: bool = False) -> float:
+    def post_deepseek_api(self, prompt: str) -> dict:
         """
-        Handling Uncertainty Reward:
-          - When the input is ambiguous, this function checks for the presence of uncertainty-related terms.
-          - Rewards the inclusion of such terms (score +2) and penalizes their absence (score -2) when ambiguity is flagged.
+        Sends a prompt to the DeepSeek-R1 API and returns the decoded JSON response.
+        Responses are served from / stored in the judge cache when one is configured.
+        Raises on HTTP or decoding errors; callers decide how to fall back.
         """
-        uncertainty_keywords = ["uncertain", "possibly", "might", "unsure", "ambiguous", "low confidence"]
-        if input_is_ambiguous:
-            return 2.0 if any(kw in reasoning.lower() for kw in uncertainty_keywords) else -2.0
-        return 0.0
+        cached = self._cache_get(prompt)
+        if cached is not None:
+            return cached
+        if self.judge is not None:
+            result = self._judge_result(self.judge.complete(prompt))
+            self._cache_put(prompt, result)
+            return result
+        with backend_call("deepseek"):
+            response = self.session.post(self.api_url, headers=self._request_headers(),
+                                         json=self._request_payload(prompt), timeout=self.timeout)
+            response.raise_for_status()
+            result = response.json()
+        record_usage("deepseek", result.get("usage"))
+        self._cache_put(prompt, result)
+        return result
 
-    def call_deepseek_api(self, prompt: str) -> float:
+    def call_deepseek_api(self, prompt: str, component: str = "unknown") -> float:
         """
         Sends a prompt to the DeepSeek-R1 API and returns the numerical score.
         Adjust the request payload and response parsing as needed to match the API specification.
+        Failures score 0.0 and are counted under esi_reward_fallback_total for the given component.
         """
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json"
-        }
-        payload = {
-            "prompt": prompt,
-            "model": "deepseek-r1",
-            "temperature": 0  # For deterministic output
-        }
         try:
-            response = requests.post(self.api_url, headers=headers, json=payload)
-            response.raise_for_status()
-            result = response.json()
+            result = self.post_deepseek_api(prompt)
             # Assuming the API returns a JSON object like: {"score": "1.5"} or {"score": 1.5}
             score_value = result.get("score")
             score = float(score_value)
         except Exception as e:
             print("Error calling DeepSeek-R1 API:", e)
+            METRICS.inc("esi_reward_fallback_total", component=component)
             score = 0.0
         return score
 
-    def compute_total_reward(self, true_esi: int, predicted_esi: int,
-                             reasoning: str, input_is_ambiguous: bool = False) -> float:
+    @METRICS.timed("esi_reward_component_seconds", component="fused")
+    def call_llm_assessment_fused(self, true_esi: int, predicted_esi: int, reasoning: str) -> Dict[str, float]:
         """
-        Compute the total reward as the weighted sum of all sub-rewards.
+        Call DeepSeek-R1 once to assess alignment, safety, explainability and bias together.
+        The model is asked for a JSON object with one score per rubric; each score is checked
+        against its documented range in SCORE_RANGES.
+        Returns the valid scores only (an empty dict if the call or parsing fails).
         """
-        r_acc         = self.weights["accuracy"] * self.reward_accuracy(true_esi, predicted_esi)
-        r_alignment   = self.weights["alignment"] * self.reward_reasoning_alignment(reasoning)
-        r_safety      = self.weights["safety"] * self.reward_safety(true_esi, predicted_esi, reasoning)
-        r_explain     = self.weights["explainability"] * self.reward_explainability(reasoning)
-        r_bias        = self.weights["bias"] * self.reward_bias_mitigation(reasoning)
-        r_uncertainty = self.weights["uncertainty"] * self.reward_uncertainty_handling(reasoning, input_is_ambiguous)
+        prompt = self.build_fused_prompt(true_esi, predicted_esi, reasoning)
+        try:
+            content = deepseek_reply_content(self.post_deepseek_api(prompt))
+        except Exception as e:
+            print("Error calling DeepSeek-R1 API for fused assessment:", e)
+            content = None
+        return self.checked_fused_scores(content)
+
+    def judge_records(self, records: List[dict], concurrency: int = 16) -> List[Dict[str, float]]:
+        """Judge a batch of records with concurrent async calls (see judge_batch_async)."""
+        return asyncio.run(self.judge_batch_async(records, concurrency))
 
-        total_reward = r_acc + r_alignment + r_safety + r_explain + r_bias + r_uncertainty
-        return total_reward
+    # ===== Async batch scoring =====
+
+    async def post_deepseek_api_async(self, session: aiohttp.ClientSession, semaphore: asyncio.Semaphore,
+                                      prompt: str, max_retries: int = 5, backoff_base: float = 0.5,
+                                      backoff_max: float = 30.0) -> dict:
+        """
+        Async counterpart of post_deepseek_api.
+          - The semaphore caps the number of in-flight requests; it is released while backing off.
+          - 429 and 5xx responses (and connection errors) are retried with full-jitter exponential backoff,
+            honouring a numeric Retry-After header when the server sends one.
+        Raises once the retries are exhausted or on any other HTTP error.
+        """
+        cached = self._cache_get(prompt)
+        if cached is not None:
+            return cached
+        if self.judge is not None:
+            # The router retries across its backends; run its blocking call off the event loop
+            async with semaphore:
+                content = await asyncio.get_running_loop().run_in_executor(None, self.judge.complete, prompt)
+            result = self._judge_result(content)
+            self._cache_put(prompt, result)
+            return result
+        for attempt in range(max_retries + 1):
+            delay = random.uniform(0, min(backoff_max, backoff_base * (2 ** attempt)))
+            try:
+                async with semaphore:
+                    with backend_call("deepseek"):
+                        async with session.post(self.api_url, headers=self._request_headers(),
+                                                json=self._request_payload(prompt)) as response:
+                            if response.status in RETRY_STATUSES and attempt < max_retries:
+                                retry_after = response.headers.get("Retry-After", "")
+                                if retry_after.replace(".", "", 1).isdigit():
+                                    delay = min(backoff_max, float(retry_after))
+                                result = None
+                            else:
+                                response.raise_for_status()
+                                result = await response.json(content_type=None)
+                if result is not None:
+                    record_usage("deepseek", result.get("usage"))
+                    self._cache_put(prompt, result)
+                    return result
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt == max_retries:
+                    raise
+            METRICS.inc("esi_backend_retries_total", backend="deepseek")
+            await asyncio.sleep(delay)
+        raise RuntimeError("DeepSeek-R1 API retries exhausted")
+
+    async def call_deepseek_api_async(self, session: aiohttp.ClientSession, semaphore: asyncio.Semaphore,
+                                      prompt: str, max_retries: int = 5, component: str = "unknown") -> float:
+        """
+        Async counterpart of call_deepseek_api; returns 0.0 if the call ultimately fails.
+        """
+        try:
+            result = await self.post_deepseek_api_async(session, semaphore, prompt, max_retries)
+            score = float(result.get("score"))
+        except Exception as e:
+            print("Error calling DeepSeek-R1 API:", e)
+            METRICS.inc("esi_reward_fallback_total", component=component)
+            score = 0.0
+        return score
+
+    async def call_llm_assessment_fused_async(self, session: aiohttp.ClientSession, semaphore: asyncio.Semaphore,
+                                              true_esi: int, predicted_esi: int, reasoning: str,
+                                              max_retries: int = 5) -> Dict[str, float]:
+        """
+        Async counterpart of call_llm_assessment_fused; returns the valid scores only.
+        """
+        prompt = self.build_fused_prompt(true_esi, predicted_esi, reasoning)
+        try:
+            content = deepseek_reply_content(
+                await self.post_deepseek_api_async(session, semaphore, prompt, max_retries))
+        except Exception as e:
+            print("Error calling DeepSeek-R1 API for fused assessment:", e)
+            content = None
+        return self.checked_fused_scores(content)
+
+    async def llm_judge_scores_async(self, session: aiohttp.ClientSession, semaphore: asyncio.Semaphore,
+                                     true_esi: int, predicted_esi: int, reasoning: str,
+                                     max_retries: int = 5, components: Optional[Iterable[str]] = None) -> Dict[str, float]:
+        """
+        Async counterpart of llm_judge_scores; per-rubric fallback calls are issued concurrently.
+        """
+        components = list(self.SCORE_RANGES) if components is None else list(components)
+        scores = self.local_scores(predicted_esi, reasoning, components)
+        if self.needs_fused_call(scores, components):
+            fused = await self.call_llm_assessment_fused_async(session, semaphore, true_esi, predicted_esi,
+                                                               reasoning, max_retries)
+            self.merge_scores(scores, fused, components)
+
+        missing = [name for name in components if name not in scores]
+        values = await asyncio.gather(*[
+            self.call_deepseek_api_async(session, semaphore,
+                                         self.build_component_prompt(name, true_esi, predicted_esi, reasoning),
+                                         max_retries, component=name)
+            for name in missing
+        ])
+        scores.update(zip(missing, values))
+        return scores
+
+    async def judge_batch_async(self, records: List[dict], concurrency: int = 16,
+                                max_retries: int = 5, timeout: float = 120.0) -> List[Dict[str, float]]:
+        """
+        Fetch the non-zero-weight LLM-judged sub-rewards for many records concurrently over a shared pool of
+        keep-alive connections. Returns one score dict per record, in input order.
+
+        A fixed pool of `concurrency` workers takes records one at a time, so only that many records
+        (each with at most one request per rubric) are in flight and memory stays flat for large batches.
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+        connector = aiohttp.TCPConnector(limit=concurrency)
+        client_timeout = aiohttp.ClientTimeout(total=timeout)
+        components = self.active_judge_components()
+        results = [None] * len(records)
+        pending = iter(enumerate(records))
+
+        async def worker():
+            # Single-threaded event loop: next() on the shared iterator needs no lock
+            for i, record in pending:
+                results[i] = await self.llm_judge_scores_async(
+                    session, semaphore, record["true_esi"], record["predicted_esi"], record["reasoning"],
+                    max_retries, components)
+
+        async with aiohttp.ClientSession(connector=connector, timeout=client_timeout) as session:
+            await asyncio.gather(*[worker() for _ in range(min(concurrency, len(records)))])
+        return results
+
+    async def score_batch_async(self, records: List[dict], concurrency: int = 16,
+                                max_retries: int = 5, timeout: float = 120.0) -> List[float]:
+        """
+        Score many samples concurrently over a shared pool of keep-alive connections.
+
+        Args:
+            records (list of dict): Each record has "true_esi", "predicted_esi", "reasoning"
+                and optionally "input_is_ambiguous".
+            concurrency (int): Maximum number of in-flight requests to the DeepSeek-R1 API.
+            max_retries (int): Retries per request on 429/5xx responses and connection errors.
+            timeout (float): Total timeout in seconds for a single request.
+
+        Returns:
+            list of float: Total rewards, in the same order as the input records.
+        """
+        judged = await self.judge_batch_async(records, concurrency, max_retries, timeout)
+        return [
+            self.combine_rewards(record["true_esi"], record["predicted_esi"], record["reasoning"],
+                                 record.get("input_is_ambiguous", False), scores)
+            for record, scores in zip(records, judged)
+        ]
+
+    def score_batch(self, records: List[dict], concurrency: int = 16,
+                    max_retries: int = 5, timeout: float = 120.0) -> List[float]:
+        """
+        Blocking wrapper around score_batch_async for use from synchronous code.
+        Returns total rewards in input order.
+        """
+        return asyncio.run(self.score_batch_async(records, concurrency, max_retries, timeout))
 
 # ===== Example usage =====
 if __name__ == "__main__":
     # Optionally set DEEPSEEK_R1_API_URL and DEEPSEEK_R1_API_KEY as environment variables.
+    # Set fused_judge=True to score all four LLM rubrics in one DeepSeek-R1 call, and
+    # pass cache=JudgeCache("judge_cache.sqlite") to avoid re-querying the judge on re-runs.
     reward_model = ESITriageReward()
 
     # Example inputs:
@@ -170,3 +346,14 @@ if __name__ == "__main__":
 
     total = reward_model.compute_total_reward(true_esi, predicted_esi, reasoning, input_is_ambiguous)
     print("Total reward:", total)
+
+    # Score a whole dataset concurrently (results come back in input order).
+    records = [
+        {"true_esi": true_esi, "predicted_esi": predicted_esi, "reasoning": reasoning,
+         "input_is_ambiguous": input_is_ambiguous},
+        {"true_esi": 4, "predicted_esi": 4, "reasoning": "Stable vitals; one resource (X-ray) expected."},
+    ]
+    print("Batch rewards:", reward_model.score_batch(records, concurrency=8))
+
+    # Per-component latency, backend usage, retries and fallback counts (also available as METRICS.to_json())
+    print(METRICS.to_prometheus())
@@ -1,42 +1,32 @@
-import re
-from typing import Dict
+from typing import Dict, Optional
 import openai  # Ensure you have installed the openai package and set your API key
+from Judge_Backends import JudgeRouter
+from Judge_Cache import JudgeCache
+from Reward_Functions_Base import ESITriageRewardBase
+from Rubric_Prescorer import RubricPrescorer
+from Metrics import METRICS, backend_call, record_usage
 
-class ESITriageReward:
-    def __init__(self, weights: Dict[str, float] = None):
+
+class ESITriageReward(ESITriageRewardBase):
+    def __init__(self, weights: Dict[str, float] = None, fused_judge: bool = False,
+                 cache: Optional[JudgeCache] = None, prescorer: Optional[RubricPrescorer] = None,
+                 judge: Optional[JudgeRouter] = None):
         """
         Initialize with optional weights for each sub-reward.
         Default weights are set to 1.0 for all reward types.
-        """
-        self.weights = {
-            "accuracy": 1.0,
-            "alignment": 1.0,
-            "safety": 1.0,
-            "explainability": 1.0,
-            "bias": 1.0,
-            "uncertainty": 1.0
-        }
-        if weights:
-            self.weights.update(weights)
-
-    def reward_accuracy(self, true_esi: int, predicted_esi: int) -> float:
-        """
-        Accuracy Reward:
-          - +10 for an exact match.
-          - If incorrect, apply a penalty proportional to the difference.
-          - Extra penalty (×2) if under–triaging (i.e., predicting a less urgent score).
-        """
-        if predicted_esi == true_esi:
-            return 10.0
-
-        diff = abs(predicted_esi - true_esi)
-        # Under–triage: predicted ESI > true ESI
-        if predicted_esi > true_esi:
-            penalty = 2 * diff
-        else:
-            penalty = diff
-        return -penalty
-
+        If fused_judge is True, the four LLM-judged sub-rewards are requested in a single
+        structured (JSON) judge call instead of one call per rubric.
+        If a JudgeCache is given, judge responses are looked up there before calling the API.
+        If a RubricPrescorer is given, clear-cut reasonings get their alignment and explainability
+        scores locally and only ambiguous ones are sent to the judge for those rubrics.
+        With fused_judge the prescorer is only used when alignment and explainability are the only
+        non-zero-weight judged rubrics, since the fused call scores every rubric anyway.
+        If a JudgeRouter is given, judge prompts go through it (routing and hedging across its
+        backends) instead of straight to the OpenAI chat API.
+        """
+        super().__init__("gpt-4", weights, fused_judge, cache, prescorer, judge)
+
+    @METRICS.timed("esi_reward_component_seconds", component="alignment")
     def reward_reasoning_alignment(self, reasoning: str) -> float:
         """
         Reasoning Alignment Reward:
@@ -48,6 +38,7 @@ class ESITriageReward:
         score = self.call_llm_assessment_alignment(reasoning)
         return score
 
+    @METRICS.timed("esi_reward_component_seconds", component="safety")
     def reward_safety(self, true_esi: int, predicted_esi: int, reasoning: str) -> float:
         """
         Safety and Conservatism Reward:
@@ -59,6 +50,7 @@ class ESITriageReward:
         score = self.call_llm_assessment_safety(true_esi, predicted_esi, reasoning)
         return score
 
+    @METRICS.timed("esi_reward_component_seconds", component="explainability")
     def reward_explainability(self, reasoning: str) -> float:
         """
         Transparency and Explainability Reward:
@@ -69,6 +61,7 @@ class ESITriageReward:
         score = self.call_llm_assessment_explainability(reasoning)
         return score
 
+    @METRICS.timed("esi_reward_component_seconds", component="bias")
     def reward_bias_mitigation(self, reasoning: str) -> float:
         """
         Bias Mitigation Reward:
@@ -80,40 +73,46 @@ class ESITriageReward:
         score = self.call_llm_assessment_bias(reasoning)
         return score
 
-    def reward_uncertainty_handling(self, reasoning: str, input_is_ambiguous: bool = False) -> float:
+    def chat_completion(self, system_content: str, prompt: str) -> str:
         """
-        Handling Uncertainty Reward:
-          - When the input is ambiguous, reward if uncertainty-related terms are present.
-          - Penalize if the explanation is overconfident despite ambiguous inputs.
+        Send a system + user message pair to the judge model and return the stripped reply text.
+        Replies are served from / stored in the judge cache when one is configured.
         """
-        uncertainty_keywords = ["uncertain", "possibly", "might", "unsure", "ambiguous", "low confidence"]
-        if input_is_ambiguous:
-            return 2.0 if any(kw in reasoning.lower() for kw in uncertainty_keywords) else -2.0
-        return 0.0
+        cache_prompt = f"{system_content}\n\n{prompt}"
+        if self.cache is not None:
+            cached = self.cache.get(cache_prompt, self.cache_model(), self.temperature)
+            if cached is not None:
+                return cached
+        if self.judge is not None:
+            content = self.judge.complete(prompt, system_content).strip()
+        else:
+            with backend_call("openai_chat"):
+                response = openai.ChatCompletion.create(
+                    model=self.model,
+                    messages=[
+                        {"role": "system", "content": system_content},
+                        {"role": "user", "content": prompt}
+                    ],
+                    temperature=self.temperature
+                )
+            record_usage("openai_chat", response.get("usage"))
+            content = response["choices"][0]["message"]["content"].strip()
+        if self.cache is not None:
+            self.cache.put(cache_prompt, self.cache_model(), self.temperature, content)
+        return content
 
     def call_llm_assessment_explainability(self, explanation: str) -> float:
         """
         Call an LLM to assess explanation quality based on clarity, conciseness, and structure.
         Returns a numerical score on a predefined scale.
         """
-        prompt = (
-            "You are an expert medical evaluator. Please assess the following explanation for clarity, conciseness, "
-            "and logical structure on a scale from -2 (poor) to +2 (excellent). Return only the numerical score.\n\n"
-            f"Explanation: {explanation}"
-        )
+        prompt = self.build_explainability_prompt(explanation)
         try:
-            response = openai.ChatCompletion.create(
-                model="gpt-4",
-                messages=[
-                    {"role": "system", "content": "You are an assistant evaluating medical explanation texts."},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0  # Deterministic output
-            )
-            score_str = response["choices"][0]["message"]["content"].strip()
+            score_str = self.chat_completion("You are an assistant evaluating medical explanation texts.", prompt)
             score = float(score_str)
         except Exception as e:
             print("Error calling LLM for explainability assessment:", e)
+            METRICS.inc("esi_reward_fallback_total", component="explainability")
             score = 0.0
         return score
 
@@ -123,26 +122,13 @@ class ESITriageReward:
         Expected to evaluate the inclusion of key factors (vital signs, chief complaint, resource utilization, etc.)
         and return a numerical score (e.g., -5 to +5).
         """
-        prompt = (
-            "You are an expert medical evaluator. Please assess the following reasoning for alignment with "
-            "established Emergency Severity Index (ESI) guidelines. Consider whether the explanation includes "
-            "relevant factors such as vital signs, chief complaint, and resource utilization. Rate the alignment "
-            "on a scale from -5 (poor alignment) to +5 (excellent alignment). Return only the numerical score.\n\n"
-            f"Reasoning: {reasoning}"
-        )
+        prompt = self.build_alignment_prompt(reasoning)
         try:
-            response = openai.ChatCompletion.create(
-                model="gpt-4",
-                messages=[
-                    {"role": "system", "content": "You are an assistant evaluating ESI reasoning alignment."},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0
-            )
-            score_str = response["choices"][0]["message"]["content"].strip()
+            score_str = self.chat_completion("You are an assistant evaluating ESI reasoning alignment.", prompt)
             score = float(score_str)
         except Exception as e:
             print("Error calling LLM for reasoning alignment assessment:", e)
+            METRICS.inc("esi_reward_fallback_total", component="alignment")
             score = 0.0
         return score
 
@@ -153,27 +139,13 @@ class ESITriageReward:
         asking the LLM to evaluate whether the decision errs on the side of caution.
         Returns a numerical score (e.g., -2 to +2).
         """
-        prompt = (
-            "You are an expert medical evaluator. Evaluate the safety of the following triage decision. "
-            "The true Emergency Severity Index (ESI) is provided along with the predicted ESI and the reasoning behind the prediction. "
-            "A safe decision should err on the side of caution (i.e., not under–triaging). "
-            "Rate the safety of the decision on a scale from -2 (unsafe, under–triage) to +2 (safe, conservative decision). "
-            "Return only the numerical score.\n\n"
-            f"True ESI: {true_esi}\nPredicted ESI: {predicted_esi}\nReasoning: {reasoning}"
-        )
+        prompt = self.build_safety_prompt(true_esi, predicted_esi, reasoning)
         try:
-            response = openai.ChatCompletion.create(
-                model="gpt-4",
-                messages=[
-                    {"role": "system", "content": "You are an assistant evaluating triage safety."},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0
-            )
-            score_str = response["choices"][0]["message"]["content"].strip()
+            score_str = self.chat_completion("You are an assistant evaluating triage safety.", prompt)
             score = float(score_str)
         except Exception as e:
             print("Error calling LLM for safety assessment:", e)
+            METRICS.inc("esi_reward_fallback_total", component="safety")
             score = 0.0
         return score
 
@@ -183,46 +155,37 @@ class ESITriageReward:
         The LLM is asked to determine if the explanation unnecessarily references sensitive demographic information,
         and to return a score on a scale (e.g., -3 for biased to 0 for bias-free).
         """
-        prompt = (
-            "You are an expert in medical ethics. Please assess the following explanation for any unnecessary or biased "
-            "references to sensitive demographic information (e.g., race, ethnicity, gender, age, etc.). "
-            "Rate the explanation on a scale from -3 (highly biased) to 0 (bias-free). Return only the numerical score.\n\n"
-            f"Explanation: {reasoning}"
-        )
+        prompt = self.build_bias_prompt(reasoning)
         try:
-            response = openai.ChatCompletion.create(
-                model="gpt-4",
-                messages=[
-                    {"role": "system", "content": "You are an assistant evaluating bias in medical explanations."},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0
-            )
-            score_str = response["choices"][0]["message"]["content"].strip()
+            score_str = self.chat_completion("You are an assistant evaluating bias in medical explanations.", prompt)
             score = float(score_str)
         except Exception as e:
             print("Error calling LLM for bias assessment:", e)
+            METRICS.inc("esi_reward_fallback_total", component="bias")
             score = 0.0
         return score
 
-    def compute_total_reward(self, true_esi: int, predicted_esi: int,
-                             reasoning: str, input_is_ambiguous: bool = False) -> float:
+    @METRICS.timed("esi_reward_component_seconds", component="fused")
+    def call_llm_assessment_fused(self, true_esi: int, predicted_esi: int, reasoning: str) -> Dict[str, float]:
         """
-        Compute the total reward as the weighted sum of all sub-rewards.
+        Call an LLM once to assess alignment, safety, explainability and bias together.
+        The LLM is asked for a JSON object with one score per rubric; each score is checked
+        against its documented range in SCORE_RANGES.
+        Returns the valid scores only (an empty dict if the call or parsing fails).
         """
-        r_acc         = self.weights["accuracy"] * self.reward_accuracy(true_esi, predicted_esi)
-        r_alignment   = self.weights["alignment"] * self.reward_reasoning_alignment(reasoning)
-        r_safety      = self.weights["safety"] * self.reward_safety(true_esi, predicted_esi, reasoning)
-        r_explain     = self.weights["explainability"] * self.reward_explainability(reasoning)
-        r_bias        = self.weights["bias"] * self.reward_bias_mitigation(reasoning)
-        r_uncertainty = self.weights["uncertainty"] * self.reward_uncertainty_handling(reasoning, input_is_ambiguous)
-
-        total_reward = r_acc + r_alignment + r_safety + r_explain + r_bias + r_uncertainty
-        return total_reward
+        prompt = self.build_fused_prompt(true_esi, predicted_esi, reasoning)
+        try:
+            content = self.chat_completion("You are an assistant evaluating ESI triage decisions.", prompt)
+        except Exception as e:
+            print("Error calling LLM for fused assessment:", e)
+            content = None
+        return self.checked_fused_scores(content)
 
 # ===== Example usage =====
 if __name__ == "__main__":
-    # Configure reward model (optionally adjust weights here)
+    # Configure reward model (optionally adjust weights here).
+    # Set fused_judge=True to score all four LLM rubrics in one judge call.
+    # Pass cache=JudgeCache("judge_cache.sqlite") to avoid re-querying the judge on re-runs.
     reward_model = ESITriageReward()
 
     # Example inputs:
@@ -237,3 +200,6 @@ if __name__ == "__main__":
 
     total = reward_model.compute_total_reward(true_esi, predicted_esi, reasoning, input_is_ambiguous)
     print("Total reward:", total)
+
+    # Per-component latency, backend usage and fallback counts (also available as METRICS.to_json())
+    print(METRICS.to_prometheus())
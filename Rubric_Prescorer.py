@@ -0,0 +1,178 @@
+import re
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+# Local, rule-based version of the rubric in ReasoningScoreingOverview.txt:
+# five decision points x two dimensions (content coverage, analytical integration), each cell -1/0/+1.
+DECISION_POINTS = ("life_saving", "high_risk", "resources", "vital_signs", "overall")
+DIMENSIONS = ("coverage", "integration")
+
+
+def _terms(*terms: str) -> re.Pattern:
+    """One case-insensitive alternation per term set; each term is a regex fragment."""
+    return re.compile(r"\b(?:" + "|".join(terms) + r")", re.IGNORECASE)
+
+
+# Term sets for decision points A-D. Each alternative counts once towards coverage.
+TERM_SETS = {
+    "life_saving": [
+        _terms(r"life[- ]saving", r"immediate (?:intervention|resuscitation)"),
+        _terms(r"airway", r"intubat\w*"),
+        _terms(r"resuscitat\w*", r"CPR", r"defibrillat\w*", r"cardiac arrest", r"pulseless"),
+        _terms(r"apne\w*", r"unresponsive", r"respiratory (?:arrest|failure)"),
+        _terms(r"ESI (?:level )?1\b", r"level 1\b"),
+    ],
+    "high_risk": [
+        _terms(r"high[- ]risk"),
+        _terms(r"altered mental status", r"AMS\b", r"confus\w*", r"letharg\w*", r"disorient\w*", r"GCS"),
+        _terms(r"severe (?:pain|distress)", r"pain (?:score|scale)?\s*(?:of\s*)?\d+\s*/\s*10", r"distress"),
+        _terms(r"chest pain", r"stroke", r"sepsis", r"\bMI\b", r"myocardial", r"suicid\w*", r"overdose"),
+        _terms(r"elderly", r"\d+[- ]year[- ]old", r"immunocompromised", r"pregnan\w*"),
+    ],
+    "resources": [
+        _terms(r"resources?"),
+        _terms(r"labs?\b", r"laboratory", r"blood (?:work|tests?)", r"CBC", r"troponin"),
+        _terms(r"x-?rays?", r"imaging", r"CT\b", r"MRI", r"ultrasound"),
+        _terms(r"IV (?:fluids|medications?|access)", r"intravenous", r"IM (?:medication|injection)"),
+        _terms(r"consult\w*", r"procedure", r"sutur\w*", r"ECG", r"EKG"),
+    ],
+    "vital_signs": [
+        _terms(r"vital signs?", r"vitals"),
+        _terms(r"heart rate", r"HR\b", r"pulse", r"tachycard\w*", r"bradycard\w*"),
+        _terms(r"blood pressure", r"BP\b", r"hypotens\w*", r"hypertens\w*", r"\d{2,3}\s*/\s*\d{2,3}\s*(?:mm ?Hg)?"),
+        _terms(r"respiratory rate", r"RR\b", r"tachypne\w*"),
+        _terms(r"SpO2", r"oxygen saturation", r"O2 sat\w*", r"hypox\w*", r"temperature", r"febrile", r"fever"),
+    ],
+}
+
+# Findings that argue for a high-acuity level (used to spot a final level that contradicts them)
+ACUITY_FINDINGS = {
+    "high_risk": _terms(r"high[- ]risk", r"altered mental status", r"severe (?:pain|distress)", r"unstable"),
+    "vital_signs": _terms(r"abnormal vital", r"tachycard\w*", r"hypotens\w*", r"hypox\w*", r"unstable vital"),
+}
+NEGATION_PATTERN = re.compile(r"\b(?:no|not|without|denies|denied|absence of|negative for)\b[^.;,]{0,40}$", re.IGNORECASE)
+
+# Connectives that tie a finding to the triage decision
+LINK_PATTERN = _terms(r"because", r"therefore", r"thus", r"hence", r"due to", r"given", r"as a result",
+                      r"which (?:justif|indicat|warrant|support|suggest|rule)\w*", r"justif\w*", r"warrant\w*",
+                      r"supports?", r"rules? out", r"exclud\w*", r"consistent with", r"so\b")
+DECISION_PATTERN = _terms(r"ESI", r"level", r"triage", r"priority", r"acuity", r"assign\w*", r"classif\w*")
+LEVEL_PATTERN = re.compile(r"\b(?:ESI|level)\s*(?:level\s*)?[:\-]?\s*([1-5])\b", re.IGNORECASE)
+SENTENCE_SPLIT = re.compile(r"(?<=[.!?;])\s+|\n+")
+WORD_PATTERN = re.compile(r"[A-Za-z0-9]+")
+
+
+@dataclass
+class RubricScore:
+    """Cell scores for one reasoning text, plus whether the local verdict is clear enough to skip the judge."""
+    cells: Dict[str, Dict[str, int]]
+    clear_cut: bool
+    flags: List[str] = field(default_factory=list)
+
+    @property
+    def total(self) -> int:
+        """Sum over all ten cells (-10 to +10)."""
+        return sum(sum(dims.values()) for dims in self.cells.values())
+
+    def alignment(self) -> float:
+        """Guideline alignment on the judge's -5..+5 scale (half of the rubric total)."""
+        return self.total / 2.0
+
+    def explainability(self) -> float:
+        """Explainability on the judge's -2..+2 scale (analytical-integration cells rescaled)."""
+        return sum(dims["integration"] for dims in self.cells.values()) * 2.0 / len(DECISION_POINTS)
+
+
+class RubricPrescorer:
+    """
+    Fast local scorer for the ESI reasoning rubric (ReasoningScoreingOverview.txt).
+
+    Decision points A-D (life-saving intervention, high-risk situation, resource needs, vital signs):
+      - Coverage: +1 if at least two distinct term sets of the point are mentioned, 0 for one, -1 for none.
+      - Integration: +1 if a sentence about the point also links it to the decision (a connective such as
+        "because"/"therefore" plus an ESI/level/triage reference), 0 if mentioned without such a link,
+        -1 if absent or if its acuity findings contradict a predicted level of 4-5.
+    Decision point E (overall integration):
+      - Coverage: +1 if A-D are all fully covered, 0 if at least three are mentioned, -1 otherwise.
+      - Integration: -1 on any contradiction or when no final level is stated; +1 if at least three of A-D
+        are linked to the decision; 0 otherwise.
+
+    A score is clear-cut when the total is at or below clear_low (the reasoning plainly ignores the rubric)
+    or at or above clear_high (it plainly covers it) and no structural red flag (e.g., a bare keyword list
+    spanning several decision points) was found. Everything else should go to the LLM judge.
+    """
+
+    def __init__(self, clear_low: int = -6, clear_high: int = 7, keyword_density: float = 0.34):
+        self.clear_low = clear_low
+        self.clear_high = clear_high
+        self.keyword_density = keyword_density
+
+    def score(self, reasoning: str, predicted_esi: Optional[int] = None) -> RubricScore:
+        sentences = [s for s in SENTENCE_SPLIT.split(reasoning or "") if s.strip()]
+        cells = {}
+        flags = []
+        contradicted = False
+
+        for point, term_sets in TERM_SETS.items():
+            hit_sets = set()
+            linked = False
+            for sentence in sentences:
+                hits = [i for i, pattern in enumerate(term_sets) if pattern.search(sentence)]
+                if not hits:
+                    continue
+                hit_sets.update(hits)
+                if LINK_PATTERN.search(sentence) and DECISION_PATTERN.search(sentence):
+                    linked = True
+
+            coverage = 1 if len(hit_sets) >= 2 else (0 if hit_sets else -1)
+            integration = (1 if linked else 0) if hit_sets else -1
+            if point in ACUITY_FINDINGS and predicted_esi is not None and predicted_esi >= 4:
+                if self._has_unnegated(ACUITY_FINDINGS[point], reasoning or ""):
+                    integration = -1
+                    contradicted = True
+                    flags.append(f"{point}_contradicts_level")
+            cells[point] = {"coverage": coverage, "integration": integration}
+
+        points = [cells[p] for p in TERM_SETS]
+        if all(c["coverage"] == 1 for c in points):
+            overall_coverage = 1
+        elif sum(c["coverage"] >= 0 for c in points) >= 3:
+            overall_coverage = 0
+        else:
+            overall_coverage = -1
+        if contradicted or not LEVEL_PATTERN.search(reasoning or ""):
+            overall_integration = -1
+        elif sum(c["integration"] == 1 for c in points) >= 3:
+            overall_integration = 1
+        else:
+            overall_integration = 0
+        cells["overall"] = {"coverage": overall_coverage, "integration": overall_integration}
+
+        if self._is_keyword_list(sentences):
+            flags.append("keyword_list")
+
+        result = RubricScore(cells, clear_cut=False, flags=flags)
+        result.clear_cut = "keyword_list" not in flags and (
+            result.total <= self.clear_low or result.total >= self.clear_high)
+        return result
+
+    @staticmethod
+    def _has_unnegated(pattern: re.Pattern, text: str) -> bool:
+        return any(not NEGATION_PATTERN.search(text[:m.start()]) for m in pattern.finditer(text))
+
+    def _is_keyword_list(self, sentences: List[str]) -> bool:
+        """
+        True if some sentence is mostly rubric terms from several decision points with nothing linking
+        them (buzzwords listed without context). Itemizing within one point, e.g. the expected resources,
+        or a dense sentence that ties its findings to the decision is not flagged.
+        """
+        for sentence in sentences:
+            matched = {point: sum(1 for pattern in sets if pattern.search(sentence))
+                       for point, sets in TERM_SETS.items()}
+            hits = sum(matched.values())
+            points = sum(1 for count in matched.values() if count)
+            if hits < 4 or points < 3 or LINK_PATTERN.search(sentence):
+                continue
+            if hits / max(len(WORD_PATTERN.findall(sentence)), 1) >= self.keyword_density:
+                return True
+        return False
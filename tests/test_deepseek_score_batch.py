@@ -0,0 +1,79 @@
+"""score_batch against the local mock judge server: input order, retries and fallbacks."""
+
+import pytest
+
+from Benchmark_Suite import MockJudgeServer
+from Metrics import METRICS
+from Reward_Functions_Deepseek import ESITriageReward
+
+RUBRICS = 4
+
+
+def counter(name, **labels):
+    for series in METRICS.snapshot()["counters"].get(name, []):
+        if series["labels"] == {k: str(v) for k, v in labels.items()}:
+            return series["value"]
+    return 0.0
+
+
+def make_records(n):
+    reasonings = ["Stable vitals, one resource expected.", "Abnormal vitals; this might be high risk."]
+    return [{"true_esi": 1 + i % 5, "predicted_esi": 1 + (i * 3) % 5, "reasoning": f"{reasonings[i % 2]} (case {i})",
+             "input_is_ambiguous": i % 3 == 0} for i in range(n)]
+
+
+def expected_totals(reward_model, records, judged):
+    return [reward_model.combine_rewards(r["true_esi"], r["predicted_esi"], r["reasoning"], r["input_is_ambiguous"],
+                                         judged) for r in records]
+
+
+@pytest.fixture(autouse=True)
+def reset_metrics():
+    METRICS.reset()
+    yield
+    METRICS.reset()
+
+
+def test_score_batch_keeps_input_order_and_retries_failed_requests():
+    records = make_records(24)
+    with MockJudgeServer(latency_ms=2, jitter_ms=1, error_rate=0.2, seed=1) as server:
+        reward_model = ESITriageReward(api_url=f"{server.url}/deepseek-r1", api_key="mock-key")
+        totals = reward_model.score_batch(records, concurrency=8, max_retries=10)
+        requests = server.request_count
+
+    # The mock scores every rubric 1; any order mix-up changes the per-record totals
+    judged = {"alignment": 1.0, "safety": 1.0, "explainability": 1.0, "bias": 1.0}
+    assert totals == expected_totals(reward_model, records, judged)
+    assert counter("esi_reward_fallback_total", component="alignment") == 0
+    # Every request beyond one per rubric and record was a retry of a 429/503
+    retries = requests - len(records) * RUBRICS
+    assert retries > 0
+    assert counter("esi_backend_retries_total", backend="deepseek") == retries
+
+
+def test_score_batch_falls_back_to_zero_when_retries_are_exhausted():
+    records = make_records(6)
+    with MockJudgeServer(latency_ms=1, jitter_ms=0, error_rate=1.0) as server:
+        reward_model = ESITriageReward(api_url=f"{server.url}/deepseek-r1", api_key="mock-key")
+        totals = reward_model.score_batch(records, concurrency=4, max_retries=1)
+        requests = server.request_count
+
+    zero = {"alignment": 0.0, "safety": 0.0, "explainability": 0.0, "bias": 0.0}
+    assert totals == expected_totals(reward_model, records, zero)
+    assert requests == len(records) * RUBRICS * 2
+    assert counter("esi_backend_retries_total", backend="deepseek") == len(records) * RUBRICS
+    for name in zero:
+        assert counter("esi_reward_fallback_total", component=name) == len(records)
+
+
+def test_fused_score_batch_keeps_input_order_under_errors():
+    records = make_records(30)
+    with MockJudgeServer(latency_ms=2, jitter_ms=1, error_rate=0.2, seed=2) as server:
+        reward_model = ESITriageReward(fused_judge=True, api_url=f"{server.url}/deepseek-r1", api_key="mock-key")
+        totals = reward_model.score_batch(records, concurrency=8, max_retries=10)
+        requests = server.request_count
+
+    judged = {"alignment": 3.0, "safety": 1.0, "explainability": 1.0, "bias": 0.0}
+    assert totals == expected_totals(reward_model, records, judged)
+    assert counter("esi_fused_judge_incomplete_total") == 0
+    assert counter("esi_backend_retries_total", backend="deepseek") == requests - len(records)
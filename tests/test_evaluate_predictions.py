@@ -0,0 +1,55 @@
+"""Evaluation harness: joint-cell bookkeeping and the multinomial bootstrap."""
+
+import numpy as np
+
+import Evaluate_Predictions as E
+
+
+def make_data(n, k, seed=0):
+    rng = np.random.default_rng(seed)
+    reference = rng.integers(1, 6, n)
+    predictions = []
+    for _ in range(k):
+        predicted = np.clip(reference + rng.choice([-1, 0, 0, 0, 1], n), 1, 5)
+        predicted[rng.random(n) < 0.05] = 0
+        predictions.append(predicted)
+    return reference, predictions
+
+
+def test_reward_matrix_matches_reward_accuracy():
+    matrix = E.reward_accuracy_matrix()
+    assert matrix[1, 1] == 10.0
+    assert matrix[1, 3] == -4.0  # under-triage by two levels
+    assert matrix[3, 1] == -2.0  # over-triage by two levels
+
+
+def test_joint_cells_stay_bounded_by_visits_for_many_models():
+    reference, predictions = make_data(2000, 8)
+    cells, counts = E.joint_counts(reference, predictions)
+    assert counts.sum() == 2000
+    assert len(counts) <= 2000  # the full joint table would have 5 * 6^8 cells
+    for confusion, predicted in zip(E._marginal_confusions(counts, cells), predictions):
+        assert (confusion == E.confusion_matrix(reference, predicted)).all()
+
+
+def test_bootstrap_marginals_match_each_draw():
+    reference, predictions = make_data(500, 3, seed=1)
+    cells, counts = E.joint_counts(reference, predictions)
+    draws = np.random.default_rng(2).multinomial(500, counts / 500, size=4)
+    for j, confusions in enumerate(E._marginal_confusions(draws, cells)):
+        for draw, confusion in zip(draws, confusions):
+            expected = np.zeros((E.LEVELS, E.STATES), dtype=int)
+            for cell, count in zip(cells, draw):
+                expected[cell[0] - 1, cell[j + 1]] += count
+            assert (confusion == expected).all()
+
+
+def test_evaluate_reports_paired_differences_for_eight_models():
+    reference, predictions = make_data(3000, 8, seed=3)
+    names = [f"model_{j}" for j in range(8)]
+    result = E.evaluate(reference, dict(zip(names, predictions)), baseline="model_0", resamples=200, workers=1)
+    assert set(result["differences"]) == set(names[1:])
+    for name, predicted in zip(names, predictions):
+        accuracy = result["metrics"][name]["accuracy"]
+        assert accuracy["value"] == np.mean(reference == predicted)
+        assert accuracy["ci_low"] <= accuracy["value"] <= accuracy["ci_high"]
@@ -0,0 +1,71 @@
+"""Inference server request validation and micro-batch failure isolation (model calls are stubbed)."""
+
+import http.client
+import json
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+import Inference_Server
+import Method_1_ZeroShot
+from Method_1_ZeroShot import ESIPrediction
+from Metrics import METRICS
+
+
+def fake_generate(texts, batch_size, max_new_tokens):
+    if any("oversized" in text for text in texts):
+        raise RuntimeError("input too long")
+    return [ESIPrediction(level=3, reasoning=text, prompt_tokens=1, completion_tokens=1, text=text) for text in texts]
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(Method_1_ZeroShot, "generate_esi_predictions_batch", fake_generate)
+    batcher = Inference_Server.MicroBatcher(max_batch_size=8, max_wait_ms=200.0)
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Inference_Server.make_handler(batcher, request_timeout=10.0))
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd.server_port
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def post(port, data):
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    connection.request("POST", "/predict", body=data, headers={"Content-Type": "application/json"})
+    response = connection.getresponse()
+    payload = json.loads(response.read())
+    connection.close()
+    return response.status, payload
+
+
+@pytest.mark.parametrize("data", [b"[1]", b'"text"', b"not json", b"{}", b'{"triage_text": ["a"]}',
+                                  b'{"triage_text": {"a": 1}}', b'{"triage_text": 7}'])
+def test_malformed_bodies_get_400(server, data):
+    status, payload = post(server, data)
+    assert status == 400
+    assert "triage_text" in payload["error"]
+
+
+def test_one_failing_input_does_not_fail_the_rest_of_its_batch(server):
+    texts = ["chest pain", "oversized narrative", "ankle sprain", "fever"]
+    results = {}
+
+    def send(text):
+        results[text] = post(server, json.dumps({"triage_text": text}).encode("utf-8"))
+
+    threads = [threading.Thread(target=send, args=(text,)) for text in texts]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # All four arrive within max_wait_ms, so they share one micro-batch that is then retried per request
+    retries = METRICS.snapshot()["counters"]["esi_server_batch_retries_total"]
+    assert sum(series["value"] for series in retries) >= 1
+    assert results["oversized narrative"][0] == 500
+    for text in ("chest pain", "ankle sprain", "fever"):
+        status, payload = results[text]
+        assert status == 200
+        assert payload["reasoning"] == text
@@ -0,0 +1,114 @@
+"""NarrativeScheduler and streaming generation against the local mock completion server."""
+
+import json
+import time
+
+import openai
+import pandas as pd
+import pytest
+
+from Benchmark_Suite import MockJudgeServer
+from Generate_Narratives import NarrativeScheduler, generate_narratives_streaming, read_narrative_shards
+from Rate_Limiter import TokenBucket
+
+
+def make_rows(n):
+    return [(str(i), pd.Series({
+        "Patient_Age": 20 + i, "Patient_Sex": "F" if i % 2 else "M", "PatientChiefComplaint": "chest pain",
+        "Mode of Arrival": "Walk-in", "Arrival Time": "10:00", "Vital_Signs": "BP 120/80, HR 80",
+    })) for i in range(n)]
+
+
+def make_scheduler(max_retries):
+    return NarrativeScheduler(max_workers=4, requests_per_minute=10 ** 6, tokens_per_minute=10 ** 9,
+                              max_retries=max_retries, backoff_base=0.001, backoff_max=0.01)
+
+
+@pytest.fixture
+def completion_server(monkeypatch):
+    servers = []
+
+    def start(error_rate, seed=0):
+        server = MockJudgeServer(latency_ms=1, jitter_ms=0, error_rate=error_rate, seed=seed).start()
+        servers.append(server)
+        monkeypatch.setattr(openai, "api_base", f"{server.url}/v1")
+        return server
+
+    yield start
+    for server in servers:
+        server.stop()
+
+
+def test_failed_rows_are_reported_and_never_returned_as_narratives(completion_server):
+    completion_server(error_rate=0.5, seed=3)
+    rows = make_rows(20)
+    narratives, failures = make_scheduler(max_retries=0).run(rows)
+
+    assert failures and narratives
+    assert not set(narratives) & set(failures)
+    assert set(narratives) | set(failures) == {row_id for row_id, _ in rows}
+    assert all(isinstance(text, str) and text for text in narratives.values())
+    assert all(error.split(":")[0] in ("RateLimitError", "ServiceUnavailableError", "APIError")
+               for error in failures.values())
+
+
+def test_retries_recover_transient_errors(completion_server):
+    server = completion_server(error_rate=0.3, seed=4)
+    rows = make_rows(20)
+    narratives, failures = make_scheduler(max_retries=10).run(rows)
+
+    assert failures == {}
+    assert set(narratives) == {row_id for row_id, _ in rows}
+    assert server.request_count > len(rows)
+
+
+def test_streaming_requeues_failed_rows_on_the_next_run(completion_server, tmp_path):
+    source = tmp_path / "patients.csv"
+    pd.DataFrame([row for _, row in make_rows(12)]).to_csv(source, index=False)
+    output_dir = tmp_path / "narratives"
+
+    completion_server(error_rate=0.5, seed=5)
+    first = generate_narratives_streaming(str(source), str(output_dir), chunk_size=5, scheduler=make_scheduler(0))
+    with open(output_dir / "failures.jsonl", encoding="utf-8") as f:
+        failed = {json.loads(line)["row_id"] for line in f}
+    assert failed and first == 12 - len(failed)
+
+    completion_server(error_rate=0.0)
+    second = generate_narratives_streaming(str(source), str(output_dir), chunk_size=5, scheduler=make_scheduler(0))
+    assert second == len(failed)
+
+    shards = read_narrative_shards(str(output_dir))
+    assert sorted(shards["row_id"], key=int) == [str(i) for i in range(12)]
+    assert shards["Narrative"].notna().all()
+
+    # Everything is done: a third run has nothing left to do
+    assert generate_narratives_streaming(str(source), str(output_dir), chunk_size=5,
+                                         scheduler=make_scheduler(0)) == 0
+
+
+def test_token_bucket_acquire_blocks_until_refilled():
+    bucket = TokenBucket(rate_per_minute=600, capacity=2)  # 10 units per second
+    start = time.monotonic()
+    bucket.acquire(2)
+    assert time.monotonic() - start < 0.05
+    bucket.acquire(1)
+    assert time.monotonic() - start >= 0.09
+
+
+def test_token_bucket_caps_requests_at_capacity():
+    bucket = TokenBucket(rate_per_minute=60, capacity=5)
+    start = time.monotonic()
+    bucket.acquire(50)  # more than the bucket can ever hold: takes the whole bucket instead of blocking forever
+    assert time.monotonic() - start < 0.05
+    assert bucket.available < 0.1
+
+
+def test_token_bucket_adjust_charges_and_refunds():
+    bucket = TokenBucket(rate_per_minute=6, capacity=100)  # refill is negligible during the test
+    bucket.acquire(40)
+    bucket.adjust(20)  # real usage was 20 higher than estimated
+    assert bucket.available == pytest.approx(40, abs=0.1)
+    bucket.adjust(-30)  # real usage was 30 lower than estimated
+    assert bucket.available == pytest.approx(70, abs=0.1)
+    bucket.adjust(-500)  # refunds never overfill the bucket
+    assert bucket.available == pytest.approx(100)
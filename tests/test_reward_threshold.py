@@ -0,0 +1,88 @@
+"""passes_threshold must make the same decision as compute_total_reward >= threshold."""
+
+import random
+import zlib
+
+import pytest
+
+from Reward_Functions_Base import ESITriageRewardBase
+from Rubric_Prescorer import RubricPrescorer
+
+REASONINGS = [
+    "No immediate life-saving intervention is needed. Chest pain with hypotension (BP 90/60) and tachycardia "
+    "is a high-risk situation, so ESI 2 is assigned.",
+    "Vital signs are stable and the patient needs one resource (sutures), so ESI 4.",
+    "The presentation is ambiguous; the patient might need labs and imaging, possibly ESI 3.",
+    "Patient is a 45-year-old woman with abdominal pain; two resources expected (labs, CT), ESI 3.",
+    "ESI 5, no resources.",
+]
+
+
+class FakeJudgeReward(ESITriageRewardBase):
+    """Deterministic in-process judge: each (rubric, case) gets a fixed score within SCORE_RANGES."""
+
+    def __init__(self, seed, **kwargs):
+        super().__init__("fake", **kwargs)
+        self.seed = seed
+        self.calls = 0
+
+    def score(self, name, true_esi, predicted_esi, reasoning):
+        low, high = self.SCORE_RANGES[name]
+        rng = random.Random(zlib.crc32(f"{self.seed}|{name}|{true_esi}|{predicted_esi}|{reasoning}".encode()))
+        return round(rng.uniform(low, high), 1)
+
+    def reward_reasoning_alignment(self, reasoning):
+        self.calls += 1
+        return self.score("alignment", None, None, reasoning)
+
+    def reward_safety(self, true_esi, predicted_esi, reasoning):
+        self.calls += 1
+        return self.score("safety", true_esi, predicted_esi, reasoning)
+
+    def reward_explainability(self, reasoning):
+        self.calls += 1
+        return self.score("explainability", None, None, reasoning)
+
+    def reward_bias_mitigation(self, reasoning):
+        self.calls += 1
+        return self.score("bias", None, None, reasoning)
+
+    def call_llm_assessment_fused(self, true_esi, predicted_esi, reasoning):
+        # Same scores as the per-rubric calls; some replies miss a rubric to exercise the fallback
+        self.calls += 1
+        rng = random.Random(zlib.crc32(f"{self.seed}|fused|{reasoning}".encode()))
+        scores = {"alignment": self.score("alignment", None, None, reasoning),
+                  "safety": self.score("safety", true_esi, predicted_esi, reasoning),
+                  "explainability": self.score("explainability", None, None, reasoning),
+                  "bias": self.score("bias", None, None, reasoning)}
+        return {name: value for name, value in scores.items() if rng.random() < 0.8}
+
+
+def random_weights(rng):
+    return {name: rng.choice([0.0, 0.5, 1.0, 2.0, rng.uniform(-1.0, 3.0)])
+            for name in ("accuracy", "alignment", "safety", "explainability", "bias", "uncertainty")}
+
+
+@pytest.mark.parametrize("fused", [False, True])
+@pytest.mark.parametrize("prescorer", [None, RubricPrescorer()], ids=["judge_only", "prescorer"])
+def test_threshold_decision_matches_total_reward(fused, prescorer):
+    rng = random.Random(1234 + fused)
+    mismatches = []
+    for case in range(750):
+        reward_model = FakeJudgeReward(case, weights=random_weights(rng), fused_judge=fused, prescorer=prescorer)
+        true_esi, predicted_esi = rng.randint(1, 5), rng.randint(1, 5)
+        reasoning = rng.choice(REASONINGS)
+        ambiguous = rng.random() < 0.3
+        total = reward_model.compute_total_reward(true_esi, predicted_esi, reasoning, ambiguous)
+        threshold = round(total + rng.uniform(-6.0, 6.0), 1) if rng.random() < 0.9 else total
+        decision = reward_model.passes_threshold(true_esi, predicted_esi, reasoning, threshold, ambiguous)
+        if decision != (total >= threshold):
+            mismatches.append((case, total, threshold, decision))
+    assert mismatches == []
+
+
+def test_threshold_decision_skips_judge_calls_when_already_certain():
+    reward_model = FakeJudgeReward(0)
+    # Exact match (+10) and the worst judged scores still leave the total above -20
+    assert reward_model.passes_threshold(3, 3, REASONINGS[1], threshold=-20.0)
+    assert reward_model.calls == 0
@@ -0,0 +1,28 @@
+"""Response-token mask used by the RL policy-gradient loss."""
+
+import torch
+
+from RL_Rollout_Pipeline import response_mask
+
+EOS = 9  # also the pad token, as when pad_token = eos_token
+
+
+def test_first_eos_is_kept_and_padding_after_it_is_masked():
+    response = torch.tensor([[5, 6, EOS, EOS, EOS],
+                             [5, 6, 7, 8, 4]])
+    assert response_mask(response, [EOS]).tolist() == [[1, 1, 1, 0, 0],
+                                                        [1, 1, 1, 1, 1]]
+
+
+def test_rows_ended_by_the_stopping_criteria_keep_no_pad_token():
+    # Row 0 was complete after 2 tokens and padded with EOS from there; row 1 sampled EOS itself
+    response = torch.tensor([[5, 6, EOS, EOS],
+                             [5, EOS, EOS, EOS]])
+    assert response_mask(response, [EOS], stopped_at=[2, 3]).tolist() == [[1, 1, 0, 0],
+                                                                          [1, 1, 0, 0]]
+
+
+def test_any_of_several_eos_ids_ends_the_response():
+    response = torch.tensor([[5, 3, 6, 6], [5, 6, 6, 9]])
+    assert response_mask(response, [3, 9], stopped_at=[None, None]).tolist() == [[1, 1, 0, 0],
+                                                                                  [1, 1, 1, 1]]